@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""Imputation challenge BED reader
+
+BED files (annotations and blacklist) are parsed into typed columns
+at once instead of keeping raw lines that are split again by each
+metric. Parsed files are cached per process.
+
+Annotations can also be compiled (build_annot_bins.py) into bin ranges
+(slices on a binned track) of each region for a window size and
+promoter location, so that scoring does not do bin arithmetic.
+
+Author:
+    Jin Lee (leepc12@gmail.com)
+"""
+
+import os
+import gzip
+import numpy
+from itertools import chain
+from collections import namedtuple
+from logger import log
+
+
+# chrom: str array, start/end: int64 arrays,
+# strand: str array ('.' if BED has less than 6 columns)
+BedColumns = namedtuple(
+    'BedColumns',
+    ('chrom', 'start', 'end', 'strand')
+)
+
+# bin ranges of regions compiled from an annotation BED
+# slices: { region: { chrom: (start, stop) } } where start/stop are
+# int64 arrays of unclipped slice bounds in the same order as in BED.
+# region is 'prom' or 'gene' (gene BED) or 'enh' (enhancer BED)
+RegionBins = namedtuple(
+    'RegionBins',
+    ('window_size', 'prom_loc', 'slices')
+)
+
+# { (path, mtime, size): BedColumns or RegionBins }
+BED_CACHE = {}
+
+
+def make_bed_columns(chrom, start, end, strand):
+    bed = BedColumns(
+        chrom=numpy.asarray(chrom, dtype=str),
+        start=numpy.asarray(start, dtype=numpy.int64),
+        end=numpy.asarray(end, dtype=numpy.int64),
+        strand=numpy.asarray(strand, dtype=str))
+    # shared by all callers (cached)
+    for arr in bed:
+        arr.setflags(write=False)
+    return bed
+
+
+def parse_bed_lines(lines):
+    """Parse BED lines one by one. Empty lines are skipped.
+    """
+    rows = [line.split() for line in lines]
+    rows = [r for r in rows if r]
+    return make_bed_columns(
+        [r[0] for r in rows],
+        [int(r[1]) for r in rows],
+        [int(r[2]) for r in rows],
+        [r[5] if len(r) > 5 else '.' for r in rows])
+
+
+def parse_bed(buf):
+    """Parse BED contents (bytes) into BedColumns.
+
+    If all lines have the same number of columns, each column is
+    converted at once from the split tokens. Otherwise parsed line by
+    line.
+    """
+    buf = buf.strip()
+    if not buf:
+        return parse_bed_lines([])
+
+    rows = [line.split() for line in buf.split(b'\n')]
+    num_col = len(rows[0])
+    num_line = len(rows)
+    # total number of tokens can match even if lines have different
+    # numbers of columns, so check each line
+    if num_col >= 3 and all(len(r) == num_col for r in rows):
+        tokens = list(chain.from_iterable(rows))
+
+        def col(i):
+            return numpy.array(tokens[i::num_col])
+        try:
+            return make_bed_columns(
+                col(0).astype(str),
+                col(1).astype(numpy.int64),
+                col(2).astype(numpy.int64),
+                col(5).astype(str) if num_col > 5
+                else numpy.full(num_line, '.'))
+        except ValueError:
+            pass
+    return parse_bed_lines(buf.decode('ascii').splitlines())
+
+
+def load_bed_columns(bed):
+    """Read gzipped/uncompressed BED into BedColumns.
+    Cached until the file is modified.
+    """
+    st = os.stat(bed)
+    key = (os.path.abspath(bed), st.st_mtime, st.st_size)
+    if key not in BED_CACHE:
+        log.info('Reading from BED {}...'.format(bed))
+        if bed.endswith('gz'):
+            with gzip.open(bed, 'rb') as fp:
+                buf = fp.read()
+        else:
+            with open(bed, 'rb') as fp:
+                buf = fp.read()
+        BED_CACHE[key] = parse_bed(buf)
+    return BED_CACHE[key]
+
+
+def get_bed_columns(annotations):
+    """BedColumns from BedColumns or BED lines (e.g. from
+    bw_to_npy.load_bed())
+    """
+    if isinstance(annotations, BedColumns):
+        return annotations
+    return parse_bed_lines(annotations)
+
+
+def get_chrom_bins(annotations, chrom, window_size=25):
+    """Bin range of each region on a chromosome, in the same order as
+    in BED.
+
+    Returns:
+        (start, end, strand) where start = start // window_size and
+        end = end // window_size + 1
+    """
+    bed = get_bed_columns(annotations)
+    m = bed.chrom == chrom
+    return (bed.start[m] // window_size,
+            bed.end[m] // window_size + 1,
+            bed.strand[m])
+
+
+def get_region_slices(annotations, chrom, window_size=25, region='gene',
+                      prom_loc=80):
+    """Slice (on a binned track) of each region on a chromosome
+    visited by mseprom/msegene/mseenh, in the same order as in BED.
+    Slices are not clipped to the track length.
+
+    Args:
+        annotations: RegionBins, BedColumns or BED lines
+        region: 'prom', 'gene' or 'enh'
+    Returns:
+        (start, stop) int64 arrays
+    """
+    if isinstance(annotations, RegionBins):
+        if annotations.window_size != window_size or \
+                region == 'prom' and annotations.prom_loc != prom_loc:
+            raise ValueError(
+                'Region bins compiled for window_size={}, prom_loc={} '
+                'cannot be used for window_size={}, prom_loc={}.'.format(
+                    annotations.window_size, annotations.prom_loc,
+                    window_size, prom_loc))
+        if region not in annotations.slices:
+            raise ValueError(
+                'Region {} is not compiled in region bins.'.format(region))
+        empty = numpy.array([], dtype=numpy.int64)
+        return annotations.slices[region].get(chrom, (empty, empty))
+
+    start, end, strand = get_chrom_bins(annotations, chrom, window_size)
+    if region == 'prom':
+        plus = strand == '+'
+        return (numpy.where(plus, start - prom_loc, end),
+                numpy.where(plus, start, end + prom_loc))
+    return start, end
+
+
+def compile_region_bins(bed, regions, window_size=25, prom_loc=80):
+    """Compile annotations into RegionBins
+
+    Args:
+        bed: BedColumns
+        regions: e.g. ('prom', 'gene') for genes or ('enh',)
+    """
+    slices = {}
+    for region in regions:
+        slices[region] = {}
+        for c in numpy.unique(bed.chrom).tolist():
+            slices[region][c] = get_region_slices(
+                bed, c, window_size, region, prom_loc)
+    return RegionBins(window_size=window_size, prom_loc=prom_loc,
+                      slices=slices)
+
+
+def get_region_bins_file(bed, window_size=25, prom_loc=80):
+    """Compiled region bins are stored next to the source BED
+    """
+    return '{}.bins.w{}.p{}.npz'.format(bed, window_size, prom_loc)
+
+
+def write_region_bins(region_bins, npz):
+    arrs = {
+        'window_size': region_bins.window_size,
+        'prom_loc': region_bins.prom_loc,
+    }
+    for region, d in region_bins.slices.items():
+        for c, (start, stop) in d.items():
+            arrs['{}:{}:start'.format(region, c)] = start
+            arrs['{}:{}:stop'.format(region, c)] = stop
+    # write to a temporary file first since scoring can read it anytime
+    tmp_npz = npz + '.tmp.npz'
+    numpy.savez(tmp_npz, **arrs)
+    os.replace(tmp_npz, npz)
+
+
+def read_region_bins(npz):
+    slices = {}
+    with numpy.load(npz) as f:
+        window_size = int(f['window_size'])
+        prom_loc = int(f['prom_loc'])
+        for k in f.files:
+            if k.count(':') != 2:
+                continue
+            region, c, bound = k.split(':')
+            if bound == 'start':
+                slices.setdefault(region, {})[c] = (
+                    f[k], f['{}:{}:stop'.format(region, c)])
+    return RegionBins(window_size=window_size, prom_loc=prom_loc,
+                      slices=slices)
+
+
+def load_annotations(bed, window_size=25, prom_loc=80):
+    """Load compiled region bins for bed if they are up to date.
+    Otherwise BedColumns of bed.
+    """
+    npz = get_region_bins_file(bed, window_size, prom_loc)
+    if not os.path.exists(npz) or \
+            os.path.getmtime(npz) < os.path.getmtime(bed):
+        return load_bed_columns(bed)
+
+    st = os.stat(npz)
+    key = (os.path.abspath(npz), st.st_mtime, st.st_size)
+    if key not in BED_CACHE:
+        log.info('Reading region bins {}...'.format(npz))
+        BED_CACHE[key] = read_region_bins(npz)
+    return BED_CACHE[key]
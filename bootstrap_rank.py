@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Imputation challenge bootstrap aggregation for global ranks
+
+Global scores of all teams are kept in a (cell/assay, bootstrap, team)
+array so that per-team score distributions, confidence bounds and rank
+stability are calculated with numpy instead of nested Python loops.
+
+Cell/assays (and a chromosome bootstrap for each of them) can also be
+resampled with replacement to get many more bootstrap samples than the
+fixed --bootstrap-chrom groups.
+
+Author:
+    Jin Lee (leepc12@gmail.com)
+"""
+
+import numpy
+from collections import namedtuple, OrderedDict
+from scipy.stats import rankdata
+
+
+# rank of a team is the second best one among bootstraps
+RANK_NTH_BEST = 1
+
+# per-team statistics over bootstraps
+# all are arrays in the same order as team_ids
+BootstrapStats = namedtuple(
+    'BootstrapStats',
+    ('team_ids', 'score_lb', 'score_mean', 'score_ub', 'rank', 'rank_std')
+)
+
+
+def get_global_score_array(cell_assay_ranks, all_users):
+    """Global score of each team for each cell/assay and bootstrap.
+    A team without submission for a cell/assay gets 0.5.
+
+    Args:
+        cell_assay_ranks: OrderedDict { (cell, assay): CellAssayRanks }
+    Returns:
+        (scores, valid, team_ids, bootstrap_ids)
+        scores: array (cell/assay, bootstrap, team)
+        valid: bool array (cell/assay, bootstrap).
+            False if a cell/assay does not have a bootstrap
+        team_ids and bootstrap_ids are in the order of array axes.
+        bootstrap_ids are in the order they first appear.
+    """
+    team_ids = sorted(all_users)
+    team_idx = {t: i for i, t in enumerate(team_ids)}
+    bootstrap_ids = list(OrderedDict.fromkeys(
+        index for r in cell_assay_ranks.values()
+        for index in r.bootstrap_scores))
+    bootstrap_idx = {k: i for i, k in enumerate(bootstrap_ids)}
+
+    scores = numpy.full(
+        (len(cell_assay_ranks), len(bootstrap_ids), len(team_ids)), 0.5)
+    valid = numpy.zeros(scores.shape[:2], dtype=bool)
+    for g, r in enumerate(cell_assay_ranks.values()):
+        for index, team_scores in r.bootstrap_scores.items():
+            b = bootstrap_idx[index]
+            valid[g, b] = True
+            if team_scores:
+                t, s = zip(*team_scores)
+                scores[g, b, [team_idx[x] for x in t]] = s
+
+    return scores, valid, team_ids, bootstrap_ids
+
+
+def sum_over_cell_assays(scores, valid):
+    """Sum of global scores (bootstrap, team) over cell/assays.
+    Cell/assays are added in order, as in Python's sum(), so that ties
+    are broken in the same way as before.
+    """
+    total = numpy.zeros(scores.shape[1:])
+    for g in range(scores.shape[0]):
+        total += numpy.where(valid[g][:, numpy.newaxis], scores[g], 0.0)
+    return total
+
+
+def calc_bootstrap_stats(scores, valid, team_ids):
+    """Statistics over the fixed bootstraps
+
+    Score bounds are min/max of bootstrap scores and the rank of a team
+    is the second best rank among bootstraps.
+
+    Returns:
+        (BootstrapStats, total) where total is
+        sum_over_cell_assays() (bootstrap, team)
+    """
+    total = sum_over_cell_assays(scores, valid)
+    mean = total / valid.sum(axis=0)[:, numpy.newaxis]
+    ranks = rankdata(total, axis=1)
+
+    mean_sum = numpy.zeros(len(team_ids))
+    for b in range(mean.shape[0]):
+        mean_sum += mean[b]
+
+    stats = BootstrapStats(
+        team_ids=team_ids,
+        score_lb=mean.min(axis=0),
+        score_mean=mean_sum / mean.shape[0],
+        score_ub=mean.max(axis=0),
+        rank=numpy.sort(ranks, axis=0)[RANK_NTH_BEST],
+        rank_std=ranks.std(axis=0))
+    return stats, total
+
+
+def resample_global_scores(scores, valid, num_resamples, seed=None,
+                           chunk_size=100):
+    """Resample cell/assays with replacement (and a chromosome bootstrap
+    for each of them) and average global scores over them.
+
+    Returns:
+        array (resample, team)
+    """
+    num_groups, num_bootstraps, num_teams = scores.shape
+    # fill missing bootstraps with a cell/assay's mean
+    masked = numpy.where(valid[:, :, numpy.newaxis], scores, numpy.nan)
+    group_mean = numpy.nanmean(masked, axis=1)
+    filled = numpy.where(
+        valid[:, :, numpy.newaxis], scores, group_mean[:, numpy.newaxis, :])
+
+    rng = numpy.random.RandomState(seed)
+    result = numpy.zeros((num_resamples, num_teams))
+    for i in range(0, num_resamples, chunk_size):
+        n = min(chunk_size, num_resamples - i)
+        g = rng.randint(num_groups, size=(n, num_groups))
+        b = rng.randint(num_bootstraps, size=(n, num_groups))
+        result[i:i + n] = filled[g, b].mean(axis=1)
+    return result
+
+
+def calc_resampled_stats(resampled, team_ids, ci=0.95):
+    """Statistics over resampled global scores (resample, team)
+
+    Score bounds are the confidence interval and the rank of a team is
+    its median rank over resamples.
+    """
+    q = (1.0 - ci) / 2.0 * 100.0
+    ranks = rankdata(resampled, axis=1)
+    return BootstrapStats(
+        team_ids=team_ids,
+        score_lb=numpy.percentile(resampled, q, axis=0),
+        score_mean=resampled.mean(axis=0),
+        score_ub=numpy.percentile(resampled, 100.0 - q, axis=0),
+        rank=numpy.median(ranks, axis=0),
+        rank_std=ranks.std(axis=0))
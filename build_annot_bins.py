@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Imputation challenge annotation compiler
+
+Compile gene/enhancer annotation BEDs into bin ranges of promoter/gene/
+enhancer regions for a window size and promoter location. Compiled
+files (.bins.wXX.pYY.npz) are written next to each BED and loaded
+instead of the BED by scoring scripts with the same parameters.
+
+Author:
+    Jin Lee (leepc12@gmail.com)
+"""
+
+from bed import load_bed_columns, compile_region_bins
+from bed import get_region_bins_file, write_region_bins
+from logger import log
+
+
+def build_annot_bins(bed, regions, window_size=25, prom_loc=80):
+    """Returns:
+        Compiled region bins file
+    """
+    region_bins = compile_region_bins(
+        load_bed_columns(bed), regions, window_size, prom_loc)
+    npz = get_region_bins_file(bed, window_size, prom_loc)
+    log.info('Writing region bins {}...'.format(npz))
+    write_region_bins(region_bins, npz)
+    return npz
+
+
+def parse_arguments():
+    import argparse
+    import os
+
+    py_path = os.path.dirname(os.path.realpath(__file__))
+
+    parser = argparse.ArgumentParser(
+        description='ENCODE Imputation Challenge annotation compiler')
+    parser.add_argument('--gene-annotations',
+                        default=os.path.join(
+                            py_path,
+                            'annot/hg38/gencode.v29.genes.gtf.bed.gz'),
+                        help='Gene annotations BED file')
+    parser.add_argument('--enh-annotations',
+                        default=os.path.join(
+                            py_path,
+                            'annot/hg38/F5.hg38.enhancers.bed.gz'),
+                        help='Enhancer annotations BED file ')
+    p_score = parser.add_argument_group(
+                        title='Scoring parameters')
+    p_score.add_argument('--window-size', default=25, type=int,
+                         help='Window size for bigwig in bp')
+    p_score.add_argument('--prom-loc', default=80, type=int,
+                         help='Promoter location in a unit of window size '
+                              '(--window-size). This is not in bp')
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    args = parse_arguments()
+
+    build_annot_bins(args.gene_annotations, ('prom', 'gene'),
+                     args.window_size, args.prom_loc)
+    build_annot_bins(args.enh_annotations, ('enh',),
+                     args.window_size, args.prom_loc)
+
+    log.info('All done')
+
+
+if __name__ == '__main__':
+    main()
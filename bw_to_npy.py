@@ -5,10 +5,13 @@ Author:
     Jin Lee (leepc12@gmail.com)
 """
 
+import json
 import numpy
 import gzip
 import pyBigWig
 from score_metrics import find_robust_min_max
+from bed import load_bed_columns, get_chrom_bins
+from validate import validate
 from logger import log
 
 
@@ -28,14 +31,52 @@ def load_bed(bed):
     return result
 
 
+def blacklist_filter(d, blacklist):
+    result = {}
+    for c in d:
+        result_per_chr = d[c]
+
+        # remove bins overlapping blacklisted region
+        if blacklist is None:
+            bfilt_result_per_chr = result_per_chr
+        else:
+            mask = numpy.ones(len(result_per_chr), dtype=bool)
+            bin_ids = blacklist[c]
+            mask[bin_ids[bin_ids < len(result_per_chr)]] = False
+            bfilt_result_per_chr = result_per_chr[mask]
+
+        result[c] = numpy.array(bfilt_result_per_chr)
+    return result
+
+
+def get_blacklist_bin_ids(blacklist, chroms, window_size=25):
+    """
+    Args:
+        blacklist: BedColumns (or BED lines)
+    Returns:
+        { chrom: [] }: label that overlaps with blackstlisted region
+    """
+    result = {}
+    for c in chroms:
+        start, end, _ = get_chrom_bins(blacklist, c, window_size)
+        bins = [numpy.arange(s, e) for s, e in zip(start, end)]
+        result[c] = numpy.unique(numpy.concatenate(
+            bins + [numpy.array([], dtype=numpy.int64)]))
+
+    return result
+
+
 def bw_to_dict(bw_file, chrs, window_size=25,
-               blacklist_file=None, validated=False):
+               blacklist_file=None, validated=False,
+               blacklist_bin_ids=None):
     """
     Build numpy array from bigwig or npy (raw, blacklist unfiltered).
     Then blacklist filter it and calculate robust min/max for normalization
 
     Args:
         bw: submission bigwig file (.bigwig, .npy or .npz)
+        blacklist_bin_ids: { chrom: bin ids } pre-built with
+            get_blacklist_bin_ids(). blacklist_file is ignored if given
 
     Returns:
         { 'chr1': [], 'chr2': [], ... , robust_min:  , robust_max: }
@@ -92,54 +133,13 @@ def bw_to_dict(bw_file, chrs, window_size=25,
 
             y_dict[c] = numpy.array(y_dict_per_chr)
 
-        def blacklist_filter(d, blacklist):
-            result = {}
-            for c in d:
-                result_per_chr = d[c]
+        if blacklist_bin_ids is None and blacklist_file is not None:
+            blacklist_bin_ids = get_blacklist_bin_ids(
+                load_bed_columns(blacklist_file), chrs, window_size)
 
-                # remove bins overlapping blacklisted region
-                if blacklist is None:
-                    bfilt_result_per_chr = result_per_chr
-                else:
-                    bfilt_result_per_chr = []
-                    for i, val in enumerate(result_per_chr):
-                        if i in blacklist[c]:
-                            continue
-                        else:
-                            bfilt_result_per_chr.append(val)
-
-                result[c] = numpy.array(bfilt_result_per_chr)
-            return result
-
-        def get_blacklist_bin_ids(blacklist, chroms, window_size=25):
-            """
-            Returns:
-                { chrom: [] }: label that overlaps with blackstlisted region
-            """
-            # make empty sets per chr
-            bins = {}
-            for c in chroms:
-                bins[c] = set()
-
-            for line in blacklist:
-                c, start, end = line.split()
-                start_bin_id = int(start) // window_size
-                end_bin_id = int(end) // window_size + 1
-                bins[c] |= set(range(start_bin_id, end_bin_id))
-
-            # convert into list and then numpy array
-            result = {}
-            for c in chroms:
-                result[c] = numpy.array(list(bins[c]), dtype=numpy.int64)
-
-            return result
-
-        if blacklist_file is None:
+        if blacklist_bin_ids is None:
             bfilt_y_dict = y_dict
         else:
-            blacklist_lines = load_bed(blacklist_file)
-            blacklist_bin_ids = get_blacklist_bin_ids(
-                blacklist_lines, chrs, window_size)
             bfilt_y_dict = blacklist_filter(y_dict, blacklist_bin_ids)
 
         #bfilt_y_array = dict_to_arr(bfilt_y_dict, chrs)
@@ -153,6 +153,37 @@ def bw_to_dict(bw_file, chrs, window_size=25,
     return bfilt_y_dict
 
 
+def validate_and_convert(bw_file, chrs, window_size=25,
+                         blacklist_file=None, blacklist_bin_ids=None,
+                         full_report=True):
+    """Validate a submission bigwig and build the same binned,
+    blacklist-filtered track as bw_to_dict(validated=True) while
+    reading intervals for validation, so that intervals are read once.
+
+    Returns:
+        (valid, all error messages, { 'chr1': [], ... })
+        where the dict is None if not valid
+    """
+    binned = {}
+    valid, all_msg = validate(bw_file, window_size,
+                              full_report=full_report, binned=binned)
+    if not valid:
+        return valid, all_msg, None
+
+    y_dict = {c: binned[c] for c in chrs}
+
+    if blacklist_bin_ids is None and blacklist_file is not None:
+        blacklist_bin_ids = get_blacklist_bin_ids(
+            load_bed_columns(blacklist_file), chrs, window_size)
+
+    if blacklist_bin_ids is None:
+        bfilt_y_dict = y_dict
+    else:
+        bfilt_y_dict = blacklist_filter(y_dict, blacklist_bin_ids)
+
+    return valid, all_msg, bfilt_y_dict
+
+
 def dict_to_arr(d, chroms):
     """Concat vectors in d
     """
@@ -166,6 +197,81 @@ def load_npy(npy_file):
     return numpy.load(npy_file, allow_pickle=True)[()]    
 
 
+def stack_npys(npy_files, chroms, out_file, dtype=numpy.float32,
+               load_func=load_npy):
+    """Stack binned submissions for the same cell/assay into a
+    (n_submissions, n_bins) memory-mapped matrix for
+    score_metrics.score_multi(). Submissions are loaded one by one.
+
+    Args:
+        load_func: function returning { chrom: array } for a file
+            (e.g. bw_to_dict for bigwigs)
+    Returns:
+        (memmap, { chrom: (offset, length) })
+    """
+    y_dict = load_func(npy_files[0])
+    chrom_offsets = {}
+    offset = 0
+    for c in chroms:
+        chrom_offsets[c] = (offset, len(y_dict[c]))
+        offset += len(y_dict[c])
+
+    mat = numpy.lib.format.open_memmap(
+        out_file, mode='w+', dtype=dtype, shape=(len(npy_files), offset))
+    for i, f in enumerate(npy_files):
+        log.info('Stacking {}...'.format(f))
+        if i > 0:
+            y_dict = load_func(f)
+        for c in chroms:
+            o, l = chrom_offsets[c]
+            if len(y_dict[c]) != l:
+                raise ValueError(
+                    'Number of bins of {} in {} does not match with '
+                    'others.'.format(c, f))
+            mat[i, o:o + l] = y_dict[c]
+        y_dict = None
+    mat.flush()
+
+    return mat, chrom_offsets
+
+
+def write_dict_to_flat_npy(d, chroms, npy_prefix):
+    """Write { chrom: array } as one flat (non-pickled) .npy and
+    a .json index { chrom: [offset, length] } so that it can be
+    memory-mapped by load_flat_npy() without decoding.
+    """
+    log.info('Writing dict to flat npy...')
+    chrom_offsets = {}
+    offset = 0
+    for c in chroms:
+        chrom_offsets[c] = [offset, len(d[c])]
+        offset += len(d[c])
+
+    dtype = numpy.result_type(*[d[c] for c in chroms])
+    arr = numpy.lib.format.open_memmap(
+        npy_prefix + '.npy', mode='w+', dtype=dtype, shape=(offset,))
+    for c in chroms:
+        o, l = chrom_offsets[c]
+        arr[o:o + l] = d[c]
+    arr.flush()
+    del arr
+
+    with open(npy_prefix + '.json', 'w') as fp:
+        json.dump(chrom_offsets, fp)
+
+
+def load_flat_npy(npy_prefix):
+    """Memory-map a flat .npy written by write_dict_to_flat_npy()
+
+    Returns:
+        { chrom: read-only numpy view }
+    """
+    with open(npy_prefix + '.json', 'r') as fp:
+        chrom_offsets = json.load(fp)
+    arr = numpy.load(npy_prefix + '.npy', mmap_mode='r')
+    return {c: arr[o:o + l] for c, (o, l) in chrom_offsets.items()}
+
+
 def write_dict_to_npy(d, npy_prefix):
     log.info('Writing dict to npy or npz...')
     return numpy.save(npy_prefix, d)
@@ -7,7 +7,11 @@ Author:
 
 import time
 import sys
+import queue
+import random
 import sqlite3
+import threading
+import numpy
 from collections import namedtuple
 from score_metrics import Score
 from logger import log
@@ -19,6 +23,13 @@ ScoreDBRecord = namedtuple(
      'bootstrap_id') + Score._fields
 )
 
+# timeout in sec for a connection waiting for a lock
+DB_TIMEOUT = 5.0
+# retry with jittered exponential backoff if still locked
+DB_MAX_RETRY = 20
+DB_RETRY_BASE_DELAY = 0.1
+DB_RETRY_MAX_DELAY = 10.0
+
 DB_TABLE_SCORE = 'score'
 DB_QUERY_INSERT = 'INSERT INTO {table} ({cols}) VALUES ({values});'
 #DB_QUERY_GET = 'SELECT * FROM {table} ORDER BY bootstrap_id, submission_id;'
@@ -33,6 +44,36 @@ AND t.assay = tm.assay AND t.bootstrap_id = tm.bootstrap_id \
 AND t.submission_id = tm.MaxSID \
 ORDER BY t.bootstrap_id, t.submission_id;'
 
+# latest submission of each team/cell/assay/bootstrap_id
+# maintained by a trigger on every insert into score table
+DB_TABLE_LATEST_SCORE = 'latest_score'
+DB_QUERY_GET_LATEST = 'SELECT * FROM {table} \
+ORDER BY bootstrap_id, submission_id;'
+DB_QUERY_CREATE_SCORE_INDEX = 'CREATE INDEX IF NOT EXISTS {table}_latest_idx \
+ON {table} (team_id, cell, assay, bootstrap_id, submission_id);'
+DB_QUERY_CREATE_LATEST_SCORE = 'CREATE TABLE IF NOT EXISTS {table} ( \
+{cols}, PRIMARY KEY (team_id, cell, assay, bootstrap_id));'
+DB_QUERY_CREATE_LATEST_SCORE_TRIGGER = 'CREATE TRIGGER IF NOT EXISTS \
+{table}_insert AFTER INSERT ON {src_table} \
+WHEN NOT EXISTS ( \
+	SELECT 1 FROM {table} WHERE team_id = NEW.team_id AND cell = NEW.cell \
+	AND assay = NEW.assay AND bootstrap_id = NEW.bootstrap_id \
+	AND submission_id > NEW.submission_id \
+) BEGIN \
+	INSERT OR REPLACE INTO {table} ({cols}) VALUES ({new_values}); \
+END;'
+
+# content-addressed cache of scores
+# to skip scoring identical resubmissions
+DB_TABLE_SCORE_CACHE = 'score_cache'
+DB_QUERY_CREATE_SCORE_CACHE = 'CREATE TABLE IF NOT EXISTS {table} ( \
+cache_key text NOT NULL, bootstrap_id integer NOT NULL, {cols}, \
+PRIMARY KEY (cache_key, bootstrap_id));'
+DB_QUERY_GET_SCORE_CACHE = 'SELECT bootstrap_id, {cols} FROM {table} \
+WHERE cache_key = ? ORDER BY rowid;'
+DB_QUERY_INSERT_SCORE_CACHE = 'INSERT OR REPLACE INTO {table} \
+(cache_key, bootstrap_id, {cols}) VALUES (?, ?, {values});'
+
 SCORE_DB_RECORD_VAR_TYPE = ScoreDBRecord(
     submission_id='integer NOT NULL',
     team_id='integer NOT NULL',
@@ -51,37 +92,146 @@ SCORE_DB_RECORD_VAR_TYPE = ScoreDBRecord(
     mse1imp='double NOT NULL'
 )
 
+# for read_scores_from_db_as_array()
+SCORE_DB_RECORD_DTYPE = numpy.dtype([
+    ('submission_id', numpy.int64),
+    ('team_id', numpy.int64),
+    ('submission_fname', object),
+    ('cell', 'U16'),
+    ('assay', 'U16'),
+    ('bootstrap_id', numpy.int64)] +
+    [(attr, numpy.float64) for attr in Score._fields])
 
-def write_to_db(score_db_record, db_file):
-    cols = []
-    values = []
-    for attr in score_db_record._fields:
-        cols.append(str(attr))
-        val = getattr(score_db_record, attr)
-        if isinstance(val, str):
-            val = '"' + val + '"'
-        else:
-            val = str(val)
-        values.append(val)
 
-    query = DB_QUERY_INSERT.format(
-        table=DB_TABLE_SCORE, cols=','.join(cols), values=','.join(values))
-    log.info('SQL query: {}'.format(query))
-    while True:
+def connect_db(db_file):
+    return sqlite3.connect(db_file, timeout=DB_TIMEOUT)
+
+
+def retry_on_db_lock(func, max_retry=DB_MAX_RETRY):
+    """Call func() and retry with jittered exponential backoff
+    while DB is locked by other processes.
+    """
+    for i in range(max_retry):
         try:
-            conn = sqlite3.connect(db_file)
-            c = conn.cursor()
-            c.execute(query)
-            c.close()
-            conn.commit()
-            conn.close()
+            return func()
         except sqlite3.OperationalError as e:
-            print(e)
+            if 'locked' not in str(e) and 'busy' not in str(e) or \
+                    i == max_retry - 1:
+                raise
+            delay = random.uniform(
+                0, min(DB_RETRY_MAX_DELAY, DB_RETRY_BASE_DELAY * 2 ** i))
+            log.warning('DB error: {}. Retrying in {:.2f} sec...'.format(
+                e, delay))
+            time.sleep(delay)
+
+
+def write_to_db(score_db_record, db_file):
+    write_records_to_db([score_db_record], db_file)
+
+
+def execute_in_transaction(db_file, queries):
+    """Execute [(query, params), ...] in a single transaction.
+    Either all or none of them are applied.
+    """
+    def run():
+        conn = connect_db(db_file)
+        try:
+            with conn:
+                for query, params in queries:
+                    conn.execute(query, params)
+        finally:
             conn.close()
-            time.sleep(1)
-            continue
-        else:
-            break    
+
+    retry_on_db_lock(run)
+
+
+def get_insert_queries(score_db_records):
+    """Parameterized INSERT queries for execute_in_transaction()
+    """
+    query = DB_QUERY_INSERT.format(
+        table=DB_TABLE_SCORE, cols=','.join(ScoreDBRecord._fields),
+        values=','.join(['?'] * len(ScoreDBRecord._fields)))
+    return [(query, tuple(r)) for r in score_db_records]
+
+
+def write_records_to_db(score_db_records, db_file, db_writer=None):
+    """Write all records (e.g. all bootstraps of a submission) atomically
+    """
+    log.info('Writing {} records to DB...'.format(len(score_db_records)))
+    queries = get_insert_queries(score_db_records)
+    if db_writer is None:
+        execute_in_transaction(db_file, queries)
+    else:
+        db_writer.execute(queries)
+
+
+class ScoreDBWriter(object):
+    """Single DB writer. One thread owns one connection (WAL mode) and
+    executes queries handed to it in batches (executemany for
+    consecutive identical queries) so that writers do not contend for
+    SQLite's file lock.
+
+    Each execute() is atomic: a batch is one transaction, and if it
+    fails each execute() in it is retried in its own transaction.
+    """
+    def __init__(self, db_file, max_batch=1000):
+        self.db_file = db_file
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def execute(self, queries):
+        """Execute [(query, params), ...] atomically and wait for it
+        """
+        item = {'queries': queries, 'done': threading.Event(), 'error': None}
+        self.queue.put(item)
+        item['done'].wait()
+        if item['error'] is not None:
+            raise item['error']
+
+    def _execute_batch(self, conn, items):
+        def run():
+            with conn:
+                group_query, group_params = None, []
+                for item in items:
+                    for query, params in item['queries']:
+                        if query != group_query and group_params:
+                            conn.executemany(group_query, group_params)
+                            group_params = []
+                        group_query = query
+                        group_params.append(params)
+                if group_params:
+                    conn.executemany(group_query, group_params)
+
+        retry_on_db_lock(run)
+
+    def _write_loop(self):
+        conn = connect_db(self.db_file)
+        conn.execute('PRAGMA journal_mode=WAL;')
+
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.max_batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._execute_batch(conn, items)
+            except sqlite3.Error:
+                # find failing ones
+                for item in items:
+                    try:
+                        self._execute_batch(conn, [item])
+                    except sqlite3.Error as e:
+                        log.error('Failed to write to DB: {} {}'.format(
+                            e, item['queries']))
+                        item['error'] = e
+
+            for item in items:
+                item['done'].set()
 
 
 def read_scores_from_db(db_file, chroms):
@@ -98,26 +248,26 @@ def read_scores_from_db(db_file, chroms):
     """
     def score_record_factory(cursor, row):
         return ScoreDBRecord(*row)
-    
-    query = DB_QUERY_GET.format(table=DB_TABLE_SCORE)  #, chroms=valid_chrs_str)
-    log.info(query)
 
-    while True:
+    def run():
+        conn = connect_db(db_file)
         try:
-            conn = sqlite3.connect(db_file)
+            if has_table(conn, DB_TABLE_LATEST_SCORE):
+                query = DB_QUERY_GET_LATEST.format(table=DB_TABLE_LATEST_SCORE)
+            else:
+                # DB not migrated yet (see migrate_db())
+                query = DB_QUERY_GET.format(table=DB_TABLE_SCORE)
+            log.info(query)
             conn.row_factory = score_record_factory
             c = conn.cursor()
             c.execute(query)
             result = c.fetchall()
             c.close()
+        finally:
             conn.close()
-        except sqlite3.OperationalError as e:
-            print(e)
-            conn.close()
-            time.sleep(1)
-            continue
-        else:
-            break
+        return result
+
+    result = retry_on_db_lock(run)
     
     #if len(result) == 0:
     #    print('No records found. '
@@ -126,16 +276,157 @@ def read_scores_from_db(db_file, chroms):
     return result
 
 
+def read_scores_from_db_as_array(db_file, chroms, chunk_size=10000):
+    """Columnar version of read_scores_from_db().
+    Rows are fetched in chunks directly into a structured array
+    without making a ScoreDBRecord for each row.
+
+    Returns:
+        numpy.recarray with fields of ScoreDBRecord
+        ordered by bootstrap_id and submission_id
+    """
+    def run():
+        conn = connect_db(db_file)
+        try:
+            if has_table(conn, DB_TABLE_LATEST_SCORE):
+                query = DB_QUERY_GET_LATEST.format(table=DB_TABLE_LATEST_SCORE)
+            else:
+                # DB not migrated yet (see migrate_db())
+                query = DB_QUERY_GET.format(table=DB_TABLE_SCORE)
+            log.info(query)
+            c = conn.cursor()
+            c.execute(query)
+            chunks = []
+            while True:
+                rows = c.fetchmany(chunk_size)
+                if not rows:
+                    break
+                chunk = numpy.empty(len(rows), dtype=SCORE_DB_RECORD_DTYPE)
+                for name, col in zip(chunk.dtype.names, zip(*rows)):
+                    chunk[name] = col
+                chunks.append(chunk)
+            c.close()
+        finally:
+            conn.close()
+        return chunks
+
+    chunks = retry_on_db_lock(run)
+
+    if chunks:
+        arr = numpy.concatenate(chunks)
+    else:
+        arr = numpy.zeros(0, dtype=SCORE_DB_RECORD_DTYPE)
+    return arr.view(numpy.recarray)
+
+
+def create_score_cache_table(conn):
+    conn.execute(DB_QUERY_CREATE_SCORE_CACHE.format(
+        table=DB_TABLE_SCORE_CACHE,
+        cols=','.join([attr + ' ' + getattr(SCORE_DB_RECORD_VAR_TYPE, attr)
+                       for attr in Score._fields])))
+
+
+def read_score_cache(db_file, cache_key):
+    """Read cached scores of a previously scored identical submission
+    Returns:
+        [(bootstrap_id, Score), ...] or None if not found
+    """
+    query = DB_QUERY_GET_SCORE_CACHE.format(
+        table=DB_TABLE_SCORE_CACHE, cols=','.join(Score._fields))
+
+    def run():
+        conn = connect_db(db_file)
+        try:
+            create_score_cache_table(conn)
+            c = conn.cursor()
+            c.execute(query, (cache_key,))
+            result = c.fetchall()
+            c.close()
+        finally:
+            conn.close()
+        return result
+
+    result = retry_on_db_lock(run)
+
+    if len(result) == 0:
+        return None
+    return [(row[0], Score(*row[1:])) for row in result]
+
+
+def write_score_cache(db_file, cache_key, score_outputs, db_writer=None):
+    """Write scores [(bootstrap_id, Score), ...] to cache
+    """
+    query = DB_QUERY_INSERT_SCORE_CACHE.format(
+        table=DB_TABLE_SCORE_CACHE, cols=','.join(Score._fields),
+        values=','.join(['?'] * len(Score._fields)))
+    log.info('Writing to score cache: {}'.format(cache_key))
+
+    queries = [(query, (cache_key, k) + tuple(float(v) for v in s))
+               for k, s in score_outputs]
+    if db_writer is None:
+        execute_in_transaction(db_file, queries)
+    else:
+        db_writer.execute(queries)
+
+
+def has_table(conn, table):
+    c = conn.execute(
+        'SELECT 1 FROM sqlite_master WHERE type=\'table\' AND name=?;',
+        (table,))
+    return c.fetchone() is not None
+
+
+def migrate_db(conn):
+    """Add index on score table and latest_score table (with a trigger
+    to keep it up to date) to an existing DB. Safe to run many times.
+    """
+    cols = ScoreDBRecord._fields
+    conn.execute(DB_QUERY_CREATE_SCORE_INDEX.format(table=DB_TABLE_SCORE))
+
+    if has_table(conn, DB_TABLE_LATEST_SCORE):
+        return
+    log.info('Creating {} table...'.format(DB_TABLE_LATEST_SCORE))
+    conn.execute(DB_QUERY_CREATE_LATEST_SCORE.format(
+        table=DB_TABLE_LATEST_SCORE,
+        cols=','.join([attr + ' ' + getattr(SCORE_DB_RECORD_VAR_TYPE, attr)
+                       for attr in cols])))
+    conn.execute(DB_QUERY_CREATE_LATEST_SCORE_TRIGGER.format(
+        table=DB_TABLE_LATEST_SCORE, src_table=DB_TABLE_SCORE,
+        cols=','.join(cols),
+        new_values=','.join(['NEW.' + attr for attr in cols])))
+    # fill with existing rows
+    conn.execute('INSERT OR REPLACE INTO {table} ({cols}) {query}'.format(
+        table=DB_TABLE_LATEST_SCORE, cols=','.join(cols),
+        query=DB_QUERY_GET.format(table=DB_TABLE_SCORE).rstrip(';')))
+
+
+def migrate_db_file(db_file):
+    def run():
+        conn = connect_db(db_file)
+        try:
+            with conn:
+                migrate_db(conn)
+        finally:
+            conn.close()
+
+    retry_on_db_lock(run)
+
+
 def create_db(db_file):
     log.info('Creating database...')
 
     try:
         conn = sqlite3.connect(db_file)
+        # allow reading while writing
+        conn.execute('PRAGMA journal_mode=WAL;')
         c = conn.cursor()
         c.execute('CREATE TABLE IF NOT EXISTS {} ({});'.format(
             DB_TABLE_SCORE,
             ','.join([attr + ' ' + getattr(SCORE_DB_RECORD_VAR_TYPE, attr)
                         for attr in SCORE_DB_RECORD_VAR_TYPE._fields])))
+        create_score_cache_table(conn)
+        migrate_db(conn)
+        conn.commit()
     except Exception as e:
         print(e)
         sys.exit(1)
@@ -152,9 +443,15 @@ def parse_arguments():
     parser = argparse.ArgumentParser(
         description='ENCODE Imputation Challenge SQLite3 Database creator.')
     parser.add_argument('db_file', help='DB file.')
+    parser.add_argument('--migrate', action='store_true',
+                        help='Add indices and latest_score table to '
+                             'an existing DB file.')
     args = parser.parse_args()
 
-    if os.path.exists(args.db_file):
+    if args.migrate:
+        if not os.path.exists(args.db_file):
+            raise ValueError('DB file does not exists.')
+    elif os.path.exists(args.db_file):
         raise ValueError('DB file already exists.')
 
     return args
@@ -162,7 +459,11 @@ def parse_arguments():
 
 def main():
     args = parse_arguments()
-    create_db(args.db_file)
+    if args.migrate:
+        migrate_db_file(args.db_file)
+        log.info('All done.')
+    else:
+        create_db(args.db_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Imputation challenge submission intake scheduler
+
+Polls an evaluation queue with an adaptive interval (short while
+submissions are arriving or being scored, backing off while idle)
+and dispatches each new submission as soon as it is seen, without
+waiting for other submissions to finish.
+
+Author:
+    Jin Lee (leepc12@gmail.com)
+"""
+
+from collections import namedtuple, OrderedDict
+from logger import log
+
+
+class IntakeScheduler(object):
+    """Dispatch RECEIVED submissions and adapt polling interval.
+
+    Submissions stay RECEIVED on Synapse until their status is stored,
+    so ones already dispatched are tracked here and not dispatched again.
+
+    Args:
+        submit: function taking a submission ID and returning an object
+            with ready() and get() (e.g. ScoringPipeline.submit)
+    """
+    def __init__(self, submit, min_period=30, max_period=1800,
+                 backoff=2.0, skip_finished=False):
+        self.submit = submit
+        self.min_period = min_period
+        self.max_period = max_period
+        self.backoff = backoff
+        self.period = min_period
+        self.in_flight = OrderedDict()  # submission_id: AsyncResult-like
+        # for dry runs, where statuses are never updated on Synapse
+        self.skip_finished = skip_finished
+        self.finished = set()
+
+    def dispatch(self, bundles):
+        """Dispatch new submissions from (submission, status) bundles.
+
+        Returns:
+            Number of newly dispatched submissions
+        """
+        n = 0
+        for submission, _ in bundles:
+            if submission.id in self.in_flight or \
+                    submission.id in self.finished:
+                continue
+            log.info('Dispatching submission {}...'.format(submission.id))
+            self.in_flight[submission.id] = self.submit(submission.id)
+            n += 1
+        return n
+
+    def collect(self):
+        """Remove finished submissions.
+
+        Returns:
+            (number of finished submissions, list of exceptions raised)
+        """
+        done = [k for k, r in self.in_flight.items() if r.ready()]
+        errors = []
+        for k in done:
+            r = self.in_flight.pop(k)
+            if self.skip_finished:
+                self.finished.add(k)
+            try:
+                r.get()
+            except Exception as e:
+                errors.append(e)
+        return len(done), errors
+
+    def next_interval(self, busy):
+        """Poll again soon if busy, otherwise back off up to max_period.
+        """
+        if busy or self.in_flight:
+            self.period = self.min_period
+        else:
+            self.period = min(self.period * self.backoff, self.max_period)
+        return self.period
+
+
+
+LocalSubmission = namedtuple(
+    'LocalSubmission',
+    ('id', 'name', 'teamId', 'userId', 'filePath')
+)
+
+
+class LocalEvaluationQueue(object):
+    """Local stand-in for a Synapse client's evaluation queue API.
+    For testing the intake loop without Synapse.
+    """
+    def __init__(self):
+        self.submissions = OrderedDict()  # id: LocalSubmission
+        self.statuses = {}  # id: status dict
+
+    def submit(self, file_path, team_id, user_id=0, name=None):
+        submission_id = str(len(self.submissions) + 1)
+        self.submissions[submission_id] = LocalSubmission(
+            submission_id, name or file_path, team_id, user_id, file_path)
+        self.statuses[submission_id] = {
+            'id': submission_id, 'status': 'RECEIVED'}
+        return submission_id
+
+    def getEvaluation(self, eval_queue_id):
+        return eval_queue_id
+
+    def getSubmissionBundles(self, evaluation, status=None):
+        for submission_id, submission in list(self.submissions.items()):
+            s = self.statuses[submission_id]
+            if status is None or s['status'] == status:
+                yield submission, dict(s)
+
+    def getSubmission(self, submission_id, **kwargs):
+        return self.submissions[getattr(submission_id, 'id', submission_id)]
+
+    def getSubmissionStatus(self, submission_id):
+        return dict(self.statuses[submission_id])
+
+    def store(self, status):
+        self.statuses[status['id']] = dict(status)
+        return status
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Imputation challenge scoring job journal
+
+Records the stage of each submission being scored and its
+per-bootstrap scores in the score DB, so that a job interrupted by a
+crash (e.g. a worker OOM-killed) resumes from its last completed stage.
+Score rows are written to DB together with the WRITTEN stage in a
+single transaction, so a submission never has partial bootstrap rows
+and is never written twice.
+Pool workers only mark SCORING (directly to DB). Scores and other
+stages are written by the main process through its ScoreDBWriter.
+
+Stages:
+    FETCHED: downloaded
+    SCORING: being scored by a worker (pid)
+    SCORED: all bootstraps scored
+    WRITTEN: score rows written to DB
+    REPORTED: status stored on Synapse
+
+Author:
+    Jin Lee (leepc12@gmail.com)
+"""
+
+import os
+import time
+from collections import namedtuple
+from score_metrics import Score
+from db import execute_in_transaction, get_insert_queries
+from db import connect_db, retry_on_db_lock
+from logger import log
+
+
+JOB_STAGES = ('FETCHED', 'SCORING', 'SCORED', 'WRITTEN', 'REPORTED')
+
+JournalRecord = namedtuple(
+    'JournalRecord',
+    ('submission_id', 'stage', 'pid', 'updated')
+)
+
+DB_TABLE_JOURNAL = 'job_journal'
+DB_TABLE_JOURNAL_SCORE = 'job_journal_score'
+DB_QUERY_CREATE_JOURNAL = 'CREATE TABLE IF NOT EXISTS {table} ( \
+submission_id integer PRIMARY KEY, stage text NOT NULL, \
+pid integer, updated double NOT NULL);'
+DB_QUERY_CREATE_JOURNAL_SCORE = 'CREATE TABLE IF NOT EXISTS {table} ( \
+submission_id integer NOT NULL, bootstrap_id integer NOT NULL, {cols}, \
+PRIMARY KEY (submission_id, bootstrap_id));'
+DB_QUERY_SET_STAGE = 'INSERT OR REPLACE INTO {table} \
+(submission_id, stage, pid, updated) VALUES (?, ?, ?, ?);'
+DB_QUERY_ADD_SCORE = 'INSERT OR REPLACE INTO {table} \
+(submission_id, bootstrap_id, {cols}) VALUES (?, ?, {values});'
+
+
+def is_pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobJournal(object):
+    def __init__(self, db_file, db_writer=None):
+        """
+        Args:
+            db_writer: ScoreDBWriter to write through.
+                Written directly to db_file if None (e.g. pool workers)
+        """
+        self.db_file = db_file
+        self.db_writer = db_writer
+        execute_in_transaction(db_file, [
+            (DB_QUERY_CREATE_JOURNAL.format(table=DB_TABLE_JOURNAL), ()),
+            (DB_QUERY_CREATE_JOURNAL_SCORE.format(
+                table=DB_TABLE_JOURNAL_SCORE,
+                cols=','.join([f + ' double NOT NULL'
+                               for f in Score._fields])), ())])
+
+    def _query(self, query, params):
+        def run():
+            conn = connect_db(self.db_file)
+            try:
+                c = conn.cursor()
+                c.execute(query, params)
+                result = c.fetchall()
+                c.close()
+            finally:
+                conn.close()
+            return result
+
+        return retry_on_db_lock(run)
+
+    def _write(self, queries):
+        if self.db_writer is None:
+            execute_in_transaction(self.db_file, queries)
+        else:
+            self.db_writer.execute(queries)
+
+    def _set_stage_query(self, submission_id, stage, pid=None):
+        assert(stage in JOB_STAGES)
+        return (DB_QUERY_SET_STAGE.format(table=DB_TABLE_JOURNAL),
+                (int(submission_id), stage, pid, time.time()))
+
+    def get(self, submission_id):
+        """Returns:
+            JournalRecord or None if not journaled
+        """
+        result = self._query(
+            'SELECT submission_id, stage, pid, updated FROM {} '
+            'WHERE submission_id = ?;'.format(DB_TABLE_JOURNAL),
+            (int(submission_id),))
+        if len(result) == 0:
+            return None
+        return JournalRecord(*result[0])
+
+    def set_stage(self, submission_id, stage, pid=None):
+        log.info('Journal: submission {} {}'.format(submission_id, stage))
+        self._write([self._set_stage_query(submission_id, stage, pid)])
+
+    def reset(self, submission_id):
+        """Start over (e.g. admin re-scores a submission)
+        """
+        self._write([
+            ('DELETE FROM {} WHERE submission_id = ?;'.format(
+                DB_TABLE_JOURNAL_SCORE), (int(submission_id),)),
+            self._set_stage_query(submission_id, 'FETCHED')])
+
+    def set_scored(self, submission_id, score_outputs):
+        """Write scores of all bootstraps and mark SCORED
+        in one transaction
+
+        Args:
+            score_outputs: [(bootstrap_id, Score), ...]
+        """
+        query = DB_QUERY_ADD_SCORE.format(
+            table=DB_TABLE_JOURNAL_SCORE, cols=','.join(Score._fields),
+            values=','.join(['?'] * len(Score._fields)))
+        self._write(
+            [(query, (int(submission_id), k) +
+                tuple(float(v) for v in score))
+             for k, score in score_outputs] +
+            [self._set_stage_query(submission_id, 'SCORED')])
+
+    def get_bootstrap_scores(self, submission_id):
+        """Returns:
+            { bootstrap_id: Score } of completed bootstraps
+        """
+        result = self._query(
+            'SELECT bootstrap_id, {} FROM {} WHERE submission_id = ?;'.format(
+                ','.join(Score._fields), DB_TABLE_JOURNAL_SCORE),
+            (int(submission_id),))
+        return {row[0]: Score(*row[1:]) for row in result}
+
+    def write_scores(self, submission_id, score_db_records):
+        """Write all score rows and mark WRITTEN in one transaction
+        """
+        log.info('Writing {} records to DB...'.format(len(score_db_records)))
+        self._write(
+            get_insert_queries(score_db_records) +
+            [self._set_stage_query(submission_id, 'WRITTEN')])
+
+    def is_lost(self, submission_id):
+        """True if the worker scoring a submission has died
+        """
+        record = self.get(submission_id)
+        return record is not None and record.stage == 'SCORING' and \
+            record.pid is not None and not is_pid_alive(record.pid)
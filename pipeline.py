@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""Imputation challenge staged scoring pipeline
+
+    fetch (threads) -> score (process pool) -> write (single thread)
+
+I/O-bound downloads run on threads and overlap with CPU-bound
+conversion/scoring on a process pool. A single writer thread writes
+scores to DB and reports to Synapse. The number of jobs between fetch
+and write is bounded so that downloads stall (backpressure) while
+scorers are busy, instead of filling up the scratch disk.
+
+A job is a dict. fetch_func(submission_id) returns it with
+job['error'] set to None or a message. score_func(job) runs on the
+process pool only if there is no error and job['cached'] is not set
+(scores already found), and returns a dict merged into the job.
+write_func(job) always runs last.
+
+If memory_budget and estimate_func(job) are given, a job is sent to
+the process pool only while the estimated peak memory of all jobs
+being scored stays under the budget.
+
+multiprocessing.Pool never returns a task whose worker died
+(e.g. OOM-killed). If lost_func(job) is given, jobs being scored are
+checked periodically and a lost one is handed to write_func with
+job['retry'] set.
+
+Author:
+    Jin Lee (leepc12@gmail.com)
+"""
+
+import time
+import queue
+import threading
+import traceback
+from io import StringIO
+from multiprocessing.pool import ThreadPool
+from logger import log
+
+
+class PipelineJob(object):
+    """Handle of a submission going through the pipeline.
+    Has ready()/get() like multiprocessing's AsyncResult.
+    """
+    def __init__(self, submission_id):
+        self.submission_id = submission_id
+        self.data = None
+        self._error = None
+        self._done = threading.Event()
+        self._handed_over = False
+        self._lock = threading.Lock()
+        self._memory = 0  # admitted to MemoryBudget
+
+    def ready(self):
+        return self._done.is_set()
+
+    def get(self, timeout=None):
+        self._done.wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return self.data
+
+    def _finish(self, error=None):
+        self._error = error
+        self._done.set()
+
+
+class MemoryBudget(object):
+    """Admit jobs while the sum of their estimated memory fits in limit.
+    A job is always admitted if nothing else is running so that a job
+    larger than the limit cannot block forever.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n):
+        with self.cond:
+            while self.used > 0 and self.used + n > self.limit:
+                self.cond.wait()
+            self.used += n
+
+    def release(self, n):
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+
+class ScoringPipeline(object):
+    def __init__(self, fetch_func, score_func, write_func, pool,
+                 nth_fetch=2, max_pending=4, lost_func=None,
+                 watchdog_period=60, memory_budget=None, estimate_func=None):
+        """
+        Args:
+            pool: multiprocessing.Pool for score_func
+            nth_fetch: number of threads for fetch_func
+            max_pending: max number of jobs between fetch and write
+            lost_func: function returning True if a job being scored
+                has lost its worker
+            memory_budget: MemoryBudget shared by jobs being scored
+            estimate_func: function returning estimated peak memory
+                of scoring a job in bytes
+        """
+        self.fetch_func = fetch_func
+        self.score_func = score_func
+        self.write_func = write_func
+        self.pool = pool
+        self.fetch_pool = ThreadPool(nth_fetch)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.memory_budget = memory_budget
+        self.estimate_func = estimate_func
+        # never blocks since number of jobs is bounded by self.pending
+        self.write_queue = queue.Queue(max_pending)
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+        self.lost_func = lost_func
+        self.watchdog_period = watchdog_period
+        self.scoring = {}  # submission_id: job
+        self.scoring_lock = threading.Lock()
+        if lost_func is not None:
+            self.watchdog = threading.Thread(
+                target=self._watchdog_loop, daemon=True)
+            self.watchdog.start()
+
+    def submit(self, submission_id):
+        job = PipelineJob(submission_id)
+        self.fetch_pool.apply_async(self._fetch, (job,))
+        return job
+
+    def _fetch(self, job):
+        # wait here while too many jobs are downloaded but not written
+        self.pending.acquire()
+        try:
+            job.data = self.fetch_func(job.submission_id)
+        except Exception as e:
+            log.error(format_exc())
+            self.pending.release()
+            job._finish(e)
+            return
+
+        if job.data['error'] is not None or job.data.get('cached'):
+            self._hand_over(job)
+            return
+
+        def on_scored(result):
+            self._hand_over(job, result)
+
+        def on_error(e):
+            self._hand_over(
+                job, {'error': 'Scoring failed: {}'.format(repr(e))})
+
+        if self.memory_budget is not None:
+            # wait here until enough memory is freed by other jobs
+            job._memory = self.estimate_func(job.data)
+            log.info('Estimated memory for submission {}: {:.1f} GB'.format(
+                job.submission_id, job._memory / 1024.0**3))
+            self.memory_budget.acquire(job._memory)
+
+        with self.scoring_lock:
+            self.scoring[job.submission_id] = job
+        self.pool.apply_async(self.score_func, (job.data,),
+                              callback=on_scored, error_callback=on_error)
+
+    def _hand_over(self, job, result=None):
+        """Send a job to the writer only once
+        (a job found lost can still return later)
+        """
+        with job._lock:
+            if job._handed_over:
+                return
+            job._handed_over = True
+        with self.scoring_lock:
+            self.scoring.pop(job.submission_id, None)
+        if job._memory:
+            self.memory_budget.release(job._memory)
+            job._memory = 0
+        if result is not None:
+            job.data.update(result)
+        self.write_queue.put(job)
+
+    def _watchdog_loop(self):
+        while True:
+            time.sleep(self.watchdog_period)
+            with self.scoring_lock:
+                jobs = list(self.scoring.values())
+            for job in jobs:
+                try:
+                    lost = self.lost_func(job.data)
+                except Exception:
+                    log.error(format_exc())
+                    continue
+                if lost:
+                    log.error('Lost worker for submission {}'.format(
+                        job.submission_id))
+                    self._hand_over(job, {
+                        'error': 'Worker died while scoring.',
+                        'retry': True})
+
+    def _write_loop(self):
+        while True:
+            job = self.write_queue.get()
+            error = None
+            try:
+                self.write_func(job.data)
+            except Exception as e:
+                log.error(format_exc())
+                error = e
+            finally:
+                self.pending.release()
+                job._finish(error)
+
+
+def format_exc():
+    st = StringIO()
+    traceback.print_exc(file=st)
+    return st.getvalue()
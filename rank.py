@@ -9,8 +9,11 @@ import numpy
 import json
 from collections import namedtuple, defaultdict, OrderedDict
 from scipy.stats import rankdata
-from score_metrics import RANK_METHOD_FOR_EACH_METRIC
-from db import DB_QUERY_GET, read_scores_from_db
+from score_metrics import RANK_METHOD_FOR_EACH_METRIC, Score
+from db import DB_QUERY_GET, read_scores_from_db_as_array
+from team_names import TeamNameResolver
+from bootstrap_rank import get_global_score_array, calc_bootstrap_stats
+from bootstrap_rank import resample_global_scores, calc_resampled_stats
 from logger import log
 
 
@@ -18,6 +21,11 @@ GlobalScore = namedtuple(
     'GlobalScore',
     ['team_id', 'name', 'score_lb', 'score_mean', 'score_ub', 'rank'])
 
+# ranks of a single cell/assay
+CellAssayRanks = namedtuple(
+    'CellAssayRanks',
+    ['bootstrap_scores', 'team_ids', 'markdown'])
+
 
 CELL_NAME = {
     'C02': 'adrenal_gland',
@@ -149,6 +157,12 @@ def parse_team_name_tsv(tsv):
     return team_name_dict
 
 
+def get_team_name_resolver(syn, team_name_dict, team_names=None):
+    if team_names is not None:
+        return team_names
+    return TeamNameResolver(syn, team_name_dict)
+
+
 def calc_combined_ranks(rows, measures_to_use):
     """Calculate ranks for combined measures
     """
@@ -175,75 +189,246 @@ def calc_combined_ranks(rows, measures_to_use):
     return dict(zip(zip(team_ids, submission_ids), ranks))
 
 
-def calc_global_ranks(rows, measures_to_use, team_name_dict=None, syn=None):
-    """Calculate global ranks
+def calc_combined_ranks_array(scores, valid, measures_to_use):
+    """Vectorized calc_combined_ranks() for many groups at once
 
-    Outputs:
-        Markdown table for ranks
+    Args:
+        scores: array of shape (..., team, metric). Metrics are in
+            the same order as measures_to_use
+        valid: bool array of shape (..., team). False for empty slots
+            (e.g. groups with fewer teams than others)
+    Returns:
+        Ranks of shape (..., team). nan for empty slots
     """
+    n = valid.sum(axis=-1, keepdims=True)
+
+    combined = numpy.zeros(valid.shape, dtype=float)
+    for i, attr in enumerate(measures_to_use):
+        rank_method = RANK_METHOD_FOR_EACH_METRIC[attr]
+        if rank_method == 'ASCENDING':
+            attr_scores = -scores[..., i]
+        elif rank_method == 'DESCENDING':
+            attr_scores = scores[..., i]
+        else:
+            raise Exception('Unknown rank_method.')
+        # empty slots are ranked last so that they do not
+        # change ranks of valid ones
+        attr_scores = numpy.where(valid, attr_scores, numpy.inf)
+        ranks = rankdata(attr_scores, "average", axis=-1)
+
+        combined += numpy.log(ranks/(n + 1.0))
+    combined = numpy.where(valid, combined, numpy.inf)
+    ranks = rankdata(combined, "average", axis=-1)
+
+    return numpy.where(valid, ranks, numpy.nan)
 
-    markdown_per_cell_assay = defaultdict(OrderedDict)
+
+def get_columns(rows, attrs):
+    """2D array (row, attr) from a list of ScoreDBRecord or
+    a structured array (e.g. from read_scores_from_db_as_array())
+    """
+    if isinstance(rows, numpy.ndarray):
+        return numpy.column_stack(
+            [rows[attr] for attr in attrs]).astype(float)
+    return numpy.array(
+        [[getattr(x, attr) for attr in attrs] for x in rows], dtype=float)
+
+
+def calc_all_combined_ranks(sample_grpd_results, measures_to_use):
+    """calc_combined_ranks() for all cell/assays and bootstraps at once.
+    Scores are loaded into a (cell/assay, bootstrap, team, metric) array.
+
+    Args:
+        sample_grpd_results: { (cell, assay): { bootstrap_id: rows } }
+            rows can be a list of ScoreDBRecord or a structured array
+    Returns:
+        { (cell, assay): { bootstrap_id: { (team_id, submission_id): rank } } }
+    """
+    keys = list(sample_grpd_results.keys())
+    bootstrap_ids = sorted(set(
+        bootstrap_id for bootstrapped_submissions in sample_grpd_results.values()
+        for bootstrap_id in bootstrapped_submissions))
+    bootstrap_idx = {k: i for i, k in enumerate(bootstrap_ids)}
+    num_teams = max([
+        len(submissions) for bootstrapped_submissions in sample_grpd_results.values()
+        for submissions in bootstrapped_submissions.values()] or [0])
+    if num_teams == 0:
+        return {}
+
+    scores = numpy.zeros(
+        (len(keys), len(bootstrap_ids), num_teams, len(measures_to_use)),
+        dtype=float)
+    valid = numpy.zeros(scores.shape[:3], dtype=bool)
+    for g, key in enumerate(keys):
+        for bootstrap_id, submissions in sample_grpd_results[key].items():
+            b = bootstrap_idx[bootstrap_id]
+            scores[g, b, :len(submissions)] = get_columns(
+                submissions, measures_to_use)
+            valid[g, b, :len(submissions)] = True
+
+    ranks = calc_combined_ranks_array(scores, valid, measures_to_use)
+
+    result = {}
+    for g, key in enumerate(keys):
+        result[key] = {}
+        for bootstrap_id, submissions in sample_grpd_results[key].items():
+            ids = get_columns(submissions, ('team_id', 'submission_id'))
+            r = ranks[g, bootstrap_idx[bootstrap_id]]
+            result[key][bootstrap_id] = dict(zip(
+                [(int(t), int(s)) for t, s in ids], r))
+    return result
+
+
+def group_rows_by_cell_assay(rows):
+    """Group rows by (cell, assay) and then by bootstrap_id
+
+    Args:
+        rows: list of ScoreDBRecord or a structured array
+            (e.g. from read_scores_from_db_as_array())
+    Returns:
+        ({ (cell, assay): { bootstrap_id: rows } }, set of all team IDs)
+        Grouped rows are sub-arrays if rows is a structured array
+    """
+    if isinstance(rows, numpy.ndarray):
+        return group_score_array_by_cell_assay(rows)
 
     sample_grpd_results = defaultdict(lambda: defaultdict(list))
     all_users = set()
     for x in rows:
-        sample_key = (x.cell, x.assay)
         sample_grpd_results[(x.cell, x.assay)][x.bootstrap_id].append(x)
         all_users.add(x.team_id)
+    return sample_grpd_results, all_users
+
+
+def get_first_seen(values):
+    """Unique values in the order they first appear and inverse indices
+    """
+    uniq, first, inv = numpy.unique(
+        values, return_index=True, return_inverse=True)
+    order = numpy.argsort(first)
+    return uniq[order], numpy.argsort(order)[inv]
+
+
+def group_score_array_by_cell_assay(arr):
+    """Same as group_rows_by_cell_assay() for a structured array.
+    Groups are in the same order as rows (as for a list of rows).
+    """
+    sample_grpd_results = OrderedDict()
+    cell_assays, group_idx = get_first_seen(
+        numpy.char.add(numpy.char.add(arr['cell'], ':'), arr['assay']))
+    for g, cell_assay in enumerate(cell_assays):
+        sub_arr = arr[group_idx == g]
+        bootstrap_ids, bootstrap_idx = get_first_seen(sub_arr['bootstrap_id'])
+        sample_grpd_results[tuple(cell_assay.split(':'))] = OrderedDict(
+            (int(bootstrap_id), sub_arr[bootstrap_idx == b])
+            for b, bootstrap_id in enumerate(bootstrap_ids))
+    all_users = set(numpy.unique(arr['team_id']).tolist())
+    return sample_grpd_results, all_users
+
+
+def calc_cell_assay_ranks(cell, assay, bootstrapped_submissions,
+                          measures_to_use, team_name_dict=None, syn=None,
+                          combined_ranks=None, team_names=None):
+    """Calculate ranks for a single cell/assay
+
+    Args:
+        combined_ranks: { bootstrap_id: ranks } from
+            calc_all_combined_ranks(). Calculated here if not given
+        team_names: TeamNameResolver. Made from syn/team_name_dict if not given
+    Returns:
+        CellAssayRanks
+    """
+    team_names = get_team_name_resolver(syn, team_name_dict, team_names)
+    user_ranks = defaultdict(list)
+    bootstrap_scores = OrderedDict()
+    for index, submissions in bootstrapped_submissions.items():
+        if combined_ranks is None:
+            ranks = calc_combined_ranks(submissions, measures_to_use)
+        else:
+            ranks = combined_ranks[index]
+
+        bootstrap_scores[index] = []
+        for (team_id, submission_id), rank in ranks.items():
+            # print team_id, rank
+            user_ranks[(team_id, submission_id)].append(rank)
+            # user_ranks[(team_id, 0)].append(rank)
+            bootstrap_scores[index].append(
+                (team_id, min(0.5, rank/(len(ranks)+1))))
+
+    markdown = '# {} {} ({} {})\n'.format(cell, get_cell_name(cell), assay, get_assay_name(assay))
+    markdown += ' | '.join(('Team', 'name', 'rank')) + '\n'
+    markdown += '|'.join(('----',)*3) + '\n'
+    team_ids = []
+    for (team_id, submission_id), ranks in sorted(
+            user_ranks.items(), key=lambda x: sorted(x[1])[1]):
+        markdown += '%d | %s | %.2f' % (
+            team_id, team_names.get(team_id), sorted(ranks)[1]) + '\n'
+        team_ids.append(int(team_id))
+    markdown += '\n\n'
+
+    return CellAssayRanks(bootstrap_scores, team_ids, markdown)
+
+
+def aggregate_global_ranks(cell_assay_ranks, all_users, team_name_dict=None,
+                           syn=None, team_names=None, num_resamples=0,
+                           seed=None):
+    """Calculate global ranks from ranks of all cell/assays
+
+    Args:
+        cell_assay_ranks: OrderedDict { (cell, assay): CellAssayRanks }
+        num_resamples: If > 0, score bounds and ranks are calculated
+            over this number of resampled cell/assays (with replacement)
+            instead of fixed bootstraps. See bootstrap_rank.py
+        seed: random seed for resampling
+    Outputs:
+        Markdown table for ranks
+    """
+    team_names = get_team_name_resolver(syn, team_name_dict, team_names)
+    team_names.prefetch(all_users)
+    markdown_per_cell_assay = defaultdict(OrderedDict)
 
     # to print ranks per cell_assay
     tmp_d = dict()
-    # group all submissions by cell and assay
     rv = {}
-    global_scores = defaultdict(lambda: defaultdict(list))
-    for (cell, assay), bootstrapped_submissions in sample_grpd_results.items():
-        user_ranks = defaultdict(list)
-        for index, submissions in bootstrapped_submissions.items():
-            ranks = calc_combined_ranks(submissions, measures_to_use)
-
-            obs_users = set(x[0] for x in ranks.keys())
-            for (team_id, submission_id), rank in ranks.items():
-                # print team_id, rank
-                user_ranks[(team_id, submission_id)].append(rank)
-                # user_ranks[(team_id, 0)].append(rank)
-                global_scores[index][team_id].append(
-                    min(0.5, rank/(len(ranks)+1))
-                )
-            for team_id in all_users - obs_users:
-                global_scores[index][team_id].append(0.5)                
-
-        markdown = '# {} {} ({} {})\n'.format(cell, get_cell_name(cell), assay, get_assay_name(assay))
-        markdown += ' | '.join(('Team', 'name', 'rank')) + '\n'
-        markdown += '|'.join(('----',)*3) + '\n'
-        tmp_d['{}{}'.format(cell, assay)] = []
-        for (team_id, submission_id), ranks in sorted(
-                user_ranks.items(), key=lambda x: sorted(x[1])[1]):
-            markdown += '%d | %s | %.2f' % (
-                team_id, get_team_name(syn, team_name_dict, team_id), sorted(ranks)[1]) + '\n'
-            tmp_d['{}{}'.format(cell, assay)].append(team_id)
-        markdown += '\n\n'
-        markdown_per_cell_assay[cell][assay] = markdown
+    for (cell, assay), r in cell_assay_ranks.items():
+        tmp_d['{}{}'.format(cell, assay)] = list(r.team_ids)
+        markdown_per_cell_assay[cell][assay] = r.markdown
 
     with open('rank_per_cell_assay.tsv', 'w') as fp:
         fp.write(json.dumps(tmp_d, indent=4))
 
-    # group the scores by user
-    user_grpd_global_scores = defaultdict(list)
-    user_grpd_global_ranks = defaultdict(list)
-    for bootstrap_id, bootstrap_global_scores in global_scores.items():
-        sorted_scores = sorted(
-            bootstrap_global_scores.items(), key=lambda x: sum(x[1]))
-        ranks = rankdata([sum(x[1]) for x in sorted_scores])
-        for (team_id, scores), rank in zip(sorted_scores, ranks):
-            user_grpd_global_scores[team_id].append(sum(scores)/float(len(scores)))
-            user_grpd_global_ranks[team_id].append(rank)
+    scores, valid, team_ids, bootstrap_ids = get_global_score_array(
+        cell_assay_ranks, all_users)
+    stats, total = calc_bootstrap_stats(scores, valid, team_ids)
+    team_idx = {t: i for i, t in enumerate(team_ids)}
+
+    # order of teams (for ties) as they are found in the first bootstrap
+    team_order = []
+    if bootstrap_ids:
+        first_index = bootstrap_ids[0]
+        for r in cell_assay_ranks.values():
+            if first_index not in r.bootstrap_scores:
+                continue
+            team_scores = r.bootstrap_scores[first_index]
+            obs_users = set(team_id for team_id, _ in team_scores)
+            team_order.extend(team_id for team_id, _ in team_scores)
+            team_order.extend(all_users - obs_users)
+        team_order = list(OrderedDict.fromkeys(team_order))
+        team_order = sorted(team_order, key=lambda x: total[0, team_idx[x]])
+        team_order = sorted(
+            team_order, key=lambda x: stats.score_mean[team_idx[x]])
+
+    if num_resamples:
+        resampled = resample_global_scores(scores, valid, num_resamples, seed)
+        stats = calc_resampled_stats(resampled, team_ids)
+
     global_data = []
-    for team_id, scores in sorted(
-            user_grpd_global_scores.items(), key=lambda x: sum(x[1])):
+    for team_id in team_order:
+        i = team_idx[team_id]
         global_data.append(GlobalScore(*[
-            team_id, get_team_name(syn, team_name_dict, team_id),
-            min(scores), sum(scores)/len(scores), max(scores), 
-            sorted(user_grpd_global_ranks[team_id])[1]
+            team_id, team_names.get(team_id),
+            stats.score_lb[i], stats.score_mean[i], stats.score_ub[i],
+            stats.rank[i]
         ]))
     global_data = sorted(global_data, key=lambda x: (x.rank, x.score_mean))
 
@@ -258,28 +443,135 @@ def calc_global_ranks(rows, measures_to_use, team_name_dict=None, syn=None):
     return rv, global_data, markdown_per_cell_assay, markdown_overall
 
 
+def calc_global_ranks(rows, measures_to_use, team_name_dict=None, syn=None,
+                      team_names=None, num_resamples=0, seed=None):
+    """Calculate global ranks
+
+    Args:
+        team_names: TeamNameResolver. Made from syn/team_name_dict if not given
+        num_resamples, seed: See aggregate_global_ranks()
+    Outputs:
+        Markdown table for ranks
+    """
+    sample_grpd_results, all_users = group_rows_by_cell_assay(rows)
+    # look up all team names at once
+    team_names = get_team_name_resolver(syn, team_name_dict, team_names)
+    team_names.prefetch(all_users)
+    combined_ranks = calc_all_combined_ranks(
+        sample_grpd_results, measures_to_use)
+
+    # group all submissions by cell and assay
+    cell_assay_ranks = OrderedDict()
+    for (cell, assay), bootstrapped_submissions in sample_grpd_results.items():
+        cell_assay_ranks[(cell, assay)] = calc_cell_assay_ranks(
+            cell, assay, bootstrapped_submissions, measures_to_use,
+            team_name_dict, syn, combined_ranks[(cell, assay)], team_names)
+
+    return aggregate_global_ranks(
+        cell_assay_ranks, all_users, team_names=team_names,
+        num_resamples=num_resamples, seed=seed)
+
+
+class IncrementalRanker(object):
+    """Calculate global ranks repeatedly (e.g. for every wiki update).
+
+    Ranks of a cell/assay are cached and recalculated only if its
+    submissions have changed since the last call, so that only
+    cell/assays with new submissions are ranked again.
+    Global ranks are aggregated from cached ranks of all cell/assays.
+    """
+    def __init__(self, measures_to_use, team_name_dict=None, syn=None,
+                 team_names=None, num_resamples=0, seed=None):
+        self.measures_to_use = measures_to_use
+        self.num_resamples = num_resamples
+        self.seed = seed
+        self.team_names = get_team_name_resolver(
+            syn, team_name_dict, team_names)
+        # (cell, assay): (signature, CellAssayRanks)
+        self._cache = {}
+
+    @staticmethod
+    def get_signature(bootstrapped_submissions):
+        # scores are included since a submission can be re-scored
+        # under the same ID (e.g. reset in journal)
+        # compared as bytes so that NaN scores are equal
+        signature = set()
+        attrs = ('submission_id', 'team_id') + Score._fields
+        for bootstrap_id, submissions in bootstrapped_submissions.items():
+            cols = get_columns(submissions, attrs)
+            signature.update((bootstrap_id, r.tobytes()) for r in cols)
+        return frozenset(signature)
+
+    def calc_global_ranks(self, rows):
+        """Same as calc_global_ranks() but uses cached cell/assay ranks
+        """
+        sample_grpd_results, all_users = group_rows_by_cell_assay(rows)
+        self.team_names.prefetch(all_users)
+
+        signatures = {}
+        changed = OrderedDict()
+        for key, bootstrapped_submissions in sample_grpd_results.items():
+            signatures[key] = self.get_signature(bootstrapped_submissions)
+            cached = self._cache.get(key)
+            if cached is None or cached[0] != signatures[key]:
+                changed[key] = bootstrapped_submissions
+        # rank all changed cell/assays at once
+        combined_ranks = calc_all_combined_ranks(
+            changed, self.measures_to_use)
+
+        cache = {}
+        cell_assay_ranks = OrderedDict()
+        for (cell, assay), bootstrapped_submissions in sample_grpd_results.items():
+            if (cell, assay) in changed:
+                r = calc_cell_assay_ranks(
+                    cell, assay, bootstrapped_submissions,
+                    self.measures_to_use,
+                    combined_ranks=combined_ranks[(cell, assay)],
+                    team_names=self.team_names)
+            else:
+                r = self._cache[(cell, assay)][1]
+            cache[(cell, assay)] = (signatures[(cell, assay)], r)
+            cell_assay_ranks[(cell, assay)] = r
+        # drop cell/assays no longer found
+        self._cache = cache
+
+        log.info('Ranked {} of {} cell/assays.'.format(
+            len(changed), len(cell_assay_ranks)))
+        return aggregate_global_ranks(
+            cell_assay_ranks, all_users, team_names=self.team_names,
+            num_resamples=self.num_resamples, seed=self.seed)
+
+
 def show_score(rows, team_name_dict=None):
+    """Print all scores
+
+    Args:
+        rows: list of ScoreDBRecord or a structured array
+            (e.g. from read_scores_from_db_as_array())
+    """
     print('\t'.join(['submission_id', 'team', 'cell_id', 'cell', 'assay_id', 'assay', 'bootstraip_id', 
                     'mse', 'gwcorr', 'gwspear', 'mseprom', 'msegene', 'mseenh',
                     'msevar', 'mse1obs', 'mse1imp']))
-    for x in rows:
-        mse = x.mse
-        gwcorr = x.gwcorr
-        gwspear = x.gwspear
-        mseprom = x.mseprom
-        msegene = x.msegene
-        mseenh = x.mseenh
-        msevar = x.msevar
-        mse1obs = x.mse1obs
-        mse1imp = x.mse1imp
-        
-        submission_id= x.submission_id
-        team= get_team_name(None, team_name_dict, x.team_id)
-        cell_id = x.cell
-        cell= get_cell_name(x.cell)
-        assay_id = x.assay
-        assay= get_assay_name(x.assay)
-        bootstrap_id= x.bootstrap_id
+    attrs = ['submission_id', 'team_id', 'cell', 'assay', 'bootstrap_id',
+             'mse', 'gwcorr', 'gwspear', 'mseprom', 'msegene', 'mseenh',
+             'msevar', 'mse1obs', 'mse1imp']
+    if isinstance(rows, numpy.ndarray):
+        cols = [rows[attr].tolist() for attr in attrs]
+    else:
+        cols = [[getattr(x, attr) for x in rows] for attr in attrs]
+
+    # look up names once for each ID
+    team_names = {
+        x: get_team_name(None, team_name_dict, x) for x in set(cols[1])}
+    cell_names = {x: get_cell_name(x) for x in set(cols[2])}
+    assay_names = {x: get_assay_name(x) for x in set(cols[3])}
+
+    for submission_id, team_id, cell_id, assay_id, bootstrap_id, \
+            mse, gwcorr, gwspear, mseprom, msegene, mseenh, \
+            msevar, mse1obs, mse1imp in zip(*cols):
+        team = team_names[team_id]
+        cell = cell_names[cell_id]
+        assay = assay_names[assay_id]
 
         print('\t'.join([str(i) for i in \
                              [submission_id, team, cell_id, cell, assay_id, assay, bootstrap_id,
@@ -306,6 +598,12 @@ def parse_arguments():
                                  'msegene', 'mseenh', 'msevar', 'mse1obs',
                                  'mse1imp'],
                         help='List of performance measures to be used for ranking')
+    parser.add_argument('--num-resamples', type=int, default=0,
+                        help='Calculate score bounds and ranks over this '
+                             'number of resampled cell/assays instead of '
+                             'fixed bootstraps. 0 to disable')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for --num-resamples')
     args = parser.parse_args()
 
     if args.chrom == ['all']:
@@ -319,7 +617,7 @@ def main():
     args = parse_arguments()
 
     log.info('Reading from DB file...')
-    rows = read_scores_from_db(args.db_file, args.chrom)
+    rows = read_scores_from_db_as_array(args.db_file, args.chrom)
 
     if args.team_name_tsv is not None:
         team_name_dict = parse_team_name_tsv(args.team_name_tsv)
@@ -334,7 +632,8 @@ def main():
         log.info('Calculate ranks...')
         rv, global_data, markdown_per_cell_assay, markdown_overall = \
             calc_global_ranks(
-                rows, args.measures_to_use, team_name_dict)
+                rows, args.measures_to_use, team_name_dict,
+                num_resamples=args.num_resamples, seed=args.seed)
         print(markdown_overall)
         for _, markdown_per_assay in markdown_per_cell_assay.items():
             for _, markdown in markdown_per_assay.items():                
@@ -8,11 +8,17 @@ import os
 import time
 import re
 import gc
-from score_metrics import Score, normalize_dict
+import itertools
+import tempfile
+import numpy
+from score_metrics import Score, normalize_dict, ChromPartialsScorer
 from score_metrics import mse, mseprom, msegene, mseenh, msevar, mse1obs, mse1imp
-from score_metrics import gwcorr, gwspear
+from score_metrics import gwcorr, gwspear, score_multi
 from db import write_to_db, ScoreDBRecord
-from bw_to_npy import load_bed, load_npy, bw_to_dict, dict_to_arr
+from bw_to_npy import load_npy, bw_to_dict, dict_to_arr, stack_npys
+from bed import load_annotations
+from track_cache import ConvertedTrackCache, get_converted_track_key
+from track_cache import get_file_md5
 from logger import log
 
 
@@ -82,6 +88,175 @@ def score(y_pred_dict, y_true_dict, chroms,
     return output
 
 
+def generate_bootstrap_chrom(chroms, method='leave-k-out', k=1,
+                             num_bootstrap=None, seed=0):
+    """Generate bootstrap groups of chromosomes
+
+    Args:
+        method:
+            leave-k-out: all groups leaving k chromosomes out.
+                If num_bootstrap is given, randomly pick that many of them.
+            resample: num_bootstrap groups of len(chroms) chromosomes
+                sampled with replacement.
+        seed: random seed. Same seed gives the same groups
+    Returns:
+        [(bootstrap_id, [chrom, ...]), ...] as in --bootstrap-chrom
+    """
+    chroms = sorted(chroms)
+    rng = numpy.random.RandomState(seed)
+
+    if method == 'leave-k-out':
+        if not 0 < k < len(chroms):
+            raise ValueError('Invalid k for leave-k-out: {}'.format(k))
+        groups = [
+            [c for c in chroms if c not in left_out]
+            for left_out in itertools.combinations(chroms, k)]
+        if num_bootstrap is not None and num_bootstrap < len(groups):
+            idx = sorted(rng.choice(len(groups), num_bootstrap, replace=False))
+            groups = [groups[i] for i in idx]
+
+    elif method == 'resample':
+        if num_bootstrap is None:
+            raise ValueError('Number of bootstraps is required for resample.')
+        groups = [
+            sorted(rng.choice(chroms, len(chroms), replace=True).tolist())
+            for _ in range(num_bootstrap)]
+
+    else:
+        raise ValueError('Unknown bootstrap method: {}'.format(method))
+
+    return list(enumerate(groups))
+
+
+def parse_bootstrap_chrom(args):
+    """Set args.bootstrap_chrom as [(bootstrap_id, [chrom, ...]), ...]
+    from --bootstrap-chrom or --bootstrap-method
+    """
+    if len(args.bootstrap_chrom) > 0:
+        for i, _ in enumerate(args.bootstrap_chrom):
+            args.bootstrap_chrom[i] = (i, args.bootstrap_chrom[i].split(','))
+    elif args.bootstrap_method is not None:
+        args.bootstrap_chrom = generate_bootstrap_chrom(
+            args.chrom, args.bootstrap_method, args.bootstrap_k,
+            args.num_bootstrap, args.bootstrap_seed)
+    else:
+        args.bootstrap_chrom = [(-1, args.chrom)]
+
+
+def add_bootstrap_arguments(p_score):
+    p_score.add_argument('--bootstrap-method',
+                         choices=['leave-k-out', 'resample'],
+                         help='Generate bootstrapped chromosome groups '
+                              'instead of listing them in --bootstrap-chrom. '
+                              'leave-k-out: leave --bootstrap-k chromosomes out. '
+                              'resample: resample chromosomes with replacement.')
+    p_score.add_argument('--bootstrap-k', type=int, default=1,
+                         help='Number of chromosomes to leave out for '
+                              '--bootstrap-method leave-k-out')
+    p_score.add_argument('--num-bootstrap', type=int,
+                         help='Number of bootstrap groups to generate. '
+                              'Required for --bootstrap-method resample. '
+                              'For leave-k-out, groups are randomly picked '
+                              'if there are more than this.')
+    p_score.add_argument('--bootstrap-seed', type=int, default=0,
+                         help='Random seed for --bootstrap-method')
+
+
+def score_bootstrap(y_pred_dict, y_true_dict, bootstrap_chrom,
+                    gene_annotations, enh_annotations,
+                    window_size=25, prom_loc=80,
+                    y_var_dict=None):
+    """Calculate score for all bootstrap groups.
+    Partials are calculated once per chromosome and combined for
+    each group (see ChromPartialsScorer) so that scoring many groups
+    costs little more than scoring one. gwspear is the exception,
+    it still takes one (sort-free) pass over the bins of each group.
+
+    Args:
+        bootstrap_chrom: [(bootstrap_id, [chrom, ...]), ...]
+    Returns:
+        [(bootstrap_id, Score), ...]
+    """
+    if not bootstrap_chrom:
+        return []
+    scorer = ChromPartialsScorer(
+        y_pred_dict, y_true_dict,
+        [chroms for _, chroms in bootstrap_chrom],
+        gene_annotations, enh_annotations,
+        window_size, prom_loc, y_var_dict)
+    return [(k, scorer.score(chroms)) for k, chroms in bootstrap_chrom]
+
+
+def load_pred_dict(args, pred_npy_or_bw):
+    """Read submission. A converted bigwig is read from/kept in
+    --converted-cache-dir (e.g. converted by validate_round2.py while
+    validating) if defined.
+    """
+    if args.converted_cache_dir is None or \
+            pred_npy_or_bw.lower().endswith(('npy', 'npz')):
+        return bw_to_dict(pred_npy_or_bw, args.chrom,
+                          args.window_size, args.blacklist_file,
+                          args.validated)
+
+    converted_track_cache = ConvertedTrackCache(
+        args.converted_cache_dir,
+        int(args.converted_cache_max_gb * 1024**3))
+    converted_key = get_converted_track_key(
+        get_file_md5(pred_npy_or_bw), args.chrom, args.window_size,
+        args.validated, args.blacklist_file)
+    y_pred_dict = converted_track_cache.get(converted_key)
+    if y_pred_dict is None:
+        y_pred_dict = converted_track_cache.put(
+            converted_key,
+            bw_to_dict(pred_npy_or_bw, args.chrom,
+                       args.window_size, args.blacklist_file,
+                       args.validated),
+            args.chrom)
+    return y_pred_dict
+
+
+def score_submissions(args, y_true_dict, gene_annotations, enh_annotations,
+                      y_var_dict=None):
+    """Score many submissions on the same cell/assay together
+    (e.g. all teams in the final round). Submissions are stacked into
+    a matrix (--stack-npy) and scored in one pass over the genome
+    with score_multi().
+
+    Returns:
+        [[(bootstrap_id, Score), ...] for each submission]
+    """
+    if args.stack_npy is None:
+        fd, stack_npy = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+    else:
+        stack_npy = args.stack_npy
+
+    try:
+        # float64 to get the same scores as scoring one by one
+        y_pred_mat, chrom_offsets = stack_npys(
+            args.pred_npy_or_bw, args.chrom, stack_npy, numpy.float64,
+            lambda f: load_pred_dict(args, f))
+        y_true = numpy.concatenate([y_true_dict[c] for c in args.chrom])
+        if y_var_dict is None:
+            y_var = None
+        else:
+            y_var = numpy.concatenate([y_var_dict[c] for c in args.chrom])
+
+        scores = score_multi(
+            y_pred_mat, y_true, chrom_offsets,
+            [chroms for _, chroms in args.bootstrap_chrom],
+            gene_annotations, enh_annotations,
+            args.window_size, args.prom_loc, y_var)
+        y_pred_mat = None
+    finally:
+        if args.stack_npy is None:
+            os.remove(stack_npy)
+
+    return [
+        [(k, scores[j][i]) for j, (k, _) in enumerate(args.bootstrap_chrom)]
+        for i in range(len(args.pred_npy_or_bw))]
+
+
 def parse_arguments():
     import argparse
     import os
@@ -91,8 +266,11 @@ def parse_arguments():
     parser = argparse.ArgumentParser(
         description='ENCODE Imputation Challenge scoring script. .npy or .npz must be built '
              'with a correct --window-size. i.e. containing a value for each bin')
-    parser.add_argument('pred_npy_or_bw',
-                        help='Submission .npy or .bigwig file to be scored')
+    parser.add_argument('pred_npy_or_bw', nargs='+',
+                        help='Submission .npy or .bigwig file to be scored. '
+                             'Many submissions for the same cell/assay '
+                             '(e.g. all teams in the final round) are '
+                             'scored together in one pass over the genome')
     parser.add_argument('true_npy_or_bw',
                         help='Truth .npy or .bigwig file')
     parser.add_argument('--download-submissions-from-syn-eval-queue', action='store_true',
@@ -123,6 +301,7 @@ def parse_arguments():
                               'comma(,) in each group. Order is important.'
                               'e.g. "chr1,chr2 chr1,chrX chr2,chrX" means '
                               'three groups: (chr1,chr2), (chr1,chrX), (chr2,chrX)')
+    add_bootstrap_arguments(p_score)
     p_score.add_argument('--gene-annotations',
                          default=os.path.join(
                             py_path,
@@ -154,6 +333,20 @@ def parse_arguments():
                               'bw_to_npy.py')
     #p_score.add_argument('--normalize-with-robust-min-max', action='store_true',
     #                     help='Normalize with robust min max.')
+    p_score.add_argument('--converted-cache-dir',
+                         help='Read converted (binned) submission bigwig from '
+                              'here if found (e.g. converted by '
+                              'validate_round2.py with the same '
+                              '--converted-cache-dir). Otherwise convert it '
+                              'and keep it here. Disabled if not defined')
+    p_score.add_argument('--converted-cache-max-gb', type=float, default=20.0,
+                         help='Size limit of --converted-cache-dir in GB. '
+                              'Least recently used tracks are evicted first')
+    p_score.add_argument('--stack-npy',
+                         help='Stack submissions into this .npy matrix '
+                              '(number of submissions x number of bins) '
+                              'when scoring many submissions. A temporary '
+                              'file is used and removed if not defined')
     p_out = parser.add_argument_group(
                         title='Output to file (TSV or DB)')
     p_out.add_argument('--db-file',
@@ -162,25 +355,27 @@ def parse_arguments():
                         title='Submission metadata, which will be written to '
                               'DB together with scores. This will be used for '
                               'ranking later')
-    p_meta.add_argument('--team-id', '-t', type=int,
-                        help='Team ID (unique ID from Synapse)')
-    p_meta.add_argument('--submission-id', '-s', type=int,
-                        help='Submission ID (unique ID from Synapse)')
+    p_meta.add_argument('--team-id', '-t', type=int, nargs='+',
+                        help='Team ID (unique ID from Synapse). '
+                             'One for each submission')
+    p_meta.add_argument('--submission-id', '-s', type=int, nargs='+',
+                        help='Submission ID (unique ID from Synapse). '
+                             'One for each submission')
     args = parser.parse_args()
 
     if args.db_file is not None:
         if not os.path.exists(args.db_file):
             raise ValueError('DB file does not exists')
+    for ids in (args.team_id, args.submission_id):
+        if ids is not None and len(ids) != len(args.pred_npy_or_bw):
+            raise ValueError('Number of --team-id or --submission-id '
+                             'should match with number of submissions')
 
     if args.chrom == ['all']:
         args.chrom = ['chr' + str(i) for i in range(1, 23)] + ['chrX']
     args.chrom = sorted(args.chrom)
 
-    if len(args.bootstrap_chrom) == 0:
-        args.bootstrap_chrom = [(-1, args.chrom)]
-    else:
-        for i, _ in enumerate(args.bootstrap_chrom):
-            args.bootstrap_chrom[i] = (i, args.bootstrap_chrom[i].split(','))
+    parse_bootstrap_chrom(args)
     print(args.bootstrap_chrom)
 
     return args
@@ -189,8 +384,6 @@ def parse_arguments():
 def main():
     args = parse_arguments()
 
-    y_pred_dict = bw_to_dict(args.pred_npy_or_bw, args.chrom,
-                             args.window_size, args.blacklist_file)
     y_true_dict = bw_to_dict(args.true_npy_or_bw, args.chrom,
                              args.window_size, args.blacklist_file)
     if args.var_npy is None:
@@ -201,35 +394,55 @@ def main():
     else:
         raise ValueError('Var true file should be a binned .npy or .npz.')
 
-    enh_annotations = load_bed(args.enh_annotations)
-    gene_annotations = load_bed(args.gene_annotations)
+    enh_annotations = load_annotations(
+        args.enh_annotations, args.window_size, args.prom_loc)
+    gene_annotations = load_annotations(
+        args.gene_annotations, args.window_size, args.prom_loc)
 
     gc.disable()
 
-    cell, assay = parse_submission_filename(args.pred_npy_or_bw)
-
-    for k, bootstrap_chrom in args.bootstrap_chrom:
-        log.info('Calculating score for bootstrap {} case...'.format(k))
-
-        score_output = score(y_pred_dict, y_true_dict, bootstrap_chrom,
-                             gene_annotations, enh_annotations,
-                             args.window_size, args.prom_loc,
-                             y_var_dict)
-        s = "\t".join(['bootstrap_'+str(k)]+[str(o) for o in score_output])
-        print(s)
-
-        # write to DB
-        if args.db_file is not None:
-            score_db_record = ScoreDBRecord(
-                args.submission_id,
-                args.team_id,
-                os.path.basename(args.pred_npy_or_bw),
-                cell,
-                assay,
-                k,
-                *score_output)
-            write_to_db(score_db_record, args.db_file)
-        gc.collect()
+    cell_assays = [parse_submission_filename(f) for f in args.pred_npy_or_bw]
+    if len(set(cell_assays)) > 1:
+        raise ValueError('All submissions should be for the same cell/assay '
+                         'to be scored together.')
+
+    log.info('Calculating score for {} bootstrap cases...'.format(
+        len(args.bootstrap_chrom)))
+    if len(args.pred_npy_or_bw) == 1:
+        y_pred_dict = load_pred_dict(args, args.pred_npy_or_bw[0])
+        all_score_outputs = [
+            score_bootstrap(y_pred_dict, y_true_dict,
+                            args.bootstrap_chrom,
+                            gene_annotations, enh_annotations,
+                            args.window_size, args.prom_loc,
+                            y_var_dict)]
+    else:
+        all_score_outputs = score_submissions(
+            args, y_true_dict, gene_annotations, enh_annotations,
+            y_var_dict)
+
+    for i, score_outputs in enumerate(all_score_outputs):
+        pred_npy_or_bw = args.pred_npy_or_bw[i]
+        cell, assay = cell_assays[i]
+        for k, score_output in score_outputs:
+            s = "\t".join(['bootstrap_'+str(k)]+[str(o) for o in score_output])
+            if len(args.pred_npy_or_bw) > 1:
+                s = pred_npy_or_bw + '\t' + s
+            print(s)
+
+            # write to DB
+            if args.db_file is not None:
+                score_db_record = ScoreDBRecord(
+                    None if args.submission_id is None
+                    else args.submission_id[i],
+                    None if args.team_id is None else args.team_id[i],
+                    os.path.basename(pred_npy_or_bw),
+                    cell,
+                    assay,
+                    k,
+                    *score_output)
+                write_to_db(score_db_record, args.db_file)
+            gc.collect()
 
     log.info('All done')
 
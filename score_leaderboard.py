@@ -9,21 +9,53 @@ import re
 import time
 import shutil
 import math
+import json
+import hashlib
 #import gc
 import traceback
+import numpy
 import synapseclient
 import multiprocessing
-from bw_to_npy import load_bed, load_npy, bw_to_dict
-from score import parse_submission_filename, score
-from score_metrics import Score
-from rank import calc_global_ranks, get_cell_name, get_assay_name, get_team_name, parse_team_name_tsv
-from db import write_to_db, ScoreDBRecord, DB_QUERY_GET, read_scores_from_db
+from bw_to_npy import load_npy, bw_to_dict, get_blacklist_bin_ids
+from bed import load_bed_columns, load_annotations
+from score import parse_submission_filename, score_bootstrap
+from score import parse_bootstrap_chrom, add_bootstrap_arguments
+from score_metrics import Score, METRIC_VERSION
+from team_names import TeamNameResolver
+from wiki_publisher import WikiPublisher, WikiPage
+from rank import calc_global_ranks, IncrementalRanker, get_cell_name, get_assay_name, get_team_name, parse_team_name_tsv
+from db import write_records_to_db, ScoreDBRecord, DB_QUERY_GET
+from db import read_score_cache, write_score_cache, ScoreDBWriter
+from db import migrate_db_file, read_scores_from_db_as_array
+from shared_tracks import SharedTrackRegistry
+from intake import IntakeScheduler
+from pipeline import ScoringPipeline
+from track_cache import ConvertedTrackCache, get_converted_track_key
+from track_cache import get_file_md5
+from journal import JobJournal
+from pipeline import MemoryBudget
+from validate import CHRSZ
 from io import StringIO
 from logger import log
 
 
 BIG_INT = 99999999  # for multiprocessing
 
+# rough peak memory per bin (or per bp) in bytes to estimate
+# memory of a scoring job. see estimate_job_memory()
+BYTES_PER_FLOAT = numpy.dtype(float).itemsize
+# score(): dict_to_arr() builds python lists of numpy scalars and
+# concatenated copies of pred/truth, plus sorting and ranks in metrics
+SCORE_BYTES_PER_BIN = 100
+# bw_to_dict(validated=True): bw.intervals() tuples + list of floats
+VALIDATED_BW_BYTES_PER_BIN = 200
+# bw_to_dict(validated=False): bw.values(), zero-padded copy and
+# nan_to_num copy of a whole chromosome at base resolution
+BW_BYTES_PER_BP = 3 * BYTES_PER_FLOAT
+
+# per-worker state loaded once by init_worker()
+WORKER_STATE = {}
+
 
 LEADERBOARD_ROUND_VALID_CELL_ASSAY = [
 'C02M22',
@@ -146,19 +178,24 @@ and%2Bassay%3D%3D%2522{assay}%2522%2B\
 
 RE_PATTERN_SUBMISSION_FNAME = r'^C\d\dM\d\d.*(bw|bigwig|bigWig|BigWig)'
 
-def update_wiki(syn, team_name_dict, args):
+def update_wiki(syn, team_name_dict, args, ranker=None, publisher=None):
     # calculate ranks and update leaderboard wiki
     log.info('Updating wiki...')
-    rows = read_scores_from_db(args.db_file, args.chrom)
-    _, _, markdown_per_cell_assay, markdown_overall = calc_global_ranks(
-        rows, args.measures_to_use, team_name_dict, syn)
+    rows = read_scores_from_db_as_array(args.db_file, args.chrom)
+    if ranker is None:
+        _, _, markdown_per_cell_assay, markdown_overall = calc_global_ranks(
+            rows, args.measures_to_use, team_name_dict, syn,
+            num_resamples=args.num_resamples, seed=args.seed)
+    else:
+        # only cell/assays with new submissions are ranked again
+        _, _, markdown_per_cell_assay, markdown_overall = \
+            ranker.calc_global_ranks(rows)
 
     wiki_id_map = {
         k.split(':')[0]: k.split(':')[1] for k in args.leaderboard_wiki_id.split(',')
     }
+    pages = []
     for k, wiki_id in wiki_id_map.items():
-        w = syn.getWiki(args.project_id, wiki_id)
-
         if k == 'submission_status':
             title = 'Submission status'
             markdown = WIKI_TEMPLATE_SUBMISSION_STATUS.format(
@@ -180,9 +217,12 @@ def update_wiki(syn, team_name_dict, args):
         else:
             continue
 
-        w.markdown = markdown
-        w.title = title
-        w = syn.store(w)
+        pages.append(WikiPage(wiki_id, title, markdown))
+
+    # push changed pages only
+    if publisher is None:
+        publisher = WikiPublisher(syn, args.project_id, args.nth_wiki)
+    publisher.publish(pages)
 
     return None
 
@@ -218,6 +258,7 @@ def parse_arguments():
                               'comma(,) in each group. Order is important.'
                               'e.g. "chr1,chr2 chr1,chrX chr2,chrX" means '
                               'three groups: (chr1,chr2), (chr1,chrX), (chr2,chrX)')
+    add_bootstrap_arguments(p_score)
     p_score.add_argument('--gene-annotations',
                          default=os.path.join(
                             py_path,
@@ -245,6 +286,12 @@ def parse_arguments():
                                  'msegene', 'mseenh', 'msevar', 'mse1obs',
                                  'mse1imp'],
                         help='List of performance measures to be used for ranking')
+    p_score.add_argument('--num-resamples', type=int, default=0,
+                         help='Calculate score bounds and ranks over this '
+                              'number of resampled cell/assays instead of '
+                              'fixed bootstraps. 0 to disable')
+    p_score.add_argument('--seed', type=int, default=0,
+                         help='Random seed for --num-resamples')
     p_score.add_argument('--validated', action='store_true',
                          help='For validated submissions '
                               'with fixed interval length of 25 and valid '
@@ -264,6 +311,36 @@ def parse_arguments():
                         help='Number of threads to parallelize scoring (per) submission')
     p_sys.add_argument('--team-name-tsv',
                         help='TSV file with team_id/team_name (1st col/2nd col).')
+    p_sys.add_argument('--team-name-cache',
+                        help='JSON file to cache team names looked up on '
+                             'synapse across runs.')
+    p_sys.add_argument('--team-name-cache-ttl', type=int, default=86400,
+                        help='Time in second before cached team names are '
+                             'looked up again.')
+    p_sys.add_argument('--mem-limit-gb', type=float,
+                        help='Memory budget in GB for submissions being scored. '
+                             'A submission is scored only while the estimated '
+                             'peak memory of all submissions being scored '
+                             'stays under this limit. Set --nth to the number '
+                             'of cores if this is used')
+    p_sys.add_argument('--nth-download', type=int, default=2,
+                        help='Number of threads to download submissions')
+    p_sys.add_argument('--nth-wiki', type=int, default=4,
+                        help='Number of threads to push wiki pages')
+    p_sys.add_argument('--max-pending', type=int, default=4,
+                        help='Maximum number of downloaded submissions waiting '
+                             'for scoring or being scored. Downloads stall '
+                             'while this is reached')
+    p_sys.add_argument('--converted-cache-dir',
+                        help='Keep converted (binned) submissions here so that '
+                             'retries and re-scoring skip downloading and '
+                             'converting bigwigs. Disabled if not defined')
+    p_sys.add_argument('--converted-cache-max-gb', type=float, default=20.0,
+                        help='Size limit of --converted-cache-dir in GB. '
+                             'Least recently used tracks are evicted first')
+    p_sys.add_argument('--preload-truth', nargs='*', default=[],
+                        help='Truth tracks (CXXMYY) to be loaded into shared '
+                             'memory at startup and kept there.')
     p_syn = parser.add_argument_group(
                         title='Communitation with synapse')
     p_syn.add_argument('--dry-run', action='store_true',
@@ -288,9 +365,14 @@ def parse_arguments():
                        help='Send message to admin.')
     p_syn.add_argument('--send-msg-to-user', action='store_true',
                        help='Send message to user.')
-    p_syn.add_argument('--period', default=1800,
-                       help='Time period in second to download submissions from synapse '
-                            'and score them')
+    p_syn.add_argument('--period', default=1800, type=int,
+                       help='Maximum time period in second to poll submissions '
+                            'from synapse. Polling backs off up to this period '
+                            'while no submissions arrive')
+    p_syn.add_argument('--min-period', default=30, type=int,
+                       help='Time period in second to poll submissions from '
+                            'synapse while submissions are arriving or being '
+                            'scored')
     p_syn.add_argument('--admin-id', nargs='+', default=['3345120'],
                        help='Admin\'s Synapse ID (as string) ')
     args = parser.parse_args()
@@ -304,32 +386,224 @@ def parse_arguments():
         args.chrom = ['chr' + str(i) for i in range(1, 23)] + ['chrX']
     args.chrom = sorted(args.chrom)
 
-    if len(args.bootstrap_chrom) == 0:
-        args.bootstrap_chrom = [(-1, args.chrom)]
-    else:
-        for i, _ in enumerate(args.bootstrap_chrom):
-            args.bootstrap_chrom[i] = (i, args.bootstrap_chrom[i].split(','))
+    parse_bootstrap_chrom(args)
     log.info(args.bootstrap_chrom)
 
     return args
 
 
-def score_submission(submission, status, args, syn,
-                     gene_annotations, enh_annotations):
+def get_submission_file_handle(submission):
+    """Get file handle (with fileName and contentMd5) of a submission
+    without downloading it. Returns None if not found.
+    """
+    try:
+        bundle = json.loads(submission.entityBundleJSON)
+        file_handle_id = bundle['entity']['dataFileHandleId']
+        for file_handle in bundle['fileHandles']:
+            if file_handle['id'] == file_handle_id:
+                return file_handle
+    except (KeyError, TypeError, ValueError):
+        pass
+    return None
+
+
+def get_score_cache_key(args, file_md5, cell, assay):
+    """Key for scores of a submission file. Identical resubmissions
+    have the same key as long as truth, var, blacklist, annotations,
+    metrics and scoring parameters are not changed.
+    """
+    truth_md5 = get_file_md5(os.path.join(
+        args.true_npy_dir, '{}{}.npy'.format(cell, assay)))
+    if args.var_npy_dir is not None:
+        var_md5 = get_file_md5(os.path.join(
+            args.var_npy_dir, 'var_{}.npy'.format(assay)))
+    else:
+        var_md5 = None
+    # submission is blacklist-filtered and metrics use annotations
+    annot_md5s = [get_file_md5(f) for f in (
+        args.blacklist_file, args.gene_annotations, args.enh_annotations)]
+    key = json.dumps([file_md5, truth_md5, var_md5, annot_md5s,
+                      METRIC_VERSION, args.chrom, args.bootstrap_chrom,
+                      args.window_size, args.prom_loc, args.validated])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def get_converted_track_cache(args):
+    if args.converted_cache_dir is None:
+        return None
+    return ConvertedTrackCache(
+        args.converted_cache_dir,
+        int(args.converted_cache_max_gb * 1024**3))
+
+
+def get_converted_key(args, file_md5):
+    return get_converted_track_key(
+        file_md5, args.chrom, args.window_size, args.validated,
+        args.blacklist_file)
+
+
+def estimate_job_memory(args, job):
+    """Estimate peak memory of score_submission() in bytes
+    from file type, chromosome sizes and dtype.
+    Truth/var tracks are in shared memory and not counted here.
+    """
+    chrom_sizes = [CHRSZ[c] for c in args.chrom]
+    num_bins = sum((s - 1) // args.window_size + 1 for s in chrom_sizes)
+    num_bins_max_chrom = (max(chrom_sizes) - 1) // args.window_size + 1
+
+    # converted submission itself
+    mem = num_bins * BYTES_PER_FLOAT
+
+    fname = job['submission_fname'].lower()
+    converted = not job['downloaded'] or \
+        fname.endswith(('npy', 'npz'))
+    if not converted and args.validated:
+        mem += num_bins_max_chrom * VALIDATED_BW_BYTES_PER_BIN
+    elif not converted:
+        mem += max(chrom_sizes) * BW_BYTES_PER_BP
+
+    # largest bootstrap group
+    num_bins_score = max(
+        sum((CHRSZ[c] - 1) // args.window_size + 1 for c in chroms)
+        for _, chroms in args.bootstrap_chrom)
+    mem += num_bins_score * SCORE_BYTES_PER_BIN
+
+    return mem
+
+
+def get_db_writer(args):
+    if args.db_file is None or args.dry_run:
+        return None
+    return ScoreDBWriter(args.db_file)
+
+
+def get_journal(args, db_writer=None):
+    if args.db_file is None or args.dry_run:
+        return None
+    return JobJournal(args.db_file, db_writer)
+
+
+def init_worker(args, track_registry):
+    """Pool initializer. Load annotations and blacklist once per worker
+    so that they survive across polling cycles.
+    """
+    WORKER_STATE['args'] = args
+    # only to mark SCORING with worker's pid (see score_submission()),
+    # scores are returned to the main process and written by its writer
+    WORKER_STATE['journal'] = get_journal(args)
+    WORKER_STATE['converted_track_cache'] = get_converted_track_cache(args)
+    WORKER_STATE['gene_annotations'] = load_annotations(
+        args.gene_annotations, args.window_size, args.prom_loc)
+    WORKER_STATE['enh_annotations'] = load_annotations(
+        args.enh_annotations, args.window_size, args.prom_loc)
+    WORKER_STATE['blacklist_bin_ids'] = get_blacklist_bin_ids(
+        load_bed_columns(args.blacklist_file), args.chrom, args.window_size)
+    WORKER_STATE['track_registry'] = track_registry
+
+
+def fetch_submission(syn, args, submission_id, converted_track_cache=None,
+                     journal=None):
+    """Fetch stage. Download a submission (I/O-bound, runs on a thread).
+
+    Returns:
+        Job dict for score_submission() and report_submission()
+    """
+    submission = syn.getSubmission(submission_id, downloadFile=False)
+    status = syn.getSubmissionStatus(submission_id)
     status['status'] = 'INVALID'
 
     submission_dir = os.path.join(
         os.path.abspath(args.submission_dir), submission.id)
     mkdir_p(submission_dir)
 
-    chosen_score = None  # first bootstrap score
-    metadata = {
-        'id': submission.id,
-        'team': 'undefined'
+    job = {
+        'submission': submission,
+        'status': status,
+        'submission_dir': submission_dir,
+        'submission_fname': None,
+        'cell': None,
+        'assay': None,
+        'metadata': {
+            'id': submission.id,
+            'team': 'undefined'
+        },
+        'score_outputs': None,
+        'file_md5': None,
+        'downloaded': True,
+        'retry': False,
+        'cache_key': None,
+        'cached': False,
+        'resume_stage': None,
+        'error': None
     }
 
     try:
-        metadata['team'] = get_team_name(syn, None, submission.teamId)
+        job['metadata']['team'] = get_team_name(syn, None, submission.teamId)
+
+        file_handle = get_submission_file_handle(submission)
+        if file_handle is not None:
+            job['file_md5'] = file_handle.get('contentMd5')
+
+        # resume from the last completed stage after a crash
+        if journal is not None:
+            record = journal.get(submission.id)
+            if record is not None and record.stage == 'REPORTED':
+                # re-scoring requested
+                journal.reset(submission.id)
+            elif record is not None and file_handle is not None and \
+                    record.stage in ('SCORED', 'WRITTEN'):
+                scores = journal.get_bootstrap_scores(submission.id)
+                if all(k in scores for k, _ in args.bootstrap_chrom):
+                    log.info('Resuming submission {} from stage {}'.format(
+                        submission.id, record.stage))
+                    cell, assay = parse_submission_filename(
+                        file_handle['fileName'])
+                    job['submission_fname'] = file_handle['fileName']
+                    job['cell'] = cell
+                    job['assay'] = assay
+                    job['score_outputs'] = [
+                        (k, scores[k]) for k, _ in args.bootstrap_chrom]
+                    job['resume_stage'] = record.stage
+                    job['cached'] = True
+                    return job
+
+        # look up scores of an identical file without downloading it
+        if args.db_file is not None and job['file_md5'] is not None:
+            cell, assay = parse_submission_filename(file_handle['fileName'])
+            if is_valid_leaderboard_cell_assay(cell, assay):
+                job['cache_key'] = get_score_cache_key(
+                    args, file_handle['contentMd5'], cell, assay)
+                score_outputs = read_score_cache(args.db_file, job['cache_key'])
+                if score_outputs is not None:
+                    log.info('Found cached scores for identical file {}, {}'.format(
+                        submission.id, file_handle['fileName']))
+                    job['submission_fname'] = file_handle['fileName']
+                    job['cell'] = cell
+                    job['assay'] = assay
+                    job['score_outputs'] = score_outputs
+                    job['cached'] = True
+                    return job
+
+        # no need to download if already converted (e.g. retries)
+        if converted_track_cache is not None and job['file_md5'] is not None \
+                and converted_track_cache.has(
+                    get_converted_key(args, job['file_md5'])):
+            cell, assay = parse_submission_filename(file_handle['fileName'])
+            if not is_valid_leaderboard_cell_assay(cell, assay):
+                raise Exception('Invalid cell/assay combination for '
+                                'leaderboard round')
+            log.info('Found converted track, skip downloading {}'.format(
+                submission.id))
+            job['submission_fname'] = file_handle['fileName']
+            job['cell'] = cell
+            job['assay'] = assay
+            job['downloaded'] = False
+            if job['cache_key'] is None and args.db_file is not None:
+                job['cache_key'] = get_score_cache_key(
+                    args, job['file_md5'], cell, assay)
+            if journal is not None:
+                journal.set_stage(submission.id, 'FETCHED')
+            return job
 
         log.info('Downloading submission... {}'.format(submission.id))
         submission = syn.getSubmission(
@@ -338,79 +612,199 @@ def score_submission(submission, status, args, syn,
             ifcollision='overwrite.local'
         )
         print()
+        job['submission'] = submission
         submission_fname = submission.filePath
         cell, assay = parse_submission_filename(submission_fname)
         if not is_valid_leaderboard_cell_assay(cell, assay):
             raise Exception('Invalid cell/assay combination for '
                             'leaderboard round')
+        job['submission_fname'] = submission_fname
+        job['cell'] = cell
+        job['assay'] = assay
+        if job['file_md5'] is None:
+            job['file_md5'] = get_file_md5(submission_fname)
+        if job['cache_key'] is None and args.db_file is not None:
+            job['cache_key'] = get_score_cache_key(
+                args, job['file_md5'], cell, assay)
+        if journal is not None:
+            journal.set_stage(submission.id, 'FETCHED')
 
         log.info('Downloading done {}, {}, {}, {}, {}'.format(
             submission_fname, submission.id,
             submission.teamId, cell, assay))
 
+    except Exception as ex1:
+        st = StringIO()
+        traceback.print_exc(file=st)
+        job['error'] = st.getvalue()
+
+    return job
+
+
+def score_submission(job):
+    """Score stage. Convert and score a downloaded submission
+    (CPU-bound, runs on a pool worker).
+
+    Returns:
+        { 'score_outputs': [(bootstrap_id, Score), ...], 'error': ... }
+    """
+    args = WORKER_STATE['args']
+    gene_annotations = WORKER_STATE['gene_annotations']
+    enh_annotations = WORKER_STATE['enh_annotations']
+    blacklist_bin_ids = WORKER_STATE['blacklist_bin_ids']
+    track_registry = WORKER_STATE['track_registry']
+    converted_track_cache = WORKER_STATE['converted_track_cache']
+    journal = WORKER_STATE['journal']
+
+    submission_id = job['submission'].id
+    submission_fname = job['submission_fname']
+    cell, assay = job['cell'], job['assay']
+
+    acquired_tracks = []  # (key, shm) of attached shared tracks
+    result = {
+        'score_outputs': None,
+        'retry': False,
+        'error': None
+    }
+
+    try:
+        # mark it first so that a worker killed while converting or
+        # loading tracks (e.g. OOM on a big chromosome) is found lost.
+        # this is the only DB write in workers since the watchdog needs
+        # it on disk while the worker is still running
+        if journal is not None:
+            journal.set_stage(submission_id, 'SCORING', os.getpid())
+
         # read pred npy (submission)
-        log.info('Converting to dict...{}'.format(submission.id))
-        y_pred_dict = bw_to_dict(submission_fname, args.chrom,
-                                 args.window_size, args.blacklist_file,
-                                 args.validated)
+        # reuse converted one if cached
+        y_pred_dict = None
+        if converted_track_cache is not None:
+            converted_key = get_converted_key(args, job['file_md5'])
+            y_pred_dict = converted_track_cache.get(converted_key)
+        if y_pred_dict is None and not job['downloaded']:
+            # evicted after fetch stage, download it on next cycle
+            result['retry'] = True
+            raise Exception('Converted track evicted from cache.')
+        if y_pred_dict is None:
+            log.info('Converting to dict...{}'.format(submission_id))
+            y_pred_dict = bw_to_dict(submission_fname, args.chrom,
+                                     args.window_size, args.blacklist_file,
+                                     args.validated, blacklist_bin_ids)
+            if converted_track_cache is not None:
+                y_pred_dict = converted_track_cache.put(
+                    converted_key, y_pred_dict, args.chrom)
         #gc.collect()
-        # read truth npy
+        # attach to truth npy (shared with other workers)
         npy_true = os.path.join(
             args.true_npy_dir,
             '{}{}.npy'.format(cell, assay))
-        y_true_dict = bw_to_dict(npy_true, args.chrom,
-                                 args.window_size, args.blacklist_file)
+        key = '{}{}'.format(cell, assay)
+        y_true_dict, shm = track_registry.acquire(
+            key,
+            lambda: bw_to_dict(npy_true, args.chrom,
+                               args.window_size, args.blacklist_file,
+                               blacklist_bin_ids=blacklist_bin_ids),
+            args.chrom)
+        acquired_tracks.append((key, shm))
         #gc.collect()
-        # read var npy
+        # attach to var npy (shared with other workers)
         if args.var_npy_dir is not None:   
             var_npy = os.path.join(
                 args.var_npy_dir,
                 'var_{}.npy'.format(assay))
-            y_var_dict = load_npy(var_npy)
+            key = 'var_{}'.format(assay)
+            y_var_dict, shm = track_registry.acquire(
+                key, lambda: load_npy(var_npy), args.chrom)
+            acquired_tracks.append((key, shm))
         else:
             y_var_dict = None
         #gc.collect()
 
-        score_outputs = []
-        for k, bootstrap_chrom in args.bootstrap_chrom:
-            # score it for each bootstrap chroms
-            log.info('Scoring... k={}, submission_id={}'.format(k, submission.id))
-            r = score(y_pred_dict, y_true_dict, bootstrap_chrom,
-                      gene_annotations, enh_annotations,
-                      args.window_size, args.prom_loc,
-                      y_var_dict)
-            #gc.collect()  # free memory for bootstrapped arrays
-            log.info('Scored: {}, {}, {}, {}'.format(
-                submission.id, submission.teamId, k, r))
+        # score all bootstrap groups at once
+        # scores are journaled by the writer in the main process
+        log.info('Scoring... submission_id={}'.format(submission_id))
+        score_outputs = score_bootstrap(
+            y_pred_dict, y_true_dict, args.bootstrap_chrom,
+            gene_annotations, enh_annotations,
+            args.window_size, args.prom_loc,
+            y_var_dict)
+
+        for k, r in score_outputs:
+            log.info('Scored: {}, {}, {}'.format(submission_id, k, r))
             for m in r:
                 if math.isnan(m) or m == float('inf') or m == float('-inf'):
                     raise Exception('NaN or +-Inf found in score {}'.format(r))
-            score_outputs.append((k, r))
+        result['score_outputs'] = score_outputs
+
+    except Exception as ex1:
+        st = StringIO()
+        traceback.print_exc(file=st)
+        result['error'] = st.getvalue()
+
+    finally:
+        # detach from shared tracks (last one unlinks them)
+        y_pred_dict = None
+        y_true_dict = None
+        y_var_dict = None
+        for key, shm in acquired_tracks:
+            track_registry.release(key, shm)
+
+    return result
+
+
+def report_submission(syn, args, job, journal=None, db_writer=None):
+    """Write stage. Write scores to DB and report to Synapse
+    (runs on a single writer thread).
+    """
+    submission = job['submission']
+    status = job['status']
+    metadata = job['metadata']
+    score_outputs = job['score_outputs']
+    chosen_score = None  # first bootstrap score
+
+    if job['retry']:
+        # leave it as RECEIVED so that it is scored again
+        log.info('Will retry submission {}: {}'.format(
+            submission.id, job['error']))
+        shutil.rmtree(job['submission_dir'])
+        return status
+
+    try:
+        if job['error'] is not None:
+            raise Exception(job['error'])
 
         # score to be shown on wiki (first bootstrap score)
         chosen_score = score_outputs[0][1]
 
-        # write to db and report
-        for k, score_output in score_outputs:
-            if not args.dry_run:
-                score_db_record = ScoreDBRecord(
-                    int(submission.id),
-                    int(submission.teamId),
-                    submission_fname,
-                    cell,
-                    assay,
-                    k,
-                    *score_output)
-                write_to_db(score_db_record, args.db_file)
+        # checkpoint scores so that they are not scored again
+        # if writing below fails
+        if journal is not None and not job['cached']:
+            journal.set_scored(submission.id, score_outputs)
+
+        # write all bootstraps to db at once and report
+        score_db_records = [
+            ScoreDBRecord(
+                int(submission.id),
+                int(submission.teamId),
+                job['submission_fname'],
+                job['cell'],
+                job['assay'],
+                k,
+                *score_output)
+            for k, score_output in score_outputs]
+        if args.dry_run or job['resume_stage'] == 'WRITTEN':
+            pass
+        elif journal is not None:
+            journal.write_scores(submission.id, score_db_records)
+        else:
+            write_records_to_db(score_db_records, args.db_file, db_writer)
+        if not args.dry_run and not job['cached'] and \
+                job['cache_key'] is not None:
+            write_score_cache(args.db_file, job['cache_key'], score_outputs,
+                              db_writer)
         # mark is as scored
         status['status'] = 'SCORED'
 
-        # free memory
-        y_pred_dict = None
-        y_true_dict = None
-        y_var_dict = None
-        #gc.collect()
-
         subject = 'Successfully scored submission %s %s %s:\n' % (
             submission.name, submission.id, submission.teamId)
         message = 'Score (bootstrap_idx: score)\n'
@@ -425,14 +819,19 @@ def score_submission(submission, status, args, syn,
             teamId = 'undefined'
         subject = 'Error scoring submission %s %s %s:\n' % (
             submission.name, submission.id, teamId)
-        st = StringIO()
-        traceback.print_exc(file=st)
-        message = st.getvalue()
+        if job['error'] is not None:
+            message = job['error']
+        else:
+            st = StringIO()
+            traceback.print_exc(file=st)
+            message = st.getvalue()
+        chosen_score = None
+        status['status'] = 'INVALID'
         log.error(subject + message)
 
     finally:
         # remove submissions (both bigwig, npy) to save disk space
-        shutil.rmtree(submission_dir)
+        shutil.rmtree(job['submission_dir'])
         pass
 
     # send message
@@ -448,12 +847,14 @@ def score_submission(submission, status, args, syn,
         if chosen_score is not None:
             for field in Score._fields:
                 metadata[field] = getattr(chosen_score, field)
-            metadata['cell'] = cell
-            metadata['assay'] = assay
+            metadata['cell'] = job['cell']
+            metadata['assay'] = job['assay']
 
         status['annotations'] = synapseclient.annotations.to_submission_status_annotations(
             metadata, is_private=False)
         status = syn.store(status)
+        if journal is not None:
+            journal.set_stage(submission.id, 'REPORTED')
 
     return status
 
@@ -469,38 +870,86 @@ def main():
         team_name_dict = None
     print(team_name_dict)
 
-    enh_annotations = load_bed(args.enh_annotations)
-    gene_annotations = load_bed(args.gene_annotations)
-
     # do GC manually
     #gc.disable()
 
     syn = synapseclient.login()
-    t0 = time.perf_counter()
+
+    if args.db_file is not None and not args.dry_run:
+        # wiki updates read latest scores only
+        migrate_db_file(args.db_file)
+
+    # truth/var tracks shared among workers
+    manager = multiprocessing.Manager()
+    track_registry = SharedTrackRegistry(manager)
+
+    # pin hot truth tracks for the lifetime of the server
+    # workers will attach to them without loading
+    for cell_assay in args.preload_truth:
+        npy_true = os.path.join(
+            args.true_npy_dir, '{}.npy'.format(cell_assay))
+        track_registry.acquire(
+            cell_assay,
+            lambda: bw_to_dict(npy_true, args.chrom,
+                               args.window_size, args.blacklist_file),
+            args.chrom)
+
+    # init multiprocessing
+    # workers live across polling cycles
+    pool = multiprocessing.Pool(
+        args.nth, initializer=init_worker,
+        initargs=(args, track_registry))
+
+    # download -> convert/score -> write/report
+    converted_track_cache = get_converted_track_cache(args)
+    # all DB writes in main process go through a single connection
+    db_writer = get_db_writer(args)
+    journal = get_journal(args, db_writer)
+    pipeline = ScoringPipeline(
+        lambda submission_id: fetch_submission(
+            syn, args, submission_id, converted_track_cache, journal),
+        score_submission,
+        lambda job: report_submission(syn, args, job, journal, db_writer),
+        pool, args.nth_download, args.max_pending,
+        lost_func=None if journal is None else
+            lambda job: journal.is_lost(job['submission'].id),
+        memory_budget=None if args.mem_limit_gb is None else
+            MemoryBudget(int(args.mem_limit_gb * 1024**3)),
+        estimate_func=lambda job: estimate_job_memory(args, job))
+
+    # dispatch submissions as soon as they arrive
+    scheduler = IntakeScheduler(pipeline.submit,
+                                args.min_period, args.period,
+                                skip_finished=args.dry_run)
+    # team names are looked up in a batch only for new teams
+    team_names = TeamNameResolver(syn, team_name_dict, args.team_name_cache,
+                                  args.team_name_cache_ttl)
+    ranker = IncrementalRanker(args.measures_to_use, team_names=team_names,
+                               num_resamples=args.num_resamples,
+                               seed=args.seed)
+    publisher = WikiPublisher(syn, args.project_id, args.nth_wiki)
+    wiki_outdated = True
 
     while True:
+        busy = False
         try:
             if not args.update_wiki_only:
                 evaluation = syn.getEvaluation(args.eval_queue_id)
 
-                # init multiprocessing
-                pool = multiprocessing.Pool(args.nth)
-
                 # distribute jobs
-                ret_vals = []
-                for submission, status in syn.getSubmissionBundles(evaluation, status='RECEIVED'):
-                    ret_vals.append(
-                        pool.apply_async(score_submission,
-                                         (submission, status, args, syn,
-                                          gene_annotations, enh_annotations)))
-                # gather
-                for r in ret_vals:
-                    r.get(BIG_INT)
+                busy = scheduler.dispatch(
+                    syn.getSubmissionBundles(evaluation, status='RECEIVED')) > 0
 
-                pool.close()
-                pool.join()
+                # gather finished ones
+                n_done, errors = scheduler.collect()
+                if n_done > 0:
+                    wiki_outdated = True
+                if errors:
+                    raise errors[0]
 
-            update_wiki(syn, team_name_dict, args)
+            if wiki_outdated or args.update_wiki_only:
+                update_wiki(syn, team_name_dict, args, ranker, publisher)
+                wiki_outdated = False
 
         except Exception as ex1:
             st = StringIO()
@@ -512,10 +961,9 @@ def main():
                 send_message(syn, args.admin_id, subject, message)
             log.error(message)
 
-        log.info('Waiting for new submissions...')
-        while time.perf_counter() - t0 < args.period:
-            time.sleep(60)
-        t0 = time.perf_counter()
+        period = scheduler.next_interval(busy)
+        log.info('Waiting for new submissions... ({} sec)'.format(period))
+        time.sleep(period)
 
     log.info('All done')
  
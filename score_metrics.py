@@ -10,6 +10,7 @@ import numpy
 from collections import namedtuple
 from sklearn.metrics import roc_auc_score
 from scipy.stats import norm, spearmanr
+from bed import get_bed_columns, get_region_slices, RegionBins
 from logger import log
 
 
@@ -19,6 +20,10 @@ Score = namedtuple(
      'msevar', 'mse1obs', 'mse1imp')
 )
 
+# Bump this whenever a metric changes.
+# Cached scores with a different version are not reused.
+METRIC_VERSION = 1
+
 # Ascending (the bigger the better) or descending order for each metric
 RANK_METHOD_FOR_EACH_METRIC = {
     'mse': 'DESCENDING',
@@ -45,6 +50,13 @@ def gwspear(y_true, y_pred):
     return spearmanr(y_true, y_pred)[0]
 
 
+def _get_annotations(annotations):
+    # parse BED lines once for all chromosomes
+    if isinstance(annotations, RegionBins):
+        return annotations
+    return get_bed_columns(annotations)
+
+
 def mseprom(y_true_dict, y_pred_dict, chroms,
             gene_annotations,
             window_size=25, prom_loc=80):
@@ -55,33 +67,26 @@ def mseprom(y_true_dict, y_pred_dict, chroms,
 
         y_pre_dict: predicted vector per chromosome
             { chr: y_pred } where y_pred is a numpy 1-dim array.
+
+        gene_annotations: RegionBins, BedColumns or BED lines
     """
     sse, n = 0., 0.
+    gene_annotations = _get_annotations(gene_annotations)
 
     for chrom in chroms:
         y_true = y_true_dict[chrom]
         y_pred = y_pred_dict[chrom]
 
-        for line in gene_annotations:
-            chrom_, start, end, _, _, strand = line.split()
-            start = int(start) // window_size
-            end = int(end) // window_size + 1
-
+        # [start-prom_loc: start] for + strand, [end: end+prom_loc] for -
+        starts, stops = get_region_slices(
+            gene_annotations, chrom, window_size, 'prom', prom_loc)
+        for start, stop in zip(starts.tolist(), stops.tolist()):
             # if chrom_ in ('chrX', 'chrY', 'chrM'):
             #     continue
 
-            if chrom_ != chrom:
-                continue
-
-            if strand == '+':
-                sse += ((y_true[start-prom_loc: start] -
-                         y_pred[start-prom_loc: start]) ** 2).sum()
-                n += y_true[start-prom_loc: start].shape[0]
-
-            else:
-                sse += ((y_true[end: end+prom_loc] -
-                         y_pred[end: end+prom_loc]) ** 2).sum()
-                n += y_true[end: end+prom_loc].shape[0]
+            sse += ((y_true[start: stop] -
+                     y_pred[start: stop]) ** 2).sum()
+            n += y_true[start: stop].shape[0]
 
     return sse / n
 
@@ -90,21 +95,18 @@ def msegene(y_true_dict, y_pred_dict, chroms,
             gene_annotations,
             window_size=25):
     sse, n = 0., 0.
+    gene_annotations = _get_annotations(gene_annotations)
 
     for chrom in chroms:
         y_true = y_true_dict[chrom]
         y_pred = y_pred_dict[chrom]
 
-        for line in gene_annotations:
-            chrom_, start, end, _, _, strand = line.split()
-            start = int(start) // window_size
-            end = int(end) // window_size + 1
-
+        starts, ends = get_region_slices(
+            gene_annotations, chrom, window_size, 'gene')
+        for start, end in zip(starts.tolist(), ends.tolist()):
             # if chrom_ in ('chrX', 'chrY', 'chrM'):
             #     continue
 
-            if chrom_ != chrom:
-                continue
             sse += ((y_true[start:end] - y_pred[start:end]) ** 2).sum()
             n += end - start
 
@@ -115,18 +117,15 @@ def mseenh(y_true_dict, y_pred_dict, chroms,
            enh_annotations,
            window_size=25):
     sse, n = 0., 0.
+    enh_annotations = _get_annotations(enh_annotations)
 
     for chrom in chroms:
         y_true = y_true_dict[chrom]
         y_pred = y_pred_dict[chrom]
 
-        for line in enh_annotations:
-            chrom_, start, end, _, _, _, _, _, _, _, _, _ = line.split()
-            start = int(start) // window_size
-            end = int(end) // window_size + 1
-
-            if chrom_ != chrom:
-                continue
+        starts, ends = get_region_slices(
+            enh_annotations, chrom, window_size, 'enh')
+        for start, end in zip(starts.tolist(), ends.tolist()):
             sse += ((y_true[start:end] - y_pred[start:end]) ** 2).sum()
             n += end - start
 
@@ -216,3 +215,474 @@ def normalize_dict(y_dict, chroms):
     #    y_dict_norm[c] = (y - robust_min) / robust_max
     #return y_dict_norm
     return y_dict
+
+
+def _slice_indices(x, length):
+    """Same as slice.indices(length) for an array of slice starts
+    (or stops) with step 1
+    """
+    x = numpy.where(x < 0, x + length, x)
+    return numpy.clip(x, 0, length)
+
+
+def build_region_weights(chrom, chrom_len, annotations, window_size=25,
+                         region='gene', prom_loc=80):
+    """Build a per-bin weight vector counting how many times each bin
+    is visited by mseprom/msegene/mseenh for a chromosome.
+
+    Slices are resolved exactly like the per-annotation loops above
+    (negative starts wrap, ends are clipped) so that
+    sum(w * (y_true - y_pred) ** 2) / n is identical to them.
+
+    Args:
+        annotations: RegionBins, BedColumns or BED lines
+        region: 'prom', 'gene' or 'enh'
+    Returns:
+        (w, n) where w is a numpy 1-dim int64 array of length chrom_len
+        and n is the denominator the metric adds up for this chromosome.
+        msegene/mseenh count unclipped bins (end - start) for n.
+    """
+    start, end = get_region_slices(
+        annotations, chrom, window_size, region, prom_loc)
+    s_start = _slice_indices(start, chrom_len)
+    s_end = _slice_indices(end, chrom_len)
+    m = s_end > s_start
+
+    diff = numpy.zeros(chrom_len + 1, dtype=numpy.int64)
+    numpy.add.at(diff, s_start[m], 1)
+    numpy.add.at(diff, s_end[m], -1)
+    if region == 'prom':
+        n = int((s_end[m] - s_start[m]).sum())
+    else:
+        n = int((end - start).sum())
+
+    return numpy.cumsum(diff[:-1]), n
+
+
+class GroupRanker(object):
+    """Ranks (average of ties like scipy.stats.rankdata) of values
+    over any group of chromosomes.
+
+    Values of each chromosome are sorted once and mapped to indices of
+    distinct values over all chromosomes. Ranks of a group are then
+    built from counts of each distinct value in the group without
+    sorting or concatenating the group.
+    """
+    def __init__(self, y_dict, chroms):
+        uniq, inv, counts = {}, {}, {}
+        for c in chroms:
+            uniq[c], inv[c], counts[c] = numpy.unique(
+                numpy.asarray(y_dict[c], dtype=float),
+                return_inverse=True, return_counts=True)
+        self.values = numpy.unique(numpy.concatenate(
+            [uniq[c] for c in chroms]))
+        # index of distinct value for each bin and
+        # (distinct value index, count) of each chromosome
+        # int32 is enough for a genome (~124M bins at 25bp)
+        self.bin_idx = {}
+        self.value_counts = {}
+        for c in chroms:
+            idx = numpy.searchsorted(self.values, uniq[c])
+            self.bin_idx[c] = idx.astype(numpy.int32)[inv[c]]
+            self.value_counts[c] = (idx, counts[c])
+
+    def ranks(self, chroms):
+        """Ranks of all distinct values in a group. A chromosome can
+        appear many times in a group.
+
+        Returns:
+            (rank of each distinct value, count of each distinct value)
+            rank is not meaningful for values not in the group (count 0)
+        """
+        cnt = numpy.zeros(len(self.values))
+        for c in chroms:
+            idx, n = self.value_counts[c]
+            # distinct in a chromosome so no duplicate in idx
+            cnt[idx] += n
+        less = numpy.cumsum(cnt) - cnt
+        return less + (cnt + 1.0) / 2.0, cnt
+
+
+def gwspear_from_ranks(true_ranker, pred_ranker, chroms):
+    """Same as gwspear on concatenated chromosomes of a group
+    (Pearson correlation of ranks), from GroupRanker's of truth
+    and prediction
+    """
+    r_true, cnt_true = true_ranker.ranks(chroms)
+    r_pred, cnt_pred = pred_ranker.ranks(chroms)
+    n = cnt_true.sum()
+    # mean rank is (n + 1) / 2 for any ties
+    r_true -= (n + 1.0) / 2.0
+    r_pred -= (n + 1.0) / 2.0
+    cov = sum(r_true[true_ranker.bin_idx[c]].dot(
+              r_pred[pred_ranker.bin_idx[c]]) for c in chroms)
+    var_true = cnt_true.dot(r_true * r_true)
+    var_pred = cnt_pred.dot(r_pred * r_pred)
+    return cov / numpy.sqrt(var_true * var_pred)
+
+
+def _top1_index(cnt):
+    """Index of the distinct value used as threshold in mse1obs/mse1imp
+    (numpy.sort(y)[-n]) from counts of distinct values in a group
+    (GroupRanker.ranks())
+    """
+    n = int(cnt.sum() * 0.01)
+    if n == 0:
+        # numpy.sort(y)[-0] is the smallest one
+        return numpy.flatnonzero(cnt)[0]
+    return len(cnt) - 1 - numpy.searchsorted(numpy.cumsum(cnt[::-1]), n)
+
+
+def score_multi(y_pred_mat, y_true, chrom_offsets, groups,
+                gene_annotations, enh_annotations,
+                window_size=25, prom_loc=80,
+                y_var=None, block_size=1000000):
+    """Calculate scores of many submissions on the same cell/assay
+    for many groups of chromosomes (e.g. bootstrap groups) at once.
+
+    Instead of n_teams separate full-genome traversals, all submissions
+    are stacked into one (n_teams x n_bins) matrix (typically a
+    numpy.memmap built by bw_to_npy.stack_npys) and the genome is
+    traversed once in blocks of block_size bins. Each block is compared
+    against the truth for all teams together. Sums are kept for each
+    chromosome and combined for each group.
+
+    gwspear and mse1imp depend on the ordering of each submission so
+    each row is ranked once more (GroupRanker) and reused for all groups.
+
+    Args:
+        y_pred_mat: (n_teams, n_bins) array of concatenated predictions
+        y_true: (n_bins,) array of concatenated truth
+        chrom_offsets: { chrom: (offset, length) } on the bin axis
+        groups: list of groups (list of chromosomes) to be scored.
+            A chromosome can appear many times in a group
+        y_var: (n_bins,) array of concatenated variance or None
+    Returns:
+        [[Score for each row of y_pred_mat] for each group]
+    """
+    n_teams = y_pred_mat.shape[0]
+    chroms = sorted(set(c for group in groups for c in group))
+    regions = ('prom', 'gene', 'enh')
+
+    def get_views(y):
+        return {c: y[o:o + l] for c, (o, l) in chrom_offsets.items()
+                if c in chroms}
+
+    # sums for each chromosome. arrays have a value for each team
+    sums = {}
+    for c in chroms:
+        offset, length = chrom_offsets[c]
+        weights = {
+            'prom': build_region_weights(c, length, gene_annotations,
+                                         window_size, 'prom', prom_loc),
+            'gene': build_region_weights(c, length, gene_annotations,
+                                         window_size, 'gene'),
+            'enh': build_region_weights(c, length, enh_annotations,
+                                        window_size, 'enh'),
+        }
+        s = {
+            'n': length, 'sx': 0., 'sxx': 0., 'var_sum': 0.,
+            'sse': numpy.zeros(n_teams),
+            'sy': numpy.zeros(n_teams),
+            'syy': numpy.zeros(n_teams),
+            'sxy': numpy.zeros(n_teams),
+            'sse_var': numpy.zeros(n_teams),
+        }
+        for r in regions:
+            s['n_' + r] = weights[r][1]
+            s['sse_' + r] = numpy.zeros(n_teams)
+
+        for b in range(0, length, block_size):
+            e = min(b + block_size, length)
+            t = numpy.asarray(y_true[offset + b:offset + e], dtype=float)
+            p = numpy.asarray(y_pred_mat[:, offset + b:offset + e],
+                              dtype=float)
+            sq = (p - t) ** 2
+
+            s['sse'] += sq.sum(axis=1)
+            s['sx'] += t.sum()
+            s['sxx'] += t.dot(t)
+            s['sy'] += p.sum(axis=1)
+            s['syy'] += (p * p).sum(axis=1)
+            s['sxy'] += p.dot(t)
+
+            if y_var is not None:
+                v = numpy.asarray(y_var[offset + b:offset + e], dtype=float)
+                s['sse_var'] += sq.dot(v)
+                s['var_sum'] += v.sum()
+
+            for r in regions:
+                s['sse_' + r] += sq.dot(weights[r][0][b:e])
+        sums[c] = s
+
+    def get_sum(group, k):
+        return sum(sums[c][k] for c in group)
+
+    y_true_dict = get_views(y_true)
+    true_ranker = GroupRanker(y_true_dict, chroms)
+
+    # mse1obs has the same top 1% bins of truth for all teams
+    mse1obs_ = []
+    for group in groups:
+        idx = _top1_index(true_ranker.ranks(group)[1])
+        sse, n = numpy.zeros(n_teams), 0
+        for c in group:
+            offset, _ = chrom_offsets[c]
+            cols = offset + numpy.flatnonzero(true_ranker.bin_idx[c] >= idx)
+            p = numpy.asarray(y_pred_mat[:, cols], dtype=float)
+            sse += ((p - numpy.asarray(y_true[cols], dtype=float)) ** 2).sum(
+                axis=1)
+            n += len(cols)
+        mse1obs_.append(sse / n)
+
+    # gwspear and mse1imp for each team
+    gwspear_ = numpy.zeros((len(groups), n_teams))
+    mse1imp_ = numpy.zeros((len(groups), n_teams))
+    for i in range(n_teams):
+        y_pred_dict = get_views(y_pred_mat[i])
+        pred_ranker = GroupRanker(y_pred_dict, chroms)
+        for j, group in enumerate(groups):
+            gwspear_[j, i] = gwspear_from_ranks(true_ranker, pred_ranker,
+                                                group)
+            idx = _top1_index(pred_ranker.ranks(group)[1])
+            sse, n = 0., 0
+            for c in group:
+                m = pred_ranker.bin_idx[c] >= idx
+                sse += ((numpy.asarray(y_pred_dict[c][m], dtype=float) -
+                         numpy.asarray(y_true_dict[c][m], dtype=float))
+                        ** 2).sum()
+                n += m.sum()
+            mse1imp_[j, i] = sse / n
+        pred_ranker = None
+
+    result = []
+    for j, group in enumerate(groups):
+        n = get_sum(group, 'n')
+        sx, sxx = get_sum(group, 'sx'), get_sum(group, 'sxx')
+        sy, syy = get_sum(group, 'sy'), get_sum(group, 'syy')
+        cov = get_sum(group, 'sxy') - sx * sy / n
+        gwcorr_ = cov / numpy.sqrt((sxx - sx * sx / n) * (syy - sy * sy / n))
+        sse = get_sum(group, 'sse')
+        sse_var = get_sum(group, 'sse_var')
+        var_sum = get_sum(group, 'var_sum')
+        mse_region = {r: get_sum(group, 'sse_' + r) /
+                      get_sum(group, 'n_' + r) for r in regions}
+        result.append([
+            Score(
+                mse=sse[i] / n,
+                gwcorr=gwcorr_[i],
+                gwspear=gwspear_[j, i],
+                mseprom=mse_region['prom'][i],
+                msegene=mse_region['gene'][i],
+                mseenh=mse_region['enh'][i],
+                msevar=0.0 if y_var is None else sse_var[i] / var_sum,
+                mse1obs=mse1obs_[j][i],
+                mse1imp=mse1imp_[j, i],
+            )
+            for i in range(n_teams)])
+    return result
+
+
+# per-chromosome sufficient statistics to score any group of chromosomes
+# (e.g. bootstrap groups) without traversing the genome again
+ChromPartials = namedtuple(
+    'ChromPartials',
+    ('n', 'sse', 'sx', 'sxx', 'sy', 'syy', 'sxy', 'sse_var', 'var_sum',
+     'sse_prom', 'n_prom', 'sse_gene', 'n_gene', 'sse_enh', 'n_enh',
+     'true_top', 'true_top_sse', 'pred_top', 'pred_top_sse')
+)
+
+
+def _top_values(y, sq, top_n):
+    """Largest top_n values of y in descending order and
+    cumulative sum of sq in the same order
+    """
+    if top_n < len(y):
+        idx = numpy.argpartition(-y, top_n - 1)[:top_n]
+        idx = idx[numpy.argsort(-y[idx], kind='stable')]
+    else:
+        idx = numpy.argsort(-y, kind='stable')
+    return y[idx], numpy.cumsum(sq[idx])
+
+
+def calc_chrom_partials(y_true, y_pred, chrom,
+                        gene_annotations, enh_annotations,
+                        window_size=25, prom_loc=80,
+                        y_var=None, top_n=None):
+    """Calculate partials for a chromosome
+
+    Args:
+        top_n: number of largest values of y_true/y_pred to keep
+            for mse1obs/mse1imp. It should be >= 1% of the number of
+            bins of the largest group to be scored. All if None
+    Returns:
+        ChromPartials
+    """
+    y_true = numpy.asarray(y_true, dtype=float)
+    y_pred = numpy.asarray(y_pred, dtype=float)
+    sq = (y_true - y_pred) ** 2
+    length = len(y_true)
+    if top_n is None:
+        top_n = length
+
+    w_prom, n_prom = build_region_weights(
+        chrom, length, gene_annotations, window_size, 'prom', prom_loc)
+    w_gene, n_gene = build_region_weights(
+        chrom, length, gene_annotations, window_size, 'gene')
+    w_enh, n_enh = build_region_weights(
+        chrom, length, enh_annotations, window_size, 'enh')
+
+    if y_var is None:
+        sse_var, var_sum = 0., 0.
+    else:
+        y_var = numpy.asarray(y_var, dtype=float)
+        sse_var, var_sum = sq.dot(y_var), y_var.sum()
+
+    true_top, true_top_sse = _top_values(y_true, sq, top_n)
+    pred_top, pred_top_sse = _top_values(y_pred, sq, top_n)
+
+    return ChromPartials(
+        n=length,
+        sse=sq.sum(),
+        sx=y_true.sum(),
+        sxx=y_true.dot(y_true),
+        sy=y_pred.sum(),
+        syy=y_pred.dot(y_pred),
+        sxy=y_pred.dot(y_true),
+        sse_var=sse_var,
+        var_sum=var_sum,
+        sse_prom=sq.dot(w_prom),
+        n_prom=n_prom,
+        sse_gene=sq.dot(w_gene),
+        n_gene=n_gene,
+        sse_enh=sq.dot(w_enh),
+        n_enh=n_enh,
+        true_top=true_top,
+        true_top_sse=true_top_sse,
+        pred_top=pred_top,
+        pred_top_sse=pred_top_sse)
+
+
+class ChromPartialsScorer(object):
+    """Score many groups of chromosomes (e.g. bootstrap groups) from
+    partials calculated once for each chromosome.
+
+    All metrics are combined from partials. mse1obs/mse1imp find the
+    top 1% threshold of a group by merging per-chromosome top values.
+    gwspear ranks each chromosome once (GroupRanker) and builds ranks
+    of a group from per-value counts, so that no group is sorted or
+    concatenated. It still takes one pass over the bins of a group.
+    """
+    def __init__(self, y_pred_dict, y_true_dict, groups,
+                 gene_annotations, enh_annotations,
+                 window_size=25, prom_loc=80, y_var_dict=None):
+        """
+        Args:
+            groups: list of groups (list of chromosomes) to be scored.
+                A chromosome can appear many times in a group
+                (e.g. resampled with replacement)
+        """
+        self.y_pred_dict = y_pred_dict
+        self.y_true_dict = y_true_dict
+        self.chroms = sorted(set(c for chroms in groups for c in chroms))
+        self.chrom_idx = {c: i for i, c in enumerate(self.chroms)}
+
+        top_n = max(
+            int(sum(len(y_true_dict[c]) for c in chroms) * 0.01)
+            for chroms in groups)
+        self.partials = {}
+        for c in self.chroms:
+            self.partials[c] = calc_chrom_partials(
+                y_true_dict[c], y_pred_dict[c], c,
+                gene_annotations, enh_annotations, window_size, prom_loc,
+                None if y_var_dict is None else y_var_dict[c],
+                max(top_n, 1))
+        self.has_var = y_var_dict is not None
+
+        self.merged_true = self._merge_top('true_top')
+        self.merged_pred = self._merge_top('pred_top')
+
+        self.true_ranker = GroupRanker(y_true_dict, self.chroms)
+        self.pred_ranker = GroupRanker(y_pred_dict, self.chroms)
+
+    def _merge_top(self, attr):
+        """Top values of all chromosomes in descending order
+        and chromosome index for each of them
+        """
+        vals = numpy.concatenate(
+            [getattr(self.partials[c], attr) for c in self.chroms])
+        chrom_idx = numpy.concatenate(
+            [numpy.full(len(getattr(self.partials[c], attr)), i)
+             for i, c in enumerate(self.chroms)])
+        order = numpy.argsort(-vals, kind='stable')
+        return vals[order], chrom_idx[order]
+
+    def _mse_top1(self, chroms, merged, attr, y_dict):
+        """Same as mse1obs (y_dict=y_true_dict) or
+        mse1imp (y_dict=y_pred_dict) for a group
+        """
+        n = sum(self.partials[c].n for c in chroms)
+        k = int(n * 0.01)
+        if k == 0:
+            # threshold is min of all, not worth partials
+            y_true = numpy.concatenate([self.y_true_dict[c] for c in chroms])
+            y_pred = numpy.concatenate([self.y_pred_dict[c] for c in chroms])
+            if y_dict is self.y_true_dict:
+                return mse1obs(y_true, y_pred)
+            return mse1imp(y_true, y_pred)
+
+        # k-th largest value in the group
+        vals, chrom_idx = merged
+        multiplicity = numpy.zeros(len(self.chroms), dtype=numpy.int64)
+        for c in chroms:
+            multiplicity[self.chrom_idx[c]] += 1
+        cum_count = numpy.cumsum(multiplicity[chrom_idx])
+        thresh = vals[numpy.searchsorted(cum_count, k)]
+
+        sse, cnt = 0., 0
+        for c in chroms:
+            p = self.partials[c]
+            top = getattr(p, attr)
+            m = numpy.searchsorted(-top, -thresh, side='right')
+            if m == len(top) and m < p.n:
+                # ties beyond kept top values
+                y = numpy.asarray(y_dict[c], dtype=float)
+                idx = y >= thresh
+                sse += ((numpy.asarray(self.y_true_dict[c], dtype=float)[idx] -
+                         numpy.asarray(self.y_pred_dict[c], dtype=float)[idx]) ** 2).sum()
+                cnt += idx.sum()
+            elif m > 0:
+                sse += getattr(p, attr + '_sse')[m - 1]
+                cnt += m
+        return sse / cnt
+
+    def score(self, chroms):
+        """Score a group of chromosomes
+
+        Returns:
+            Score
+        """
+        p = [self.partials[c] for c in chroms]
+        n = sum(x.n for x in p)
+        sx = sum(x.sx for x in p)
+        sy = sum(x.sy for x in p)
+        sxx = sum(x.sxx for x in p)
+        syy = sum(x.syy for x in p)
+        sxy = sum(x.sxy for x in p)
+        cov = sxy - sx * sy / n
+
+        return Score(
+            mse=sum(x.sse for x in p) / n,
+            gwcorr=cov / numpy.sqrt((sxx - sx * sx / n) * (syy - sy * sy / n)),
+            gwspear=gwspear_from_ranks(self.true_ranker, self.pred_ranker,
+                                       chroms),
+            mseprom=sum(x.sse_prom for x in p) / sum(x.n_prom for x in p),
+            msegene=sum(x.sse_gene for x in p) / sum(x.n_gene for x in p),
+            mseenh=sum(x.sse_enh for x in p) / sum(x.n_enh for x in p),
+            msevar=sum(x.sse_var for x in p) / sum(x.var_sum for x in p)
+                if self.has_var else 0.0,
+            mse1obs=self._mse_top1(chroms, self.merged_true, 'true_top',
+                                   self.y_true_dict),
+            mse1imp=self._mse_top1(chroms, self.merged_pred, 'pred_top',
+                                   self.y_pred_dict),
+        )
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""Imputation challenge shared-memory track cache
+
+Truth/variance tracks are published once into a
+multiprocessing.shared_memory segment and all pool workers scoring
+the same cell/assay attach to it without copying.
+A segment is unlinked when the last worker using it releases it.
+
+Author:
+    Jin Lee (leepc12@gmail.com)
+"""
+
+import os
+import time
+import numpy
+from collections import namedtuple
+from multiprocessing import shared_memory, resource_tracker
+from logger import log
+
+
+SharedTrack = namedtuple(
+    'SharedTrack',
+    ('shm_name', 'dtype', 'chrom_offsets')
+)
+
+# placeholder in registry while a worker is loading a track
+TrackLoading = namedtuple(
+    'TrackLoading',
+    ('pid', 'started')
+)
+
+# another worker takes over loading a track after this time in sec
+TRACK_LOADING_TIMEOUT = 3600
+
+
+def publish_track(y_dict, chroms):
+    """Copy { chrom: array } into a new shared memory segment
+
+    Returns:
+        (SharedTrack, SharedMemory)
+    """
+    dtype = numpy.result_type(*[y_dict[c] for c in chroms])
+    chrom_offsets = {}
+    offset = 0
+    for c in chroms:
+        chrom_offsets[c] = (offset, len(y_dict[c]))
+        offset += len(y_dict[c])
+
+    shm = shared_memory.SharedMemory(
+        create=True, size=max(offset * dtype.itemsize, 1))
+    arr = numpy.ndarray((offset,), dtype=dtype, buffer=shm.buf)
+    for c in chroms:
+        o, l = chrom_offsets[c]
+        arr[o:o + l] = y_dict[c]
+
+    return SharedTrack(shm.name, dtype.str, chrom_offsets), shm
+
+
+def attach_track(shared_track):
+    """Attach to a published track without copying
+
+    Returns:
+        ({ chrom: read-only numpy view }, SharedMemory)
+        SharedMemory must be kept alive while views are used.
+    """
+    shm = shared_memory.SharedMemory(name=shared_track.shm_name)
+    n = sum(l for _, l in shared_track.chrom_offsets.values())
+    arr = numpy.ndarray((n,), dtype=numpy.dtype(shared_track.dtype),
+                        buffer=shm.buf)
+    arr.flags.writeable = False
+    y_dict = {}
+    for c, (o, l) in shared_track.chrom_offsets.items():
+        y_dict[c] = arr[o:o + l]
+    return y_dict, shm
+
+
+class SharedTrackRegistry(object):
+    """Refcounted registry of shared tracks.
+
+    Create it in the main process with a multiprocessing.Manager and
+    pass it to pool workers. Workers call acquire() to get a track
+    (the first one loads and publishes it) and release() when done.
+    """
+    def __init__(self, manager, load_timeout=TRACK_LOADING_TIMEOUT):
+        """
+        Args:
+            load_timeout: time in sec before another worker takes over
+                loading a track (e.g. loader is stuck)
+        """
+        # all workers must share one resource tracker,
+        # otherwise a worker's tracker can unlink segments
+        # still in use by others when the worker exits
+        resource_tracker.ensure_running()
+        self._tracks = manager.dict()
+        self._refcounts = manager.dict()
+        self._lock = manager.Lock()
+        self.load_timeout = load_timeout
+
+    def acquire(self, key, load_func, chroms):
+        """Attach to a track, publish it first if not found.
+        If a worker loading it is killed (e.g. OOM) or takes longer than
+        load_timeout, the track is loaded again.
+
+        Args:
+            key: track name (e.g. CXXMYY or var_MYY)
+            load_func: function returning { chrom: array },
+                called only if the track is not published yet
+        Returns:
+            ({ chrom: array }, SharedMemory)
+        """
+        while True:
+            with self._lock:
+                shared_track = self._tracks.get(key)
+                if isinstance(shared_track, TrackLoading) and \
+                        not self.is_loading(shared_track):
+                    log.warning('Loading shared track {} again. '
+                                'Worker {} loading it is gone or '
+                                'timed out.'.format(key, shared_track.pid))
+                    shared_track = None
+                if shared_track is None:
+                    loading = TrackLoading(os.getpid(), time.time())
+                    self._tracks[key] = loading
+                elif not isinstance(shared_track, TrackLoading):
+                    self._refcounts[key] += 1
+                    log.info('Attaching to shared track {}...'.format(key))
+                    return attach_track(shared_track)
+            if shared_track is not None:
+                # another worker is loading it
+                time.sleep(1)
+                continue
+
+            try:
+                log.info('Publishing shared track {}...'.format(key))
+                shared_track, shm = publish_track(load_func(), chroms)
+            except Exception:
+                with self._lock:
+                    if self._tracks.get(key) == loading:
+                        del self._tracks[key]
+                raise
+
+            with self._lock:
+                if self._tracks.get(key) == loading:
+                    self._tracks[key] = shared_track
+                    self._refcounts[key] = 1
+                    shm.close()
+                    return attach_track(shared_track)
+            # taken over by another worker while loading
+            shm.close()
+            shm.unlink()
+
+    def is_loading(self, loading):
+        """Whether a worker loading a track is still alive and
+        has not timed out.
+        """
+        if time.time() - loading.started > self.load_timeout:
+            return False
+        try:
+            os.kill(loading.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def release(self, key, shm):
+        """Detach from a track and unlink it if nobody else uses it
+        """
+        try:
+            shm.close()
+        except BufferError:
+            # views still alive, segment is freed when they are gc-ed
+            log.warning('Shared track {} still in use.'.format(key))
+        with self._lock:
+            self._refcounts[key] -= 1
+            if self._refcounts[key] > 0:
+                return
+            del self._refcounts[key]
+            del self._tracks[key]
+        log.info('Unlinking shared track {}...'.format(key))
+        shm.unlink()
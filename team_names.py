@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Imputation challenge team name resolver
+
+Team names are looked up on Synapse in a single batched request
+(POST /teamList) for all unknown team IDs and cached in memory and
+optionally on disk (with TTL) so that wiki updates do not make a REST
+call for each row.
+
+Author:
+    Jin Lee (leepc12@gmail.com)
+"""
+
+import os
+import json
+import time
+from logger import log
+
+
+# max number of team IDs in a single POST /teamList
+TEAM_LIST_MAX_IDS = 100
+
+
+class TeamNameResolver(object):
+    """Resolve team names in the same order as rank.get_team_name():
+    team_name_dict (for team_id <= 100), Synapse, team_name_dict, team_id.
+
+    Args:
+        syn: Synapse client (or LocalTeamRestClient). No lookup if None
+        team_name_dict: { team_id: team_name } (e.g. from --team-name-tsv)
+        cache_file: JSON file to keep names across runs
+        ttl: time in sec before names in cache_file are looked up again
+    """
+    def __init__(self, syn, team_name_dict=None, cache_file=None,
+                 ttl=86400):
+        self.syn = syn
+        self.team_name_dict = team_name_dict or {}
+        self.cache_file = cache_file
+        self.ttl = ttl
+        # team_id: (team_name, time looked up)
+        # team_name is None if not found or lookup failed
+        self._cache = {}
+        if cache_file is not None and os.path.exists(cache_file):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.cache_file, 'r') as fp:
+                d = json.load(fp)
+        except ValueError:
+            log.warning('Ignoring corrupted team name cache {}'.format(
+                self.cache_file))
+            return
+        for team_id, (team_name, t) in d.items():
+            self._cache[int(team_id)] = (team_name, t)
+
+    def _save(self):
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w') as fp:
+            json.dump({str(k): v for k, v in self._cache.items()}, fp)
+        os.replace(tmp_file, self.cache_file)
+
+    def _is_fixed(self, team_id):
+        # names in team_name_dict are used first for these IDs
+        return team_id in self.team_name_dict and int(team_id) <= 100
+
+    def _is_cached(self, team_id, now):
+        return team_id in self._cache and \
+            now - self._cache[team_id][1] < self.ttl
+
+    def prefetch(self, team_ids):
+        """Look up names of all unknown team IDs at once
+        """
+        now = time.time()
+        team_ids = sorted(set(
+            int(t) for t in team_ids
+            if not self._is_fixed(t) and not self._is_cached(int(t), now)))
+        if self.syn is None or not team_ids:
+            return
+
+        log.info('Looking up {} team names...'.format(len(team_ids)))
+        for i in range(0, len(team_ids), TEAM_LIST_MAX_IDS):
+            ids = team_ids[i:i + TEAM_LIST_MAX_IDS]
+            # not looked up again until ttl expires even if not found
+            for team_id in ids:
+                self._cache[team_id] = (None, now)
+            try:
+                teams = self.syn.restPOST(
+                    '/teamList', body=json.dumps({'list': ids}))['list']
+            except Exception as e:
+                log.warning('Failed to look up teams: {}'.format(e))
+                continue
+            for team in teams:
+                if 'name' in team:
+                    self._cache[int(team['id'])] = (team['name'], now)
+
+        if self.cache_file is not None:
+            self._save()
+
+    def get(self, team_id):
+        if self._is_fixed(team_id):
+            return self.team_name_dict[team_id]
+        if self.syn is not None:
+            if not self._is_cached(int(team_id), time.time()):
+                self.prefetch([team_id])
+            team_name = self._cache.get(int(team_id), (None, None))[0]
+            if team_name is not None:
+                return team_name
+        if team_id in self.team_name_dict:
+            return self.team_name_dict[team_id]
+        return team_id
+
+
+class LocalTeamRestClient(object):
+    """Local stand-in for a Synapse client's team REST API.
+    For testing TeamNameResolver without Synapse.
+    """
+    def __init__(self, team_name_dict):
+        self.team_name_dict = team_name_dict
+        self.num_calls = 0
+
+    def restGET(self, uri):
+        self.num_calls += 1
+        team_id = int(uri.split('/')[-1])
+        if team_id not in self.team_name_dict:
+            raise ValueError('Team not found: {}'.format(team_id))
+        return {'id': str(team_id), 'name': self.team_name_dict[team_id]}
+
+    def restPOST(self, uri, body):
+        self.num_calls += 1
+        team_ids = json.loads(body)['list']
+        return {'list': [
+            {'id': str(t), 'name': self.team_name_dict[int(t)]}
+            for t in team_ids if int(t) in self.team_name_dict]}
@@ -0,0 +1,79 @@
+from intake import IntakeScheduler, LocalEvaluationQueue
+
+
+class Result(object):
+    def __init__(self, error=None):
+        self.done = False
+        self.error = error
+
+    def ready(self):
+        return self.done
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+
+
+def poll(scheduler, syn):
+    evaluation = syn.getEvaluation('1')
+    return scheduler.dispatch(
+        syn.getSubmissionBundles(evaluation, status='RECEIVED'))
+
+
+def test_dispatch_new_submissions_once():
+    syn = LocalEvaluationQueue()
+    results = {}
+
+    def submit(submission_id):
+        results[submission_id] = Result()
+        return results[submission_id]
+
+    scheduler = IntakeScheduler(submit, min_period=1, max_period=8)
+    syn.submit('C01M01.bw', team_id=1)
+    assert poll(scheduler, syn) == 1
+
+    # still RECEIVED on Synapse while being scored
+    syn.submit('C02M02.bw', team_id=2)
+    assert poll(scheduler, syn) == 1
+    assert sorted(results) == ['1', '2']
+
+    results['1'].done = True
+    syn.store(dict(syn.getSubmissionStatus('1'), status='SCORED'))
+    assert scheduler.collect() == (1, [])
+    assert list(scheduler.in_flight) == ['2']
+    assert poll(scheduler, syn) == 0
+
+
+def test_collect_errors():
+    syn = LocalEvaluationQueue()
+    error = Exception('failed')
+    scheduler = IntakeScheduler(lambda submission_id: Result(error))
+    syn.submit('C01M01.bw', team_id=1)
+    poll(scheduler, syn)
+
+    scheduler.in_flight['1'].done = True
+    assert scheduler.collect() == (1, [error])
+
+
+def test_skip_finished_for_dry_run():
+    syn = LocalEvaluationQueue()
+    scheduler = IntakeScheduler(lambda submission_id: Result(),
+                                skip_finished=True)
+    syn.submit('C01M01.bw', team_id=1)
+    poll(scheduler, syn)
+
+    scheduler.in_flight['1'].done = True
+    scheduler.collect()
+    # status is never stored in dry runs
+    assert poll(scheduler, syn) == 0
+
+
+def test_back_off_while_idle():
+    scheduler = IntakeScheduler(lambda submission_id: Result(),
+                                min_period=1, max_period=8)
+    assert [scheduler.next_interval(False) for _ in range(5)] == \
+        [2, 4, 8, 8, 8]
+    assert scheduler.next_interval(True) == 1
+
+    scheduler.in_flight['1'] = Result()
+    assert scheduler.next_interval(False) == 1
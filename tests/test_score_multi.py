@@ -0,0 +1,68 @@
+import os
+import sys
+
+import numpy
+import pytest
+
+# modules are at the top level of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bed import load_bed_columns
+from bw_to_npy import stack_npys
+from score import score_bootstrap
+from score_metrics import score_multi
+
+CHROM_LENS = {'chr1': 3000, 'chr2': 2000}
+BED = '''chr1\t1000\t5000\t.\t0\t+
+chr1\t20000\t30000\t.\t0\t-
+chr2\t0\t2500\t.\t0\t+
+chr2\t40000\t45000\t.\t0\t-
+'''
+
+
+@pytest.fixture
+def tracks(tmp_path):
+    rng = numpy.random.RandomState(0)
+    # rounded to have ties like real tracks
+    y_true = {c: numpy.round(rng.gamma(1., 2., n), 1)
+              for c, n in CHROM_LENS.items()}
+    y_var = {c: rng.rand(n) for c, n in CHROM_LENS.items()}
+    npy_files = []
+    for i in range(3):
+        npy = str(tmp_path / 'C05M22.{}.npy'.format(i))
+        numpy.save(npy, {c: numpy.round(y + rng.normal(0., 1., len(y)), 1)
+                         for c, y in y_true.items()})
+        npy_files.append(npy)
+    bed = tmp_path / 'annot.bed'
+    bed.write_text(BED)
+    annotations = load_bed_columns(str(bed))
+    return y_true, y_var, npy_files, annotations, str(tmp_path / 'stack.npy')
+
+
+def test_score_multi_matches_score_bootstrap(tracks):
+    y_true, y_var, npy_files, annotations, stack_npy = tracks
+    chroms = ['chr1', 'chr2']
+    bootstrap_chrom = [(0, ['chr1']), (1, ['chr1', 'chr2', 'chr2'])]
+
+    y_pred_mat, chrom_offsets = stack_npys(
+        npy_files, chroms, stack_npy, numpy.float64)
+    scores = score_multi(
+        y_pred_mat, numpy.concatenate([y_true[c] for c in chroms]),
+        chrom_offsets, [group for _, group in bootstrap_chrom],
+        annotations, annotations,
+        y_var=numpy.concatenate([y_var[c] for c in chroms]))
+
+    for i, npy in enumerate(npy_files):
+        expected = score_bootstrap(
+            numpy.load(npy, allow_pickle=True)[()], y_true,
+            bootstrap_chrom, annotations, annotations, y_var_dict=y_var)
+        for j, (_, score) in enumerate(expected):
+            numpy.testing.assert_allclose(scores[j][i], score, rtol=1e-12)
+
+
+def test_stack_npys_rejects_mismatched_bins(tracks, tmp_path):
+    _, _, npy_files, _, stack_npy = tracks
+    short = str(tmp_path / 'C05M22.short.npy')
+    numpy.save(short, {c: numpy.zeros(n - 1) for c, n in CHROM_LENS.items()})
+
+    with pytest.raises(ValueError):
+        stack_npys(npy_files + [short], ['chr1', 'chr2'], stack_npy)
@@ -0,0 +1,61 @@
+from team_names import TeamNameResolver, LocalTeamRestClient
+
+
+def test_prefetch_in_one_call():
+    syn = LocalTeamRestClient({1001: 'A', 1002: 'B'})
+    resolver = TeamNameResolver(syn)
+    resolver.prefetch([1001, 1002, 1001])
+    assert syn.num_calls == 1
+    assert resolver.get(1001) == 'A'
+    assert resolver.get(1002) == 'B'
+    assert syn.num_calls == 1
+
+
+def test_team_name_dict_order():
+    syn = LocalTeamRestClient({7: 'Synapse', 1001: 'Synapse'})
+    resolver = TeamNameResolver(syn, {7: 'Fixed', 1001: 'Dict', 1003: 'Dict'})
+    # team_name_dict first for team_id <= 100
+    assert resolver.get(7) == 'Fixed'
+    assert resolver.get(1001) == 'Synapse'
+    # team_name_dict if not found on Synapse, otherwise team_id
+    assert resolver.get(1003) == 'Dict'
+    assert resolver.get(1004) == 1004
+
+
+def test_cache_misses():
+    syn = LocalTeamRestClient({})
+    resolver = TeamNameResolver(syn)
+    assert resolver.get(1001) == 1001
+    assert resolver.get(1001) == 1001
+    assert syn.num_calls == 1
+
+
+def test_cache_failures():
+    class FailingClient(LocalTeamRestClient):
+        def restPOST(self, uri, body):
+            self.num_calls += 1
+            raise IOError('Service unavailable')
+
+    syn = FailingClient({1001: 'A'})
+    resolver = TeamNameResolver(syn)
+    assert resolver.get(1001) == 1001
+    assert resolver.get(1001) == 1001
+    assert syn.num_calls == 1
+
+
+def test_cache_file_ttl(tmp_path):
+    cache_file = str(tmp_path / 'team_names.json')
+    syn = LocalTeamRestClient({1001: 'A'})
+    TeamNameResolver(syn, cache_file=cache_file).prefetch([1001, 1002])
+    assert syn.num_calls == 1
+
+    # found and not found ones are both cached on disk
+    resolver = TeamNameResolver(syn, cache_file=cache_file)
+    assert resolver.get(1001) == 'A'
+    assert resolver.get(1002) == 1002
+    assert syn.num_calls == 1
+
+    # looked up again once expired
+    resolver = TeamNameResolver(syn, cache_file=cache_file, ttl=0)
+    resolver.prefetch([1001, 1002])
+    assert syn.num_calls == 2
@@ -0,0 +1,40 @@
+import pytest
+from wiki_publisher import WikiPublisher, WikiPage, LocalWikiStore
+
+
+def test_push_changed_pages_only():
+    syn = LocalWikiStore()
+    publisher = WikiPublisher(syn, 'syn1', nth=2)
+    pages = [WikiPage(i, 'title {}'.format(i), 'markdown') for i in range(4)]
+    assert publisher.publish(pages) == 4
+    assert syn.wikis[('syn1', 2)].title == 'title 2'
+
+    num_calls = syn.num_calls
+    assert publisher.publish(pages) == 0
+    assert syn.num_calls == num_calls
+
+    pages[1] = WikiPage(1, 'title 1', 'new markdown')
+    assert publisher.publish(pages) == 1
+    assert syn.wikis[('syn1', 1)].markdown == 'new markdown'
+
+
+def test_push_failed_pages_again():
+    class FailingStore(LocalWikiStore):
+        fail = True
+
+        def store(self, w):
+            if self.fail and w.id == 1:
+                raise IOError('Service unavailable')
+            return super(FailingStore, self).store(w)
+
+    syn = FailingStore()
+    publisher = WikiPublisher(syn, 'syn1')
+    pages = [WikiPage(i, 'title', 'markdown') for i in range(3)]
+    with pytest.raises(IOError):
+        publisher.publish(pages)
+    # other pages are pushed anyway
+    assert sorted(k[1] for k in syn.wikis) == [0, 2]
+
+    syn.fail = False
+    assert publisher.publish(pages) == 1
+    assert sorted(k[1] for k in syn.wikis) == [0, 1, 2]
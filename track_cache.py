@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Imputation challenge converted track cache
+
+Binned, blacklist-filtered submission tracks are kept on scratch disk
+in the flat .npy layout (bw_to_npy.write_dict_to_flat_npy) so that
+retries and re-scoring memory-map them instead of downloading and
+decoding the bigwig again. Least recently used tracks are evicted
+when the cache exceeds its size limit.
+
+Author:
+    Jin Lee (leepc12@gmail.com)
+"""
+
+import os
+import glob
+import json
+import hashlib
+import tempfile
+import threading
+from bw_to_npy import write_dict_to_flat_npy, load_flat_npy
+from logger import log
+
+
+# { (path, mtime, size): md5 } of truth/var/blacklist files
+FILE_MD5_CACHE = {}
+FILE_MD5_CACHE_LOCK = threading.Lock()
+
+
+def get_file_md5(path, chunk_size=1024*1024*16):
+    """md5 of a file, cached until the file is modified
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime, st.st_size)
+    with FILE_MD5_CACHE_LOCK:
+        if key in FILE_MD5_CACHE:
+            return FILE_MD5_CACHE[key]
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            md5.update(chunk)
+
+    with FILE_MD5_CACHE_LOCK:
+        FILE_MD5_CACHE[key] = md5.hexdigest()
+    return FILE_MD5_CACHE[key]
+
+
+def get_converted_track_key(file_md5, chroms, window_size, validated,
+                            blacklist_file):
+    """Key for a converted track.
+    Same file converted with the same parameters and the same
+    blacklist contents has the same key.
+    """
+    key = json.dumps([file_md5, sorted(chroms), window_size, validated,
+                      get_file_md5(blacklist_file)
+                      if blacklist_file else None])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class ConvertedTrackCache(object):
+    """Size-bounded LRU cache of converted tracks on disk.
+    Safe to use from several processes. Files are written under a
+    temporary name and renamed, and a track being evicted stays
+    readable by processes that already memory-mapped it.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _prefix(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def has(self, key):
+        prefix = self._prefix(key)
+        return os.path.exists(prefix + '.npy') and \
+            os.path.exists(prefix + '.json')
+
+    def get(self, key):
+        """Returns:
+            { chrom: memory-mapped array } or None if not cached
+        """
+        prefix = self._prefix(key)
+        try:
+            y_dict = load_flat_npy(prefix)
+            # mark as recently used
+            os.utime(prefix + '.npy')
+        except (FileNotFoundError, ValueError):
+            return None
+        log.info('Found converted track in cache {}'.format(key))
+        return y_dict
+
+    def put(self, key, y_dict, chroms):
+        """Write a converted track and evict old ones if needed.
+        Returns:
+            { chrom: memory-mapped array } of the cached track
+        """
+        prefix = self._prefix(key)
+        tmp_prefix = tempfile.mktemp(prefix='.tmp_' + key,
+                                     dir=self.cache_dir)
+        write_dict_to_flat_npy(y_dict, chroms, tmp_prefix)
+        # write index last, has() checks both
+        os.replace(tmp_prefix + '.npy', prefix + '.npy')
+        os.replace(tmp_prefix + '.json', prefix + '.json')
+        self.evict()
+        try:
+            return load_flat_npy(prefix)
+        except FileNotFoundError:
+            # evicted right away (larger than the cache itself)
+            return y_dict
+
+    def evict(self):
+        """Remove least recently used tracks until the cache fits in
+        max_bytes.
+        """
+        tracks = []
+        total = 0
+        for f in glob.glob(os.path.join(self.cache_dir, '*.npy')):
+            try:
+                st = os.stat(f)
+            except FileNotFoundError:
+                continue
+            tracks.append((st.st_mtime, st.st_size, f))
+            total += st.st_size
+
+        for _, size, f in sorted(tracks):
+            if total <= self.max_bytes:
+                break
+            log.info('Evicting converted track {}'.format(f))
+            prefix = os.path.splitext(f)[0]
+            for ext in ('.json', '.npy'):
+                try:
+                    os.remove(prefix + ext)
+                except FileNotFoundError:
+                    pass
+            total -= size
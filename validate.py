@@ -7,8 +7,13 @@ Author:
 
 import pyBigWig
 import json
+import struct
 import traceback
 import math
+import itertools
+import numpy
+import multiprocessing
+from io import StringIO
 from logger import log
 
 
@@ -39,9 +44,342 @@ CHRSZ = {
     'chrX': 156040895
 }
 
-def validate(bw_file, window_size=25):
+# intervals are read and checked in chunks of this size in bp
+INTERVAL_CHUNK_SIZE = 10000000
+
+# per-worker state loaded once by init_worker()
+WORKER_STATE = {}
+
+# bigwig header (64 bytes) and chromosome B+ tree header (32 bytes)
+# https://genome.ucsc.edu/goldenPath/help/bigWig.html
+BIGWIG_MAGIC = 0x888FFC26
+BIGWIG_HEADER_FORMAT = 'IHHQQQHHQQIQ'
+CHROM_TREE_MAGIC = 0x78CA8C91
+CHROM_TREE_HEADER_FORMAT = 'IIIIQQ'
+# chromosome tree is read into memory at once. trees of hg38 bigwigs
+# (even with all alt/random contigs) are far smaller than this
+MAX_CHROM_TREE_SIZE = 16 * 1024 * 1024
+# timeout in sec for each ranged read of a remote bigwig
+URL_READ_TIMEOUT = 30
+
+
+def intervals_to_arr(intervals):
+    """((start, end, value), ...) from pyBigWig to numpy arrays
+    Returns:
+        (starts, ends, values)
+    """
+    arr = numpy.fromiter(
+        itertools.chain.from_iterable(intervals), dtype=float,
+        count=3 * len(intervals)).reshape(-1, 3)
+    return arr[:, 0], arr[:, 1], arr[:, 2]
+
+
+def find_invalid_interval(starts, ends, values, chrom_size, window_size=25):
+    """Index of the first interval that get_interval_error()
+    finds an error in. None if all are valid.
+    """
+    invalid = (ends != chrom_size) & (
+        (ends - starts != window_size) | (ends > chrom_size) |
+        ~numpy.isfinite(values))
+    idx = numpy.flatnonzero(invalid)
+    if len(idx) == 0:
+        return None
+    return idx[0]
+
+
+def get_interval_error(c, s, start, end, v, window_size=25):
+    """Error message for an interval in chromosome c (size s) or None
+    """
+    if end == s:
+        return None
+    if end-start != window_size:
+        return 'Invalid window size for chromosome {}. '\
+        'start: {}, end: {}, value: {}'.format(
+                c, start, end, v)
+    if end > s:
+        return 'Invalid end interval in chromosome {}. '\
+        'End must be equal to or smaller than chrom size. '\
+        'start: {}, end: {}, value: {}, chrsz: {}'.format(
+                c, start, end, v, s)
+    if math.isnan(v) or v == float('inf') or v == float('-inf'):
+        return 'Found NaN or Inf in chromosome {}. '\
+        'start: {}, end: {}, value: {}, chrsz: {}'.format(
+                c, start, end, v, s)
+    return None
+
+
+def validate_chrom(bw, c, s, window_size=25, cancel=None, binned=None):
+    """Validate intervals of a chromosome.
+    Intervals are read in chunks and checked with numpy.
+
+    Args:
+        cancel: Event. Stop reading chunks (and return None) if set
+        binned: dict. If given, binned values of a valid chromosome
+            (one value per window, 0 for missing windows) are stored in
+            binned[c] while validating it
+    Returns:
+        Error message for the first invalid interval or None
+    """
+    bw_chrsz = bw.chroms(c)
+    if bw_chrsz is None:
+        # raises an error for a chromosome not in the bigwig
+        bw.intervals(c)
+
+    found = False
+    bin_chunks = []  # (starts, values) of each chunk
+    for chunk_start in range(0, bw_chrsz, INTERVAL_CHUNK_SIZE):
+        if cancel is not None and cancel.is_set():
+            return None
+        intervals = bw.intervals(
+            c, chunk_start, min(chunk_start + INTERVAL_CHUNK_SIZE, bw_chrsz))
+        if intervals is None:
+            continue
+        found = True
+        starts, ends, values = intervals_to_arr(intervals)
+        i = find_invalid_interval(starts, ends, values,
+                                  chrom_size=s, window_size=window_size)
+        if i is not None:
+            start, end, v = intervals[i]
+            return get_interval_error(c, s, start, end, v, window_size)
+        if binned is not None:
+            # an interval overlapping two chunks is in both
+            m = starts >= chunk_start
+            bin_chunks.append((starts[m], values[m]))
+
+    if not found:
+        return 'No intervals found for chromosome {}. '.format(c)
+
+    if binned is not None:
+        y = numpy.zeros((bw_chrsz - 1) // window_size + 1)
+        for starts, values in bin_chunks:
+            y[starts.astype(numpy.int64) // window_size] = values
+        binned[c] = y
+    return None
+
+
+def get_file_reader(bw_file):
+    """Returns:
+        read(offset, size) for a local file
+    """
+    def read(offset, size):
+        with open(bw_file, 'rb') as fp:
+            fp.seek(offset)
+            return fp.read(size)
+    return read
+
+
+def get_url_reader(url, timeout=URL_READ_TIMEOUT):
+    """Returns:
+        read(offset, size) with a ranged HTTP GET for each call.
+        Raises socket.timeout (IOError) if the server stalls for
+        timeout sec
+    """
+    from urllib.request import Request, urlopen
+
+    def read(offset, size):
+        req = Request(url, headers={
+            'Range': 'bytes={}-{}'.format(offset, offset + size - 1)})
+        with urlopen(req, timeout=timeout) as res:
+            if res.getcode() != 206:
+                raise IOError('Server does not support ranged read: '
+                              '{}'.format(url))
+            return res.read(size)
+    return read
+
+
+def read_bigwig_chroms(read):
+    """Read chromosome sizes from a bigwig's header and chromosome
+    B+ tree without reading any data.
+
+    Args:
+        read: read(offset, size) from get_file_reader() or
+            get_url_reader()
+    Returns:
+        { chrom: size } in the same order as pyBigWig's chroms()
+    """
+    header = read(0, struct.calcsize('<' + BIGWIG_HEADER_FORMAT))
+    if len(header) < 4:
+        raise ValueError('Not a bigwig file.')
+    if struct.unpack('<I', header[:4])[0] == BIGWIG_MAGIC:
+        endian = '<'
+    elif struct.unpack('>I', header[:4])[0] == BIGWIG_MAGIC:
+        endian = '>'
+    else:
+        raise ValueError('Not a bigwig file.')
+    _, _, _, tree_offset, data_offset, _, _, _, _, _, _, _ = \
+        struct.unpack(endian + BIGWIG_HEADER_FORMAT, header)
+
+    # chromosome tree is stored right before data
+    # so read it at once if possible
+    tree_size = data_offset - tree_offset
+    if tree_size > MAX_CHROM_TREE_SIZE:
+        raise ValueError('Invalid bigwig header. Chromosome tree is too '
+                         'large: {} bytes.'.format(tree_size))
+    tree = read(tree_offset, tree_size) if tree_size > 0 else b''
+
+    def read_tree(offset, size):
+        i = offset - tree_offset
+        if i + size <= len(tree):
+            return tree[i:i + size]
+        return read(offset, size)
+
+    tree_header_size = struct.calcsize(endian + CHROM_TREE_HEADER_FORMAT)
+    magic, _, key_size, _, _, _ = struct.unpack(
+        endian + CHROM_TREE_HEADER_FORMAT,
+        read_tree(tree_offset, tree_header_size))
+    if magic != CHROM_TREE_MAGIC:
+        raise ValueError('Invalid chromosome tree in bigwig.')
+
+    chroms = {}
+
+    def read_node(offset):
+        is_leaf, _, count = struct.unpack(
+            endian + 'BBH', read_tree(offset, 4))
+        offset += 4
+        item_size = key_size + 8
+        items = read_tree(offset, item_size * count)
+        for i in range(count):
+            item = items[i * item_size:(i + 1) * item_size]
+            key = item[:key_size].rstrip(b'\0').decode()
+            if is_leaf:
+                _, chrom_size = struct.unpack(endian + 'II', item[key_size:])
+                chroms[key] = chrom_size
+            else:
+                read_node(struct.unpack(endian + 'Q', item[key_size:])[0])
+
+    read_node(tree_offset + tree_header_size)
+    return chroms
+
+
+def get_chrom_size_errors(chroms):
+    """Check chromosome names and sizes against CHRSZ.
+
+    Args:
+        chroms: { chrom: size } of a bigwig
+    Returns:
+        List of error messages
+    """
+    errors = []
+    # check number of chrs
+    if len(chroms) != len(CHRSZ):
+        errors.append(
+            'Invalid number of chromosome {}. It should match with {}'.format(
+                len(chroms), len(CHRSZ)))
+    # check each chrsz
+    for k, v in chroms.items():
+        if k not in CHRSZ:
+            errors.append('Invalid chromosome {}'.format(k))
+        elif v != CHRSZ[k]:
+            errors.append('Invalid size {} for chromosome {}'.format(v, k))
+    return errors
+
+
+def validate_header(read):
+    """Validate chromosome sizes with a bigwig's header/index only.
+    Much faster than validate() and does not need a whole file
+    (e.g. read with get_url_reader() before downloading a file).
+
+    Returns:
+        (valid, all error messages)
+    """
+    all_msg = ''
+    try:
+        errors = get_chrom_size_errors(read_bigwig_chroms(read))
+    except ValueError as e:
+        errors = [str(e)]
+    except struct.error as e:
+        errors = ['Truncated bigwig header: {}'.format(e)]
+    for msg in errors:
+        print(msg)
+        all_msg += msg + '\n'
+    return not errors, all_msg
+
+
+def init_worker(bw_file, cancel):
+    """Pool initializer. Each worker has its own bigwig handle.
+    """
+    WORKER_STATE['bw'] = pyBigWig.open(bw_file)
+    WORKER_STATE['cancel'] = cancel
+
+
+def validate_chrom_in_worker(task):
+    c, s, window_size = task
+    return c, validate_chrom(WORKER_STATE['bw'], c, s, window_size,
+                             WORKER_STATE['cancel'])
+
+
+def validate_all_chroms(bw_file, bw, window_size=25, nth=1,
+                        full_report=True, binned=None):
+    """Validate intervals of all chromosomes in CHRSZ.
+    Chromosomes are validated in parallel with nth processes.
+
+    Args:
+        bw: bigwig handle used if validated in the current process
+        full_report: Validate all chromosomes. Otherwise stop validating
+            others on the first invalid chromosome.
+        binned: dict to store binned values. See validate_chrom()
+    Returns:
+        { chrom: error message } for invalid chromosomes
+    """
+    errors = {}
+    if nth > 1 and binned is not None:
+        # binned tracks are too large to send back from workers
+        nth = 1
+    if nth > 1 and multiprocessing.current_process().daemon:
+        # e.g. in a worker of validate_round2's pool
+        log.info('Cannot make child processes in a daemonic process. '
+                 'Validating chromosomes sequentially...')
+        nth = 1
+
+    if nth <= 1:
+        for c, s in CHRSZ.items():
+            log.info('Validating chromosome {}...'.format(c))
+            msg = validate_chrom(bw, c, s, window_size, binned=binned)
+            if msg is not None:
+                errors[c] = msg
+                if not full_report:
+                    break
+        return errors
+
+    log.info('Validating {} chromosomes with {} processes...'.format(
+        len(CHRSZ), nth))
+    cancel = multiprocessing.Event()
+    pool = multiprocessing.Pool(
+        min(nth, len(CHRSZ)), initializer=init_worker,
+        initargs=(bw_file, cancel))
+    try:
+        tasks = [(c, s, window_size) for c, s in CHRSZ.items()]
+        # in order of completion so that it stops on the first error
+        for c, msg in pool.imap_unordered(validate_chrom_in_worker, tasks):
+            if msg is not None:
+                errors[c] = msg
+                if not full_report:
+                    break
+    finally:
+        # workers still running stop on their next chunk
+        cancel.set()
+        pool.terminate()
+        pool.join()
+    return errors
+
+
+def validate(bw_file, window_size=25, nth=1, full_report=True,
+             binned=None):
+    """Validate a submission bigwig.
+
+    Args:
+        nth: number of processes to validate chromosomes
+        full_report: Report all errors. Otherwise stop on
+            the first invalid chromosome size or interval.
+        binned: dict to store binned values of valid chromosomes
+            while validating (in the current process only).
+            See validate_chrom()
+    Returns:
+        (valid, all error messages)
+    """
     log.info('Opening bigwig file...')
-    bw = pyBigWig.open(bw_file.strip("'"))
+    bw_file = bw_file.strip("'")
+    bw = pyBigWig.open(bw_file)
     all_msg = ''
     
     try:
@@ -52,65 +390,20 @@ def validate(bw_file, window_size=25):
         # print(json.dumps({k: CHRSZ[k] for k in sorted(CHRSZ)}, indent=4))
         # log.info('==== Your submission ====')
         # print(json.dumps({k: bw.chroms()[k] for k in sorted(bw.chroms())}, indent=4))
-        # check number of chrs
-        if len(bw.chroms()) != len(CHRSZ):
-            msg = 'Invalid number of chromosome {}. It should match with {}'.format(
-                len(bw.chroms()), len(CHRSZ))
+        for msg in get_chrom_size_errors(bw.chroms()):
             print(msg)
             all_msg += msg + '\n'
             valid = False
-        # check each chrsz
-        for k, v in bw.chroms().items():
-            if k not in CHRSZ:
-                msg = 'Invalid chromosome {}'.format(k)
-                print(msg)
-                all_msg += msg + '\n'
-                valid = False
-                continue
-            if v != CHRSZ[k]:
-                msg = 'Invalid size {} for chromosome {}'.format(v, k)
-                print(msg)
-                all_msg += msg + '\n'
-                valid = False
-                continue
 
         # validate window_size
-        for c, s in CHRSZ.items():
-            log.info('Validating chromosome {}...'.format(c))
-            if bw.intervals(c) is None:
-                msg = 'No intervals found for chromosome {}. '.format(c)
-                print(msg)
-                all_msg += msg + '\n'
-                valid = False
-                continue
-            for start, end, v in bw.intervals(c):
-                if end == s:
-                    continue
-                if end-start != window_size:
-                    msg = 'Invalid window size for chromosome {}. '\
-                    'start: {}, end: {}, value: {}'.format(
-                            c, start, end, v)
-                    print(msg)
-                    all_msg += msg + '\n'
-                    valid = False
-                    break
-                if end > s:
-                    msg = 'Invalid end interval in chromosome {}. '\
-                    'End must be equal to or smaller than chrom size. '\
-                    'start: {}, end: {}, value: {}, chrsz: {}'.format(
-                            c, start, end, v, s)
-                    print(msg)
-                    all_msg += msg + '\n'
+        if valid or full_report:
+            errors = validate_all_chroms(
+                bw_file, bw, window_size, nth, full_report, binned)
+            for c in CHRSZ:
+                if c in errors:
+                    print(errors[c])
+                    all_msg += errors[c] + '\n'
                     valid = False
-                    break
-                if math.isnan(v) or v == float('inf') or v == float('-inf'):
-                    msg = 'Found NaN or Inf in chromosome {}. '\
-                    'start: {}, end: {}, value: {}, chrsz: {}'.format(
-                            c, start, end, v, s)
-                    print(msg)
-                    all_msg += msg + '\n'
-                    valid = False
-                    break
 
     except Exception as e:
         st = StringIO()
@@ -132,9 +425,18 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description='ENCODE Imputation Challenge'
                                           'validation script.')
     parser.add_argument('bw', type=str,
-                        help='Bigwig file to be validated.')
+                        help='Bigwig file (or URL with --header-only) '
+                             'to be validated.')
     parser.add_argument('--window-size', default=25, type=int,
                          help='Window size for bigwig in bp')
+    parser.add_argument('--nth', type=int, default=1,
+                        help='Number of processes to validate chromosomes '
+                             'in parallel')
+    parser.add_argument('--header-only', action='store_true',
+                        help='Validate chromosome sizes in header only.')
+    parser.add_argument('--stop-on-first-error', action='store_true',
+                        help='Stop validating on the first invalid '
+                             'chromosome instead of reporting all errors.')
     args = parser.parse_args()
     return args
 
@@ -143,7 +445,15 @@ def main():
     # read params
     args = parse_arguments()
 
-    valid, _ = validate(args.bw, args.window_size)
+    if args.header_only:
+        if args.bw.startswith(('http://', 'https://')):
+            read = get_url_reader(args.bw)
+        else:
+            read = get_file_reader(args.bw)
+        valid, _ = validate_header(read)
+    else:
+        valid, _ = validate(args.bw, args.window_size, args.nth,
+                            not args.stop_on_first_error)
     if valid:
         return 0
     else:
@@ -6,6 +6,7 @@ Author:
 
 import os
 import re
+import json
 import time
 import shutil
 import math
@@ -13,17 +14,27 @@ import math
 import traceback
 import synapseclient
 import multiprocessing
-from validate import validate
+from validate import validate, validate_header, get_url_reader
 from io import StringIO
+from http.client import HTTPException
 from rank import get_team_name, parse_team_name_tsv
 from score import parse_submission_filename
 from score_leaderboard import mkdir_p, send_message
+from score_leaderboard import get_submission_file_handle
+from bw_to_npy import get_blacklist_bin_ids, validate_and_convert
+from bed import load_bed_columns
+from track_cache import ConvertedTrackCache, get_converted_track_key
+from track_cache import get_file_md5
 from score_leaderboard import WIKI_TEMPLATE_SUBMISSION_STATUS, RE_PATTERN_SUBMISSION_FNAME
+from wiki_publisher import WikiPublisher, WikiPage
 from logger import log
 
 
 BIG_INT = 99999999  # for multiprocessing
 
+# per-worker state loaded once by init_worker()
+WORKER_STATE = {}
+
 
 ROUND2_VALID_CELL_ASSAY = [
 'C05M17',
@@ -87,15 +98,14 @@ ROUND2_VALID_CELL_ASSAY = [
 def is_valid_round2_cell_assay(cell, assay):
     return (cell + assay) in ROUND2_VALID_CELL_ASSAY
 
-def update_wiki_for_round2(syn, team_name_dict, args):
+def update_wiki_for_round2(syn, team_name_dict, args, publisher=None):
     # calculate ranks and update round2 wiki
     log.info('Updating wiki...')
     wiki_id_map = {
         k.split(':')[0]: k.split(':')[1] for k in args.round2_wiki_id.split(',')
     }
+    pages = []
     for k, wiki_id in wiki_id_map.items():
-        w = syn.getWiki(args.project_id, wiki_id)
-
         if k == 'submission_status':
             title = 'Submission status'
             markdown = WIKI_TEMPLATE_SUBMISSION_STATUS.format(
@@ -104,9 +114,12 @@ def update_wiki_for_round2(syn, team_name_dict, args):
         else:
             raise Exception('invalid wiki type')
 
-        w.markdown = markdown
-        w.title = title
-        w = syn.store(w)
+        pages.append(WikiPage(wiki_id, title, markdown))
+
+    # push changed pages only
+    if publisher is None:
+        publisher = WikiPublisher(syn, args.project_id)
+    publisher.publish(pages)
 
     return None
 
@@ -124,6 +137,21 @@ def parse_arguments():
                         title='Scoring parameters')
     p_score.add_argument('--window-size', default=25, type=int,
                          help='Window size for bigwig in bp')
+    p_score.add_argument('--chrom', nargs='+',
+                         default=['all'],
+                         help='List of chromosomes to be converted for '
+                              'scoring (with --converted-cache-dir). '
+                              'Set as "all" (default) for all chromosomes.')
+    p_score.add_argument('--blacklist-file',
+                         default=os.path.join(
+                            py_path,
+                            'annot/hg38/hg38.blacklist.bed.gz'),
+                         help='Blacklist BED file for converting submissions '
+                              '(with --converted-cache-dir).')
+    p_score.add_argument('--validate-full-report', action='store_true',
+                         help='Report all errors in a submission. Otherwise '
+                              'stop validating on the first invalid '
+                              'chromosome.')
     p_score.add_argument('--update-wiki-only', action='store_true',
                          help='Update wiki based on DB file (--db-file) without '
                               'scoring submissions')
@@ -133,6 +161,15 @@ def parse_arguments():
                         help='Number of threads to parallelize scoring (per) submission')
     p_sys.add_argument('--team-name-tsv',
                         help='TSV file with team_id/team_name (1st col/2nd col).')
+    p_sys.add_argument('--converted-cache-dir',
+                        help='Convert (bin) valid submissions while validating '
+                             'them and keep them here, so that '
+                             'score.py --validated with the same '
+                             '--converted-cache-dir skips converting them. '
+                             'Disabled if not defined')
+    p_sys.add_argument('--converted-cache-max-gb', type=float, default=20.0,
+                        help='Size limit of --converted-cache-dir in GB. '
+                             'Least recently used tracks are evicted first')
     p_syn = parser.add_argument_group(
                         title='Communitation with synapse')
     p_syn.add_argument('--dry-run', action='store_true',
@@ -155,9 +192,77 @@ def parse_arguments():
                        help='Admin\'s Synapse ID (as string) ')
     args = parser.parse_args()
 
+    if args.chrom == ['all']:
+        args.chrom = ['chr' + str(i) for i in range(1, 23)] + ['chrX']
+    # same order as score.py, converted tracks are keyed by it
+    args.chrom = sorted(args.chrom)
+
     return args
 
-def validate_submission(submission, status, args, syn):
+def init_worker(args):
+    """Pool initializer. Each worker has its own Synapse client so that
+    tasks only need to carry a submission ID.
+    """
+    WORKER_STATE['args'] = args
+    WORKER_STATE['syn'] = synapseclient.login(silent=True)
+    if args.converted_cache_dir is not None:
+        WORKER_STATE['converted_track_cache'] = ConvertedTrackCache(
+            args.converted_cache_dir,
+            int(args.converted_cache_max_gb * 1024**3))
+        WORKER_STATE['blacklist_bin_ids'] = get_blacklist_bin_ids(
+            load_bed_columns(args.blacklist_file), args.chrom, args.window_size)
+    else:
+        WORKER_STATE['converted_track_cache'] = None
+
+
+def validate_submission_header(syn, submission):
+    """Validate a submission's bigwig header with ranged reads
+    before downloading it.
+
+    Returns:
+        (valid, message). valid is None if header cannot be read
+    """
+    try:
+        bundle = json.loads(submission['entityBundleJSON'])
+        file_handle_id = bundle['entity']['dataFileHandleId']
+        res = syn.restPOST(
+            '/fileHandle/batch',
+            body=json.dumps({
+                'requestedFiles': [{
+                    'fileHandleId': file_handle_id,
+                    'associateObjectId': submission.id,
+                    'associateObjectType': 'SubmissionAttachment'
+                }],
+                'includePreSignedURLs': True,
+                'includeFileHandles': False
+            }),
+            endpoint=syn.fileHandleEndpoint)
+        requested_file = res['requestedFiles'][0]
+        if 'failureCode' in requested_file:
+            raise IOError('Failed to get pre-signed URL: {}'.format(
+                requested_file['failureCode']))
+        url = requested_file['preSignedURL']
+    except (KeyError, IndexError, ValueError, IOError) as e:
+        log.warning('Cannot get URL of submission {} to read bigwig header. '
+                    'Validating it after download instead. '
+                    'Cause: {}: {}'.format(submission.id, type(e).__name__, e))
+        return None, ''
+    try:
+        return validate_header(get_url_reader(url))
+    except (IOError, HTTPException) as e:
+        log.warning('Cannot read bigwig header of submission {} with ranged '
+                    'read. Validating it after download instead. '
+                    'Cause: {}: {}'.format(submission.id, type(e).__name__, e))
+        return None, ''
+
+
+def validate_submission(submission_id):
+    args = WORKER_STATE['args']
+    syn = WORKER_STATE['syn']
+    converted_track_cache = WORKER_STATE['converted_track_cache']
+
+    submission = syn.getSubmission(submission_id, downloadFile=False)
+    status = syn.getSubmissionStatus(submission_id)
     status['status'] = 'INVALID'
 
     submission_dir = os.path.join(
@@ -172,26 +277,54 @@ def validate_submission(submission, status, args, syn):
     try:
         metadata['team'] = get_team_name(syn, None, submission.teamId)
 
-        log.info('Downloading submission... {}'.format(submission.id))
-        submission = syn.getSubmission(
-            submission, 
-            downloadLocation=submission_dir, 
-            ifcollision='overwrite.local'
-        )
-        print()
-        submission_fname = submission.filePath
-        cell, assay = parse_submission_filename(submission_fname)
-        if not is_valid_round2_cell_assay(cell, assay):
-            raise Exception('Invalid cell/assay combination for '
-                            'round2 round')
-
-        log.info('Downloading done {}, {}, {}, {}, {}'.format(
-            submission_fname, submission.id,
-            submission.teamId, cell, assay))
-
-        # read pred npy (submission)
-        log.info('Validating bigwig...{}'.format(submission.id))
-        valid, message = validate(submission_fname, args.window_size)
+        # reject a submission with invalid chromosomes without downloading
+        log.info('Validating bigwig header...{}'.format(submission.id))
+        valid, message = validate_submission_header(syn, submission)
+
+        if valid is not False:
+            log.info('Downloading submission... {}'.format(submission.id))
+            submission = syn.getSubmission(
+                submission, 
+                downloadLocation=submission_dir, 
+                ifcollision='overwrite.local'
+            )
+            print()
+            submission_fname = submission.filePath
+            cell, assay = parse_submission_filename(submission_fname)
+            if not is_valid_round2_cell_assay(cell, assay):
+                raise Exception('Invalid cell/assay combination for '
+                                'round2 round')
+
+            log.info('Downloading done {}, {}, {}, {}, {}'.format(
+                submission_fname, submission.id,
+                submission.teamId, cell, assay))
+
+            # read pred npy (submission)
+            log.info('Validating bigwig...{}'.format(submission.id))
+            # submissions are already validated in parallel (one per worker)
+            # so chromosomes of a submission are validated sequentially
+            if converted_track_cache is None:
+                valid, message = validate(
+                    submission_fname, args.window_size,
+                    full_report=args.validate_full_report)
+            else:
+                # convert it while validating, ready for scoring
+                valid, message, y_dict = validate_and_convert(
+                    submission_fname, args.chrom, args.window_size,
+                    blacklist_bin_ids=WORKER_STATE['blacklist_bin_ids'],
+                    full_report=args.validate_full_report)
+                if valid:
+                    file_handle = get_submission_file_handle(submission)
+                    if file_handle is not None and \
+                            file_handle.get('contentMd5') is not None:
+                        file_md5 = file_handle['contentMd5']
+                    else:
+                        file_md5 = get_file_md5(submission_fname)
+                    converted_track_cache.put(
+                        get_converted_track_key(
+                            file_md5, args.chrom, args.window_size, True,
+                            args.blacklist_file),
+                        y_dict, args.chrom)
 
         if valid:
             status['status'] = 'VALIDATED'
@@ -250,28 +383,28 @@ def main():
     syn = synapseclient.login()
     t0 = time.perf_counter()
 
+    # init multiprocessing
+    # workers live across polling cycles
+    pool = multiprocessing.Pool(
+        args.nth, initializer=init_worker, initargs=(args,))
+    publisher = WikiPublisher(syn, args.project_id)
+
     while True:
         try:
             if not args.update_wiki_only:
                 evaluation = syn.getEvaluation(args.eval_queue_id)
 
-                # init multiprocessing
-                pool = multiprocessing.Pool(args.nth)
-
                 # distribute jobs
                 ret_vals = []
                 for submission, status in syn.getSubmissionBundles(evaluation, status='RECEIVED'):
                     ret_vals.append(
                         pool.apply_async(validate_submission,
-                                         (submission, status, args, syn)))
+                                         (submission.id,)))
                 # gather
                 for r in ret_vals:
                     r.get(BIG_INT)
 
-                pool.close()
-                pool.join()
-
-            update_wiki_for_round2(syn, team_name_dict, args)
+            update_wiki_for_round2(syn, team_name_dict, args, publisher)
 
         except Exception as ex1:
             st = StringIO()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Imputation challenge wiki publisher
+
+Keeps a hash of the title/markdown last pushed to each wiki page
+and only pushes pages whose content has changed. Changed pages are
+pushed concurrently with a bounded number of threads.
+
+Author:
+    Jin Lee (leepc12@gmail.com)
+"""
+
+import hashlib
+import threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from logger import log
+
+
+WikiPage = namedtuple(
+    'WikiPage',
+    ('wiki_id', 'title', 'markdown')
+)
+
+
+def get_wiki_page_hash(page):
+    h = hashlib.md5()
+    h.update(page.title.encode())
+    h.update(b'\0')
+    h.update(page.markdown.encode())
+    return h.hexdigest()
+
+
+class WikiPublisher(object):
+    """Push wiki pages only if changed since they were last pushed.
+    All pages are pushed on the first publish().
+
+    Args:
+        syn: Synapse client (or LocalWikiStore)
+        nth: number of threads to push pages
+    """
+    def __init__(self, syn, project_id, nth=4):
+        self.syn = syn
+        self.project_id = project_id
+        self.pool = ThreadPool(nth)
+        self._hashes = {}  # wiki_id: hash of last pushed page
+        self._lock = threading.Lock()
+
+    def _push(self, page, page_hash):
+        w = self.syn.getWiki(self.project_id, page.wiki_id)
+        w.markdown = page.markdown
+        w.title = page.title
+        self.syn.store(w)
+        with self._lock:
+            self._hashes[page.wiki_id] = page_hash
+
+    def publish(self, pages):
+        """Push changed pages and wait until all of them are pushed.
+
+        Returns:
+            Number of pushed pages
+        """
+        changed = []
+        for page in pages:
+            page_hash = get_wiki_page_hash(page)
+            with self._lock:
+                if self._hashes.get(page.wiki_id) == page_hash:
+                    continue
+            changed.append((page, page_hash))
+        log.info('Pushing {} of {} wiki pages...'.format(
+            len(changed), len(pages)))
+
+        results = [self.pool.apply_async(self._push, x) for x in changed]
+        # raise the first error after all pushes are done
+        # failed pages are pushed again on next publish()
+        errors = []
+        for r in results:
+            try:
+                r.get()
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+        return len(changed)
+
+
+class LocalWiki(object):
+    def __init__(self, owner_id, wiki_id, title='', markdown=''):
+        self.ownerId = owner_id
+        self.id = wiki_id
+        self.title = title
+        self.markdown = markdown
+
+
+class LocalWikiStore(object):
+    """Local stand-in for a Synapse client's wiki API.
+    For testing WikiPublisher without Synapse.
+    """
+    def __init__(self):
+        self.wikis = {}  # (owner_id, wiki_id): LocalWiki
+        self.num_calls = 0
+        self._lock = threading.Lock()
+
+    def getWiki(self, owner_id, wiki_id):
+        with self._lock:
+            self.num_calls += 1
+            w = self.wikis.get((owner_id, wiki_id))
+            if w is None:
+                return LocalWiki(owner_id, wiki_id)
+            return LocalWiki(owner_id, wiki_id, w.title, w.markdown)
+
+    def store(self, w):
+        with self._lock:
+            self.num_calls += 1
+            self.wikis[(w.ownerId, w.id)] = w
+            return w